@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""
+Vectorized aggregation of sensor columns (NumPy)
+
+時刻（UNIX秒の float 配列）とメトリクス列（shape = (メトリクス数, 行数)、欠損は NaN）を受け取り、
+バケット集計・移動平均・統計サマリーをベクトル演算で求める。
+欠損は NaN のマスクで扱うため、0.0 の測定値が欠損扱いになることはない。
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+DEFAULT_QUANTILES = (0.05, 0.5, 0.95)
+
+Buckets = namedtuple("Buckets", ["start", "mean", "min", "max", "count"])
+
+
+# --- 変換 ---
+def epochs_from_text(timestamps):
+    """'YYYY-MM-DD HH:MM:SS[.ffffff]' のリストをUNIX秒（float）の配列に変換"""
+    if not len(timestamps):
+        return np.empty(0)
+    return np.array(timestamps, dtype="datetime64[us]").astype(np.int64) / 1e6
+
+
+def values_from_rows(rows, first_column=1):
+    """SQLの行（None を含む）からメトリクス列の配列 (メトリクス数, 行数) を作る"""
+    if not rows:
+        return np.empty((3, 0))
+    return np.array([row[first_column:] for row in rows], dtype=float).T
+
+
+def to_list(values, digits=None):
+    """JSON/テンプレート用のリストに変換（NaN は None、必要なら丸める）"""
+    if digits is not None:
+        values = np.round(values, digits)
+    return [None if v != v else v for v in values.tolist()]
+
+
+# --- バケット集計 ---
+def bucket_keys(ts, bucket, origin=0):
+    return (np.floor((ts - origin) / bucket) * bucket + origin).astype(np.int64)
+
+
+def bucket_aggregate(ts, values, bucket, origin=0):
+    """時刻順の列をバケットごとに集計する（平均・最小・最大・件数、NaNは除外）"""
+    values = np.atleast_2d(values)
+    if ts.size == 0:
+        empty = np.empty((values.shape[0], 0))
+        return Buckets(np.empty(0, dtype=np.int64), empty, empty, empty, empty.astype(np.int64))
+    keys = bucket_keys(ts, bucket, origin)
+    if np.any(keys[1:] < keys[:-1]):
+        order = np.argsort(keys, kind="stable")
+        keys, values = keys[order], values[:, order]
+    starts = np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1))
+    mask = ~np.isnan(values)
+    count = np.add.reduceat(mask, starts, axis=1)
+    total = np.add.reduceat(np.where(mask, values, 0.0), starts, axis=1)
+    mean = np.full(total.shape, np.nan)
+    np.divide(total, count, out=mean, where=count > 0)
+    return Buckets(
+        keys[starts],
+        mean,
+        np.fmin.reduceat(values, starts, axis=1),
+        np.fmax.reduceat(values, starts, axis=1),
+        count,
+    )
+
+
+def merge_partials(starts, totals, counts, bucket, origin=0):
+    """ロールアップの (合計, 件数) をより粗いバケットにまとめて平均を返す: (開始, 平均)"""
+    if starts.size == 0:
+        return starts, np.empty((totals.shape[0], 0))
+    keys = bucket_keys(starts, bucket, origin)
+    boundaries = np.concatenate(([0], np.flatnonzero(np.diff(keys)) + 1))
+    total = np.add.reduceat(totals, boundaries, axis=1)
+    count = np.add.reduceat(counts, boundaries, axis=1)
+    mean = np.full(total.shape, np.nan)
+    np.divide(total, count, out=mean, where=count > 0)
+    return keys[boundaries], mean
+
+
+def rolling_mean(values, points):
+    """直近 points 点の移動平均（NaN は除外、1点でもあれば値を出す）"""
+    values = np.atleast_2d(values)
+    mask = ~np.isnan(values)
+    zero = np.zeros((values.shape[0], 1))
+    total = np.concatenate((zero, np.cumsum(np.where(mask, values, 0.0), axis=1)), axis=1)
+    count = np.concatenate((zero, np.cumsum(mask, axis=1)), axis=1)
+    hi = np.arange(1, values.shape[1] + 1)
+    lo = np.maximum(hi - points, 0)
+    window_count = count[:, hi] - count[:, lo]
+    result = np.full(values.shape, np.nan)
+    np.divide(total[:, hi] - total[:, lo], window_count, out=result, where=window_count > 0)
+    return result
+
+
+# --- 統計サマリー ---
+def summarize_column(column, quantiles=DEFAULT_QUANTILES, digits=1, empty=0):
+    """1列の 件数・平均・最小・最大・標準偏差・最新値・分位点（RunningStats.summary と同じ形）"""
+    present = column[~np.isnan(column)]
+    n = int(present.size)
+
+    def r(value):
+        return round(float(value), digits) if value is not None else empty
+
+    if n == 0:
+        result = {"count": 0, "avg": empty, "min": empty, "max": empty, "std": empty, "last": empty}
+        result.update({f"p{int(round(q * 100))}": empty for q in quantiles})
+        return result
+    result = {
+        "count": n,
+        "avg": r(present.mean()),
+        "min": r(present.min()),
+        "max": r(present.max()),
+        "std": r(present.std(ddof=1) if n > 1 else 0.0),
+        "last": r(present[-1]),
+    }
+    for q, value in zip(quantiles, np.percentile(present, [q * 100 for q in quantiles])):
+        result[f"p{int(round(q * 100))}"] = r(value)
+    return result
+
+
+def summarize(values, metrics, quantiles=DEFAULT_QUANTILES, digits=1):
+    """WindowStats.summary と同じ形の辞書を列から作る"""
+    values = np.atleast_2d(values)
+    result = {"count": int(values.shape[1])}
+    for metric, column in zip(metrics, values):
+        result[metric] = summarize_column(column, quantiles, digits)
+    return result
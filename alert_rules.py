@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""
+Rule-based alert engine
+
+単一サンプルの閾値判定ではなく、ストリーミングで届く読み取り値に対して
+宣言的なルールを逐次評価する。ルールごと・場所ごとの状態は定数サイズで、
+DBを再クエリせずに判定できる。
+
+ルールの種類:
+- threshold: 閾値（below/above）。hysteresis 分戻るまで解除しない
+- rate:      変化率（単位/時間）。指数重み付き回帰で傾きを O(1) 状態で追跡
+共通オプション:
+- for_minutes: 条件が N 分継続したら発報
+- overrides:   場所ごとの設定上書き {"ohana_001": {"value": 25}}
+
+ロガー内で評価するか、`python alert_rules.py` で sensor_data の
+新しい行を追跡するサイドカーとして動かす。
+"""
+
+import argparse
+import json
+import logging
+import math
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+import anomalies
+import locations
+
+logger = logging.getLogger(__name__)
+
+# ルール定義ファイルが無い場合の既定ルール（従来の「30%未満で通知」を含む）
+DEFAULT_RULES = [
+    {
+        "name": "soil_moisture_low",
+        "type": "threshold",
+        "metric": "soil_moisture",
+        "op": "below",
+        "value": 30.0,
+        "hysteresis": 3.0,
+        "kind": "moisture",
+        "subject": "💧水やりアラート（土壌湿度低下）",
+        "body": "⚠️ 土壌湿度が {value}% に低下しました。\n\n日時: {timestamp}\n\n水やりを検討してください。",
+    },
+    {
+        "name": "soil_moisture_fast_drop",
+        "type": "rate",
+        "metric": "soil_moisture",
+        "op": "below",
+        "value": -5.0,
+        "window_minutes": 60,
+        "hysteresis": 1.0,
+        "for_minutes": 20,
+        "subject": "📉 土壌湿度が急速に低下しています",
+        "body": "⚠️ {location} の土壌湿度が {rate:.1f}%/時 で低下しています（現在 {value}%）。\n\n日時: {timestamp}",
+    },
+]
+
+DEFAULT_SUBJECT = "🔔 アラート: {rule}"
+DEFAULT_BODY = "{location} の {metric} がルール「{rule}」の条件を満たしました。\n\n値: {value}\n日時: {timestamp}"
+
+
+def to_epoch(timestamp):
+    """datetime / ISO文字列 / 数値 をUNIX秒に変換"""
+    if isinstance(timestamp, (int, float)):
+        return float(timestamp)
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    return timestamp.timestamp()
+
+
+class RuleEvent:
+    """ルールの発報(fired)・解除(resolved)"""
+
+    def __init__(self, rule, location, state, timestamp, value, rate=None):
+        self.rule = rule
+        self.location = location
+        self.state = state
+        self.timestamp = timestamp
+        self.value = value
+        self.rate = rate
+
+    def format(self, template):
+        return template.format(
+            rule=self.rule.name,
+            metric=self.rule.metric,
+            location=self.location,
+            value=self.value,
+            rate=self.rate if self.rate is not None else 0.0,
+            timestamp=datetime.fromtimestamp(self.timestamp).strftime("%Y-%m-%d %H:%M:%S"),
+        )
+
+    @property
+    def subject(self):
+        return self.format(self.rule.subject)
+
+    @property
+    def body(self):
+        return self.format(self.rule.body)
+
+
+class Rule:
+    """ルール定義（場所ごとの上書きは settings_for() で解決）"""
+
+    TYPES = ("threshold", "rate")
+
+    def __init__(self, spec):
+        self.spec = dict(spec)
+        self.name = spec["name"]
+        self.type = spec.get("type", "threshold")
+        if self.type not in self.TYPES:
+            raise ValueError(f"unknown rule type: {self.type}")
+        self.metric = spec["metric"]
+        self.kind = spec.get("kind", f"rule:{self.name}")
+        self.subject = spec.get("subject", DEFAULT_SUBJECT)
+        self.body = spec.get("body", DEFAULT_BODY)
+        self.overrides = spec.get("overrides", {})
+        self._settings_cache = {}
+
+    def settings_for(self, location):
+        settings = self._settings_cache.get(location)
+        if settings is None:
+            base = {
+                "op": self.spec.get("op", "below"),
+                "value": float(self.spec["value"]),
+                "hysteresis": float(self.spec.get("hysteresis", 0.0)),
+                "for_minutes": float(self.spec.get("for_minutes", 0.0)),
+                "window_minutes": float(self.spec.get("window_minutes", 60.0)),
+                "enabled": self.spec.get("enabled", True),
+            }
+            base.update(self.overrides.get(location, {}))
+            settings = self._settings_cache[location] = base
+        return settings
+
+
+class RuleState:
+    """ルール×場所ごとの定数サイズの状態"""
+
+    __slots__ = ("active", "pending_since", "last_t", "s0", "st", "sv", "stt", "stv")
+
+    def __init__(self):
+        self.active = False
+        self.pending_since = None
+        self.last_t = None
+        # 指数重み付き線形回帰の累積値（時刻は最新サンプルを0とした時間単位）
+        self.s0 = self.st = self.sv = self.stt = self.stv = 0.0
+
+    def update_slope(self, t, value, window_hours):
+        """新しいサンプルを取り込み、窓幅相当の重みでの傾き（単位/時間）を返す"""
+        if self.last_t is not None:
+            dt = (t - self.last_t) / 3600.0
+            if dt < 0:
+                return self.slope()
+            decay = math.exp(-dt / window_hours)
+            # 原点を dt だけ後ろにずらしてから減衰させる
+            self.stt = decay * (self.stt - 2 * dt * self.st + dt * dt * self.s0)
+            self.stv = decay * (self.stv - dt * self.sv)
+            self.st = decay * (self.st - dt * self.s0)
+            self.sv = decay * self.sv
+            self.s0 = decay * self.s0
+        self.s0 += 1.0
+        self.sv += value
+        self.last_t = t
+        return self.slope()
+
+    def slope(self):
+        denominator = self.s0 * self.stt - self.st * self.st
+        if self.s0 < 2 or abs(denominator) < 1e-12:
+            return None
+        return (self.s0 * self.stv - self.st * self.sv) / denominator
+
+    def to_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
+
+    @classmethod
+    def from_dict(cls, data):
+        state = cls()
+        for k in cls.__slots__:
+            if k in data:
+                setattr(state, k, data[k])
+        return state
+
+
+def _breaches(op, observed, limit):
+    return observed < limit if op == "below" else observed > limit
+
+
+def _recovered(op, observed, limit, hysteresis):
+    return observed >= limit + hysteresis if op == "below" else observed <= limit - hysteresis
+
+
+class RuleEngine:
+    """読み取り値を1件ずつ受け取り、発報・解除イベントを返す"""
+
+    def __init__(self, rules=None):
+        self.rules = [Rule(spec) for spec in (rules if rules is not None else DEFAULT_RULES)]
+        self._states = {}
+
+    @classmethod
+    def from_file(cls, path):
+        """ルール定義JSON（[{...}, ...] か {"rules": [...]}）を読み込む。無ければ既定ルール"""
+        if path and os.path.exists(path):
+            with open(path) as f:
+                data = json.load(f)
+            return cls(data["rules"] if isinstance(data, dict) else data)
+        return cls()
+
+    def _state(self, rule, location):
+        key = (rule.name, location)
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = RuleState()
+        return state
+
+    def process(self, location, timestamp, values):
+        """1サンプルを評価する。values は {"soil_moisture": 28.5, ...}"""
+        t = to_epoch(timestamp)
+        events = []
+        for rule in self.rules:
+            value = values.get(rule.metric)
+            if value is None:
+                continue
+            settings = rule.settings_for(location)
+            if not settings["enabled"]:
+                continue
+            state = self._state(rule, location)
+
+            rate = None
+            if rule.type == "rate":
+                rate = state.update_slope(t, value, settings["window_minutes"] / 60.0)
+                if rate is None:
+                    continue
+                observed = rate
+            else:
+                observed = value
+
+            if state.active:
+                if _recovered(settings["op"], observed, settings["value"], settings["hysteresis"]):
+                    state.active = False
+                    state.pending_since = None
+                    events.append(RuleEvent(rule, location, "resolved", t, value, rate))
+                continue
+
+            if not _breaches(settings["op"], observed, settings["value"]):
+                state.pending_since = None
+                continue
+            if state.pending_since is None:
+                state.pending_since = t
+            if t - state.pending_since >= settings["for_minutes"] * 60:
+                state.active = True
+                events.append(RuleEvent(rule, location, "fired", t, value, rate))
+        return events
+
+    # --- 状態の保存（cron実行のロガーで前回の状態を引き継ぐ） ---
+    def state_dict(self):
+        return {f"{name}\t{location}": state.to_dict() for (name, location), state in self._states.items()}
+
+    def load_state_dict(self, data):
+        for key, value in data.items():
+            name, _, location = key.partition("\t")
+            self._states[(name, location)] = RuleState.from_dict(value)
+
+    def load_state(self, path):
+        if not path or not os.path.exists(path):
+            return {}
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠ ルール状態の読み込みに失敗しました: {e}")
+            return {}
+        self.load_state_dict(data.get("rules", {}))
+        return data
+
+    def save_state(self, path, **extra):
+        data = dict(extra, rules=self.state_dict())
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+
+# --- サイドカー実行 ---
+def follow(db_path, engine, on_event, state_path, interval=30.0, batch_size=1000, once=False):
+    """sensor_data に追加された行を id 順に追跡してルールを評価する"""
+    saved = engine.load_state(state_path)
+    last_id = saved.get("last_id")
+    conn = sqlite3.connect(db_path)
+    try:
+        locations.ensure_schema(conn)
+        anomalies.ensure_column(conn)
+        if last_id is None:
+            # 初回は既存データを遡らず、現在の末尾から追跡する
+            last_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM sensor_data").fetchone()[0]
+            engine.save_state(state_path, last_id=last_id)
+        while True:
+            # 品質フラグの付いた値（外れ値・固着など）は評価しない
+            rows = conn.execute(f'''
+                SELECT id, timestamp, {anomalies.masked_columns()}, location_id
+                FROM sensor_data WHERE id > ? ORDER BY id LIMIT ?
+            ''', (last_id, batch_size)).fetchall()
+            registry = locations.registry(conn)
+            for row_id, ts, temperature, humidity, soil_moisture, location_id in rows:
+                values = {"temperature": temperature, "humidity": humidity, "soil_moisture": soil_moisture}
+                for event in engine.process(registry.name_of(location_id) or "default", ts, values):
+                    on_event(event)
+                last_id = row_id
+            if rows:
+                engine.save_state(state_path, last_id=last_id)
+            if once and len(rows) < batch_size:
+                break
+            if len(rows) < batch_size:
+                time.sleep(interval)
+    finally:
+        conn.close()
+    return last_id
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate alert rules over new sensor_data rows")
+    parser.add_argument("--db", default=os.getenv("SENSOR_DB_PATH", "sensor_data.db"))
+    parser.add_argument("--rules", default=os.getenv("ALERT_RULES_PATH", "alert_rules.json"))
+    parser.add_argument("--state", default=os.path.join("logs", "alert_rules_sidecar_state.json"))
+    parser.add_argument("--interval", type=float, default=30.0, help="ポーリング間隔（秒）")
+    parser.add_argument("--once", action="store_true", help="未処理の行を評価したら終了")
+    parser.add_argument("--dry-run", action="store_true", help="メールを送らずログ出力のみ")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+    os.makedirs(os.path.dirname(args.state) or ".", exist_ok=True)
+
+    from dotenv import load_dotenv
+    from alerts import AlertDispatcher, MemoryTransport, SMTPTransport
+    load_dotenv()
+    user = os.getenv("GMAIL_USER")
+    transport = MemoryTransport() if args.dry_run else SMTPTransport(
+        os.getenv("SMTP_HOST", "smtp.gmail.com"), int(os.getenv("SMTP_PORT", "587")), user, os.getenv("GMAIL_PASS"))
+    dispatcher = AlertDispatcher(transport, user, os.getenv("TO_EMAIL"),
+                                 state_path=os.path.join(os.path.dirname(args.state) or ".", "alert_state.json"))
+
+    def on_event(event):
+        logger.info(f"🔔 {event.rule.name} {event.state} @ {event.location}: {event.value}")
+        if event.state == "fired":
+            dispatcher.submit(event.rule.kind, event.subject, event.body, source=event.location)
+
+    engine = RuleEngine.from_file(args.rules)
+    try:
+        follow(args.db, engine, on_event, args.state, interval=args.interval, once=args.once)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dispatcher.close(timeout=60)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,355 @@
+# -*- coding: utf-8 -*-
+"""
+Asynchronous alert dispatcher
+
+メール通知をセンサー読み取りの処理から切り離すためのディスパッチャー。
+- submit() はキューに積むだけで即座に戻る（送信はバックグラウンドスレッド）
+- SMTP接続は使い回し、切断されていれば再接続する
+- アラート種別・発生元ごとのクールダウン（送信できた時刻から数える。状態はJSONに保存し、cron実行をまたいで有効）
+- 短時間に複数のアラートが出た場合は1通のダイジェストにまとめる
+- 送信方法は差し替え可能（SMTPTransport / MemoryTransport / テスト用の FakeSMTPServer）
+"""
+
+import json
+import logging
+import os
+import queue
+import smtplib
+import socketserver
+import threading
+import time
+from email.mime.text import MIMEText
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# アラート種別ごとのデフォルトのクールダウン（秒）
+DEFAULT_COOLDOWNS = {
+    "moisture": 3 * 60 * 60,
+    "sensor_error": 60 * 60,
+    "exception": 60 * 60,
+}
+DEFAULT_COOLDOWN = 60 * 60
+
+# ダイジェストにまとめる待ち時間（秒）
+DEFAULT_DIGEST_WINDOW = 5.0
+
+EMAIL_SEND_SECONDS = metrics.histogram("email_send_seconds", "Time to send an alert email")
+EMAILS_SENT = metrics.counter("email_send_total", "Alert emails by result", ("result",))
+ALERTS = metrics.counter("alerts_total", "Submitted alerts by kind and outcome", ("kind", "outcome"))
+QUEUE_DEPTH = metrics.gauge("alert_queue_depth", "Alerts waiting to be sent")
+
+
+class Alert:
+    """通知1件分"""
+
+    def __init__(self, kind, subject, body, created_at=None, source=None):
+        self.kind = kind
+        self.subject = subject
+        self.body = body
+        self.created_at = created_at or time.time()
+        self.source = source
+
+    @property
+    def key(self):
+        return cooldown_key(self.kind, self.source)
+
+
+def cooldown_key(kind, source=None):
+    """クールダウン状態のキー。発生元の無いアラートは種別だけ（以前の状態ファイルと同じキー）"""
+    return kind if source is None else f"{kind}:{source}"
+
+
+# --- 送信方法 ---
+class SMTPTransport:
+    """SMTP接続を保持して使い回す送信方法"""
+
+    def __init__(self, host="smtp.gmail.com", port=587, user=None, password=None,
+                 starttls=True, timeout=30, idle_timeout=300):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.starttls = starttls
+        self.timeout = timeout
+        self.idle_timeout = idle_timeout
+        self._server = None
+        self._last_used = 0.0
+
+    def _connect(self):
+        server = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        if self.starttls:
+            server.starttls()
+        if self.user:
+            server.login(self.user, self.password)
+        self._server = server
+
+    def _ensure_connected(self):
+        if self._server is None:
+            self._connect()
+            return
+        # しばらく使っていない接続はサーバー側で切られている可能性があるため確認
+        if time.time() - self._last_used > self.idle_timeout:
+            try:
+                self._server.noop()
+            except (smtplib.SMTPException, OSError):
+                self.close()
+                self._connect()
+
+    def send(self, msg):
+        self._ensure_connected()
+        try:
+            self._server.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            # 1回だけ再接続して再送
+            self.close()
+            self._connect()
+            self._server.send_message(msg)
+        self._last_used = time.time()
+
+    def close(self):
+        if self._server is not None:
+            try:
+                self._server.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._server = None
+
+
+class MemoryTransport:
+    """送信したメッセージをメモリに保持する送信方法（テスト・ドライラン用）"""
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, msg):
+        self.messages.append(msg)
+
+    def close(self):
+        pass
+
+
+# --- ディスパッチャー ---
+class AlertDispatcher:
+    """キューとバックグラウンドスレッドでアラートを送信する"""
+
+    def __init__(self, transport, sender, recipient, cooldowns=None,
+                 digest_window=DEFAULT_DIGEST_WINDOW, state_path=None):
+        self.transport = transport
+        self.sender = sender
+        self.recipient = recipient
+        self.cooldowns = dict(DEFAULT_COOLDOWNS, **(cooldowns or {}))
+        self.digest_window = digest_window
+        self.state_path = state_path
+        self._queue = queue.Queue()
+        self._state_lock = threading.Lock()
+        self._last_sent = self._load_state()
+        self._pending = set()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name="alert-dispatcher", daemon=True)
+        self._thread.start()
+
+    # --- クールダウン状態 ---
+    def _load_state(self):
+        if not self.state_path or not os.path.exists(self.state_path):
+            return {}
+        try:
+            with open(self.state_path) as f:
+                return json.load(f).get("last_sent", {})
+        except (OSError, ValueError) as e:
+            logger.warning(f"⚠ アラート状態の読み込みに失敗しました: {e}")
+            return {}
+
+    def _save_state(self):
+        if not self.state_path:
+            return
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"last_sent": self._last_sent}, f)
+        os.replace(tmp_path, self.state_path)
+
+    def _cooldown(self, kind):
+        return self.cooldowns.get(kind, DEFAULT_COOLDOWN)
+
+    def submit(self, kind, subject, body, source=None):
+        """アラートをキューに積む。同じ種別・発生元（場所・センサー名など）がクールダウン中か
+        送信待ちなら破棄して False を返す"""
+        now = time.time()
+        key = cooldown_key(kind, source)
+        with self._state_lock:
+            last = self._last_sent.get(key)
+            if key in self._pending or (last is not None and now - last < self._cooldown(kind)):
+                ALERTS.labels(kind, "suppressed").inc()
+                logger.info(f"🔕 クールダウン中のため通知を抑制しました: {subject}")
+                return False
+            # 送信完了前に同じアラートが続いても重複しないよう、送信待ちとして記録する
+            # （クールダウンは送信できた時点で始める）
+            self._pending.add(key)
+        ALERTS.labels(kind, "queued").inc()
+        self._queue.put(Alert(kind, subject, body, now, source))
+        QUEUE_DEPTH.set(self._queue.qsize())
+        return True
+
+    # --- 送信スレッド ---
+    def _run(self):
+        while True:
+            alert = self._queue.get()
+            if alert is None:
+                break
+            batch = [alert]
+            # ダイジェスト待ち時間内に届いたアラートをまとめる
+            deadline = time.time() + self.digest_window
+            stop = False
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    nxt = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if nxt is None:
+                    stop = True
+                    break
+                batch.append(nxt)
+            QUEUE_DEPTH.set(self._queue.qsize())
+            self._send_batch(batch)
+            if stop:
+                break
+        self.transport.close()
+
+    def _build_message(self, batch):
+        if len(batch) == 1:
+            subject, body = batch[0].subject, batch[0].body
+        else:
+            subject = f"📋 植物センサー通知まとめ（{len(batch)}件）"
+            sections = []
+            for alert in batch:
+                sent_at = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(alert.created_at))
+                sections.append(f"■ {alert.subject}（{sent_at}）\n{alert.body}")
+            body = "\n\n".join(sections)
+        msg = MIMEText(body)
+        msg["Subject"] = subject
+        msg["From"] = self.sender
+        msg["To"] = self.recipient
+        return msg
+
+    def _send_batch(self, batch):
+        msg = self._build_message(batch)
+        start = time.perf_counter()
+        sent = False
+        try:
+            self.transport.send(msg)
+            sent = True
+            EMAILS_SENT.labels("ok").inc()
+            logger.info("📧 メール送信しました: " + msg["Subject"])
+        except Exception as e:
+            EMAILS_SENT.labels("error").inc()
+            logger.error(f"❌ メール送信に失敗しました: {e}")
+        finally:
+            EMAIL_SEND_SECONDS.observe(time.perf_counter() - start)
+        with self._state_lock:
+            # 送れなかったアラートはクールダウンを始めず、次の発生時に再送できるようにする
+            sent_at = time.time()
+            for alert in batch:
+                self._pending.discard(alert.key)
+                if sent:
+                    self._last_sent[alert.key] = sent_at
+            try:
+                self._save_state()
+            except OSError as e:
+                logger.warning(f"⚠ アラート状態の保存に失敗しました: {e}")
+
+    def close(self, timeout=None):
+        """キューに残ったアラートを送り切ってからスレッドを終了する"""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join(timeout)
+        if self._thread.is_alive():
+            logger.warning("⚠ アラート送信が時間内に完了しませんでした")
+
+
+# --- テスト用のローカルSMTPサーバー ---
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    """EHLO/MAIL/RCPT/DATA/QUIT のみを扱う最小限のSMTPハンドラ"""
+
+    def _reply(self, line):
+        self.wfile.write((line + "\r\n").encode())
+
+    def handle(self):
+        self._reply("220 localhost fake SMTP ready")
+        mail_from, rcpt_to = None, []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line.decode(errors="replace").strip()
+            verb = command[:4].upper()
+            if verb in ("EHLO", "HELO"):
+                self._reply("250 localhost")
+            elif verb == "MAIL":
+                mail_from, rcpt_to = command[10:].strip(), []
+                self._reply("250 OK")
+            elif verb == "RCPT":
+                rcpt_to.append(command[8:].strip())
+                self._reply("250 OK")
+            elif verb == "DATA":
+                self._reply("354 End data with <CR><LF>.<CR><LF>")
+                data = []
+                while True:
+                    data_line = self.rfile.readline()
+                    if not data_line or data_line in (b".\r\n", b".\n"):
+                        break
+                    if data_line.startswith(b".."):
+                        data_line = data_line[1:]
+                    data.append(data_line)
+                self.server.messages.append({
+                    "from": mail_from,
+                    "to": rcpt_to,
+                    "data": b"".join(data).decode(errors="replace"),
+                })
+                self._reply("250 OK")
+            elif verb in ("RSET", "NOOP"):
+                self._reply("250 OK")
+            elif verb == "QUIT":
+                self._reply("221 Bye")
+                break
+            else:
+                self._reply("502 Command not implemented")
+
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """受信したメールを messages に溜めるローカルSMTPサーバー
+
+    with FakeSMTPServer() as server:
+        transport = SMTPTransport("127.0.0.1", server.port, starttls=False)
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, host="127.0.0.1", port=0):
+        super().__init__((host, port), _SMTPHandler)
+        self.messages = []
+        self.connections = 0
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+        return False
@@ -0,0 +1,367 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming anomaly and stuck-sensor detection
+
+取り込み時に1件ずつ読み取り値を検査し、疑わしい値に品質フラグを付ける。
+状態はメトリクスごとに直近 WINDOW 件と直前の値だけ（定数サイズ）で、
+cron実行のロガーのために anomaly_state テーブルへ保存する。
+
+検出する異常（メトリクスごとに4ビット、sensor_data.quality に保存）:
+- SPIKE:        直近の中央値から MAD（中央絶対偏差）の SPIKE_Z 倍以上離れた値
+- FLATLINE:     まったく同じ値が FLATLINE 件以上続いている（断線した SEN0193 など）
+- IMPOSSIBLE:   物理的にあり得ない値・変化速度
+- INCONSISTENT: センサー間で矛盾する値（DHT11 の読み取り失敗による 温度0・湿度0 など）
+
+quality が 0 の値だけを集計に使う。フラグの付いたメトリクスは SQL では
+masked_columns() で NULL として読み出すため、ロールアップ・スケッチ・グラフの
+集計からは欠損として除外される。ANOMALY_ACTION=quarantine の場合は、
+フラグの付いた行を sensor_data に入れず sensor_quarantine に保存する。
+
+既存データの検査（フラグの付け直し）:
+    python anomalies.py --rescan
+
+フラグが変わった場所・期間のロールアップ・スケッチなどの派生データも作り直し、import_runs に
+記録してダッシュボードのタイルとホットキャッシュを読み直させる（bulk_import.rescan）。
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+from collections import deque
+
+import locations
+import timeseries
+
+METRICS = ("temperature", "humidity", "soil_moisture")
+
+SPIKE = 1
+FLATLINE = 2
+IMPOSSIBLE = 4
+INCONSISTENT = 8
+FLAG_NAMES = {SPIKE: "spike", FLATLINE: "flatline", IMPOSSIBLE: "impossible", INCONSISTENT: "inconsistent"}
+BITS_PER_METRIC = 4
+
+# "flag"（フラグを付けて保存）または "quarantine"（sensor_quarantine に隔離）
+ANOMALY_ACTION = os.getenv("ANOMALY_ACTION", "flag")
+
+# 中央値・MAD を求める直近の件数（10分間隔で約2時間）と、判定を始める最小件数
+WINDOW = 13
+MIN_WINDOW = 5
+SPIKE_Z = 6.0
+# この時間以上データが空いたら変化速度は判定しない
+MAX_RATE_GAP = 2 * 3600
+
+# メトリクスごとの設定
+#   range:      物理的に取り得る範囲（両端を含む）
+#   max_rise / max_drop: 1時間あたりの最大変化量（None は判定しない）
+#   spike_min:  外れ値とみなす中央値からの最小の差（MAD が0のときの下限）
+#   spike_up:   上向きの外れ値も判定するか（土壌湿度の上昇は水やりなので判定しない）
+#   flatline:   同じ値がこの件数以上続いたら固着とみなす（DHT11 は整数値なので長め）
+LIMITS = {
+    "temperature": {"range": (-20.0, 60.0), "max_rise": 20.0, "max_drop": 20.0,
+                    "spike_min": 5.0, "spike_up": True, "flatline": 72},
+    "humidity": {"range": (1.0, 100.0), "max_rise": 60.0, "max_drop": 60.0,
+                 "spike_min": 15.0, "spike_up": True, "flatline": 72},
+    "soil_moisture": {"range": (0.0, 100.0), "max_rise": None, "max_drop": 40.0,
+                      "spike_min": 15.0, "spike_up": False, "flatline": 18},
+}
+
+# 途中から検査し直すときに検出器の状態を作る行数（窓と固着の判定に必要な件数）
+WARMUP = max(WINDOW, *(limits["flatline"] for limits in LIMITS.values()))
+
+CREATE_STATE_SQL = '''
+    CREATE TABLE IF NOT EXISTS anomaly_state (
+        sensor_location TEXT PRIMARY KEY,
+        state TEXT NOT NULL
+    ) WITHOUT ROWID
+'''
+
+CREATE_QUARANTINE_SQL = '''
+    CREATE TABLE IF NOT EXISTS sensor_quarantine (
+        id INTEGER PRIMARY KEY,
+        timestamp DATETIME,
+        temperature FLOAT,
+        humidity FLOAT,
+        soil_moisture FLOAT,
+        sensor_location VARCHAR,
+        quality INTEGER NOT NULL
+    )
+'''
+
+
+# --- 品質フラグ ---
+def metric_flags(quality, metric):
+    return (quality >> (BITS_PER_METRIC * METRICS.index(metric))) & 0xF
+
+
+def metric_mask(metric):
+    return 0xF << (BITS_PER_METRIC * METRICS.index(metric))
+
+
+def describe(quality):
+    """{"soil_moisture": ["flatline"], ...}（フラグの無いメトリクスは含めない）"""
+    result = {}
+    for metric in METRICS:
+        flags = metric_flags(quality, metric)
+        if flags:
+            result[metric] = [name for bit, name in FLAG_NAMES.items() if flags & bit]
+    return result
+
+
+def masked_columns(include_flagged=False):
+    """SELECT 用の 温度・湿度・土壌湿度 の列。フラグの付いた値は NULL にする"""
+    if include_flagged:
+        return ", ".join(METRICS)
+    return ", ".join(
+        f"CASE WHEN quality & {metric_mask(m)} THEN NULL ELSE {m} END AS {m}" for m in METRICS)
+
+
+def masked_values(values, quality):
+    """取り込み時の値の辞書から、フラグの付いたメトリクスを None にしたものを返す"""
+    return {m: (None if quality & metric_mask(m) else values.get(m)) for m in METRICS}
+
+
+def ensure_column(conn, table_name="sensor_data"):
+    """sensor_data に quality 列が無ければ追加する（既存行は 0 = 正常）"""
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")]
+    if columns and "quality" not in columns:
+        conn.execute(f"ALTER TABLE {table_name} ADD COLUMN quality INTEGER NOT NULL DEFAULT 0")
+        conn.commit()
+
+
+# --- 検出器 ---
+class SeriesDetector:
+    """1メトリクス分の状態（直近 WINDOW 件・直前の正常値・同じ値の連続数）"""
+
+    __slots__ = ("limits", "window", "last_time", "last_value", "run_value", "run_length")
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.window = deque(maxlen=WINDOW)
+        self.last_time = None
+        self.last_value = None
+        self.run_value = None
+        self.run_length = 0
+
+    def check(self, epoch, value):
+        """値を検査してフラグを返し、状態を更新する"""
+        if value is None:
+            return 0
+        limits = self.limits
+        flags = 0
+        low, high = limits["range"]
+        if not low <= value <= high:
+            return IMPOSSIBLE  # 範囲外の値は状態に入れない
+
+        if self.last_value is not None and 0 < epoch - self.last_time <= MAX_RATE_GAP:
+            rate = (value - self.last_value) * 3600 / (epoch - self.last_time)
+            if (limits["max_rise"] is not None and rate > limits["max_rise"]) or \
+                    (limits["max_drop"] is not None and -rate > limits["max_drop"]):
+                flags |= IMPOSSIBLE
+
+        if len(self.window) >= MIN_WINDOW:
+            ordered = sorted(self.window)
+            median = ordered[len(ordered) // 2]
+            mad = sorted(abs(v - median) for v in ordered)[len(ordered) // 2]
+            deviation = value - median
+            if (deviation < 0 or limits["spike_up"]) and \
+                    abs(deviation) > max(limits["spike_min"], SPIKE_Z * 1.4826 * mad):
+                flags |= SPIKE
+
+        if value == self.run_value:
+            self.run_length += 1
+        else:
+            self.run_value, self.run_length = value, 1
+        if self.run_length >= limits["flatline"]:
+            flags |= FLATLINE
+
+        # 外れ値も窓には入れる（本当に水準が変わった場合は中央値が追従する）
+        self.window.append(value)
+        if not flags & IMPOSSIBLE:
+            self.last_time, self.last_value = epoch, value
+        return flags
+
+    def to_dict(self):
+        return [list(self.window), self.last_time, self.last_value, self.run_value, self.run_length]
+
+    def load(self, data):
+        window, self.last_time, self.last_value, self.run_value, self.run_length = data
+        self.window.extend(window)
+
+
+class AnomalyDetector:
+    """1場所分の検出器。check() で sensor_data.quality の値を返す"""
+
+    def __init__(self):
+        self.series = {m: SeriesDetector(LIMITS[m]) for m in METRICS}
+
+    def check(self, epoch, values):
+        flags = {m: self.series[m].check(epoch, values.get(m)) for m in METRICS}
+        # センサー間の整合性: DHT11 の読み取り失敗は 温度0・湿度0 になる
+        temperature, humidity = values.get("temperature"), values.get("humidity")
+        if temperature == 0 and humidity == 0:
+            flags["temperature"] |= INCONSISTENT
+            flags["humidity"] |= INCONSISTENT
+        # 温度と湿度が同時に外れ値になるのは、環境の変化より読み取りの破損が疑わしい
+        if flags["temperature"] & SPIKE and flags["humidity"] & SPIKE:
+            flags["temperature"] |= INCONSISTENT
+            flags["humidity"] |= INCONSISTENT
+        quality = 0
+        for m in METRICS:
+            quality |= flags[m] << (BITS_PER_METRIC * METRICS.index(m))
+        return quality
+
+    def to_dict(self):
+        return {m: self.series[m].to_dict() for m in METRICS}
+
+    @classmethod
+    def from_dict(cls, data):
+        detector = cls()
+        for m in METRICS:
+            if m in data:
+                detector.series[m].load(data[m])
+        return detector
+
+
+def load_detector(conn, location):
+    conn.execute(CREATE_STATE_SQL)
+    row = conn.execute("SELECT state FROM anomaly_state WHERE sensor_location = ?", (location,)).fetchone()
+    return AnomalyDetector.from_dict(json.loads(row[0])) if row else AnomalyDetector()
+
+
+def save_detector(conn, location, detector):
+    conn.execute("INSERT OR REPLACE INTO anomaly_state (sensor_location, state) VALUES (?, ?)",
+                 (location, json.dumps(detector.to_dict())))
+
+
+def quarantine(conn, timestamp, values, location, quality):
+    """フラグの付いた行を sensor_quarantine に保存する（コミットは呼び出し側）"""
+    conn.execute(CREATE_QUARANTINE_SQL)
+    conn.execute('''
+        INSERT INTO sensor_quarantine (timestamp, temperature, humidity, soil_moisture, sensor_location, quality)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (str(timestamp), values.get("temperature"), values.get("humidity"), values.get("soil_moisture"),
+          location, quality))
+
+
+def flagged(conn, table_name, location, start_epoch, end_epoch, limit=1000):
+    """期間内のフラグの付いた行（新しい順）: [{"timestamp", "location", "values", "flags"}, ...]"""
+    params = [timeseries.epoch_text(start_epoch), timeseries.epoch_text(end_epoch)]
+    location_condition = ""
+    if location is not None:
+        location_condition = " AND d.location_id = ?"
+        params.append(locations.location_id(conn, location))
+    rows = conn.execute(f'''
+        SELECT d.timestamp, l.name, d.temperature, d.humidity, d.soil_moisture, d.quality
+        FROM {table_name} d LEFT JOIN locations l ON l.id = d.location_id
+        WHERE d.quality != 0 AND d.timestamp >= ? AND d.timestamp < ?{location_condition}
+        ORDER BY d.timestamp DESC LIMIT ?
+    ''', (*params, limit)).fetchall()
+    return [
+        {"timestamp": timestamp, "location": loc,
+         "values": dict(zip(METRICS, (temperature, humidity, soil_moisture))), "flags": describe(quality)}
+        for timestamp, loc, temperature, humidity, soil_moisture, quality in rows
+    ]
+
+
+def rescan_location(conn, location, table_name="sensor_data", batch_size=10000, start_epoch=None, end_epoch=None):
+    """1場所の行を時刻順に検査し直して quality を付け直す（コミットは呼び出し側）
+
+    start_epoch を指定すると、その直前の WARMUP 行で検出器の状態を作ってから検査を始め、
+    end_epoch より後で quality が保存済みの値と WARMUP 行続けて一致したら止める（状態はそれより
+    前の行に依存しなくなっている）。途中で止めた場合、anomaly_state（ロガーの状態）は変えない。
+    (検査した行のうちフラグの付いた行数, quality が変わった最初と最後の行のUNIX秒（変わらなければ None）)
+    を返す。
+    """
+    conn.execute(CREATE_STATE_SQL)
+    location_id = locations.location_id(conn, location)
+    detector = AnomalyDetector()
+    condition, params = "", [location_id]
+    if start_epoch is not None:
+        start_text = timeseries.epoch_text(start_epoch)
+        warmup = conn.execute(f'''
+            SELECT timestamp, temperature, humidity, soil_moisture FROM {table_name}
+            WHERE location_id = ? AND timestamp < ? ORDER BY timestamp DESC LIMIT ?
+        ''', (location_id, start_text, WARMUP)).fetchall()
+        for timestamp_str, temperature, humidity, soil_moisture in reversed(warmup):
+            detector.check(timeseries.timestamp_epoch(timestamp_str),
+                           {"temperature": temperature, "humidity": humidity, "soil_moisture": soil_moisture})
+        condition = " AND timestamp >= ?"
+        params.append(start_text)
+    cursor = conn.execute(f'''
+        SELECT rowid, timestamp, temperature, humidity, soil_moisture, quality FROM {table_name}
+        WHERE location_id = ?{condition} ORDER BY timestamp
+    ''', params)
+    flagged = 0
+    updates = []
+    first_changed = last_changed = None
+    unchanged = 0
+    converged = False
+    while not converged:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for rowid, timestamp_str, temperature, humidity, soil_moisture, old_quality in rows:
+            values = {"temperature": temperature, "humidity": humidity, "soil_moisture": soil_moisture}
+            epoch = timeseries.timestamp_epoch(timestamp_str)
+            quality = detector.check(epoch, values)
+            if quality:
+                flagged += 1
+            if quality != old_quality:
+                updates.append((quality, rowid))
+                if first_changed is None:
+                    first_changed = epoch
+                last_changed = epoch
+                unchanged = 0
+            elif end_epoch is not None and epoch > end_epoch:
+                unchanged += 1
+                if unchanged >= WARMUP:
+                    converged = True
+                    break
+    conn.executemany(f"UPDATE {table_name} SET quality = ? WHERE rowid = ?", updates)
+    if not converged:
+        save_detector(conn, location, detector)
+    return flagged, (first_changed, last_changed)
+
+
+def rescan(conn, table_name="sensor_data", batch_size=10000):
+    """既存の全行を場所ごとに時刻順に検査し直して quality を付け直す
+
+    (フラグの付いた行数, quality が変わった {場所名: (最初, 最後のUNIX秒)}) を返す。
+    派生データの作り直しと generation の更新は bulk_import.rescan が行う。
+    """
+    locations.ensure_schema(conn, table_name)
+    ensure_column(conn, table_name)
+    conn.execute(CREATE_STATE_SQL)
+    conn.execute("DELETE FROM anomaly_state")
+    flagged = 0
+    changed = {}
+    for location in locations.names(conn):
+        count, (first_changed, last_changed) = rescan_location(conn, location, table_name, batch_size)
+        flagged += count
+        if first_changed is not None:
+            changed[location] = (first_changed, last_changed)
+    conn.commit()
+    return flagged, changed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Flag anomalous and stuck sensor readings")
+    parser.add_argument("--db", default=os.getenv("SENSOR_DB_PATH", "sensor_data.db"))
+    parser.add_argument("--rescan", action="store_true", help="既存の全行を検査し直して quality を付け直す")
+    args = parser.parse_args(argv)
+    if args.rescan:
+        # bulk_import はこのモジュールを読み込むので、ここで読み込む
+        import bulk_import
+        conn = sqlite3.connect(args.db)
+        flagged, refreshed = bulk_import.rescan(conn)
+        total = conn.execute("SELECT COUNT(*) FROM sensor_data").fetchone()[0]
+        conn.close()
+        print(f"✅ {flagged} / {total} rows flagged")
+        if refreshed:
+            print(f"   派生データを作り直しました: {', '.join(refreshed)}")
+
+
+if __name__ == "__main__":
+    main()
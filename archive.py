@@ -0,0 +1,385 @@
+# -*- coding: utf-8 -*-
+"""
+Memory-mapped columnar archive for closed months
+
+ARCHIVE_AFTER_MONTHS か月より前の「閉じた」月を、場所ごとに固定幅の列ファイルへ書き出す:
+
+    archive/<YYYY-MM>/<location_id>/ts.npy             int64  UNIX秒（ローカル時刻をUTCとみなす）
+                                    temperature.npy    int16  compact.SCALE 倍した整数（欠損は MISSING）
+                                    humidity.npy       int16
+                                    soil_moisture.npy  int16
+                                    quality.npy        uint16 品質フラグ
+                                    blocks.npy         BLOCK_ROWS 行ごとの時刻の範囲と各メトリクスの最小・最大
+
+読み出しは np.load(mmap_mode="r") で、ファイルを読み込まずにページキャッシュを直接参照する。
+期間の切り出しはブロック索引で対象ブロックを絞ってから、その範囲だけを二分探索する（コピーしない）。
+値の条件での検索（search）は、最小・最大が条件に合わないブロックを読まずに飛ばす。
+
+書き出した月は archive_months テーブルに記録し、ダッシュボードはその月の範囲を
+sensor_data ではなくアーカイブから読む（cutoff() より前）。--prune を付けると書き出した月の行を
+sensor_data から削除する。ロールアップ等の派生テーブルはそのまま残るが、削除後に --rebuild すると
+削除した月は含まれない。
+
+    python archive.py                 # 閉じた月を書き出す
+    python archive.py --prune         # 書き出した月の行を sensor_data から削除する
+    python archive.py --search soil_moisture --below 20
+"""
+
+import argparse
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+import numpy as np
+
+import aggregation
+import anomalies
+import compact
+import locations
+import rollups
+import timeseries
+
+METRICS = ("temperature", "humidity", "soil_moisture")
+# 直近この月数は sensor_data に残す（アーカイブしない）
+ARCHIVE_AFTER_MONTHS = int(os.getenv("ARCHIVE_AFTER_MONTHS", "3"))
+ARCHIVE_DIR = os.getenv("SENSOR_ARCHIVE_DIR")
+BLOCK_ROWS = 1024
+
+MISSING = np.iinfo(np.int16).min
+COLUMN_TYPES = {"ts": np.int64, **{m: np.int16 for m in METRICS}, "quality": np.uint16}
+BLOCK_DTYPE = np.dtype([("start", np.int64), ("end", np.int64)]
+                       + [(f"{m}_{bound}", np.int16) for m in METRICS for bound in ("min", "max")])
+
+CREATE_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS archive_months (
+        month_start INTEGER PRIMARY KEY,
+        month_end INTEGER NOT NULL,
+        rows INTEGER NOT NULL,
+        bytes INTEGER NOT NULL,
+        pruned INTEGER NOT NULL DEFAULT 0,
+        created INTEGER NOT NULL
+    )
+'''
+
+
+def ensure_table(conn):
+    conn.execute(CREATE_TABLE_SQL)
+
+
+def archive_dir(conn):
+    """アーカイブの置き場所（SENSOR_ARCHIVE_DIR。未設定ならDBファイルと同じ場所の archive/）"""
+    if ARCHIVE_DIR:
+        return ARCHIVE_DIR
+    path = conn.execute("PRAGMA database_list").fetchone()[2]
+    return os.path.join(os.path.dirname(os.path.abspath(path)), "archive")
+
+
+def month_range(epoch):
+    """epoch を含む月の (開始, 終了) のUNIX秒"""
+    dt = timeseries.epoch_datetime(epoch)
+    start = datetime(dt.year, dt.month, 1)
+    end = datetime(dt.year + dt.month // 12, dt.month % 12 + 1, 1)
+    return rollups.naive_epoch(start), rollups.naive_epoch(end)
+
+
+def month_name(month_start):
+    return timeseries.epoch_datetime(month_start).strftime("%Y-%m")
+
+
+# --- 書き出し ---
+def _encode(values):
+    """小数の配列（欠損は NaN）を SCALE 倍の int16 にする"""
+    scaled = np.round(values * compact.SCALE)
+    scaled = np.clip(np.nan_to_num(scaled, nan=MISSING), MISSING + 1, np.iinfo(np.int16).max)
+    scaled[np.isnan(values)] = MISSING
+    return scaled.astype(np.int16)
+
+
+def _blocks(ts, columns):
+    """BLOCK_ROWS 行ごとの時刻の範囲と、各メトリクスの（欠損を除いた）最小・最大"""
+    starts = np.arange(0, ts.size, BLOCK_ROWS)
+    blocks = np.zeros(starts.size, dtype=BLOCK_DTYPE)
+    blocks["start"] = ts[starts]
+    blocks["end"] = ts[np.minimum(starts + BLOCK_ROWS, ts.size) - 1]
+    high = np.iinfo(np.int16).max
+    for m, column in zip(METRICS, columns):
+        missing = column == MISSING
+        # 値が1つも無いブロックは最小 > 最大になり、どの条件にも合わない
+        blocks[f"{m}_min"] = np.minimum.reduceat(np.where(missing, high, column), starts)
+        blocks[f"{m}_max"] = np.maximum.reduceat(np.where(missing, MISSING, column), starts)
+    return blocks
+
+
+def write_month(conn, month_start, month_end, table_name="sensor_data"):
+    """1か月分を場所ごとの列ファイルに書き出す。(行数, バイト数) を返す"""
+    registry = locations.registry(conn)
+    directory = os.path.join(archive_dir(conn), month_name(month_start))
+    staging = directory + ".tmp"
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    total_rows = total_bytes = 0
+    for name in registry.names():
+        location_id = registry.id_of(name)
+        rows = conn.execute(f'''
+            SELECT timestamp, {", ".join(METRICS)}, quality FROM {table_name}
+            WHERE location_id = ? AND timestamp >= ? AND timestamp < ?
+            ORDER BY timestamp
+        ''', (location_id, timeseries.epoch_text(month_start), timeseries.epoch_text(month_end))).fetchall()
+        if not rows:
+            continue
+        ts = np.floor(aggregation.epochs_from_text([row[0] for row in rows])).astype(np.int64)
+        values = aggregation.values_from_rows([row[:4] for row in rows])
+        columns = [_encode(values[i]) for i in range(len(METRICS))]
+        quality = np.array([row[4] or 0 for row in rows], dtype=np.uint16)
+        location_dir = os.path.join(staging, str(location_id))
+        os.makedirs(location_dir)
+        arrays = {"ts": ts, **dict(zip(METRICS, columns)), "quality": quality, "blocks": _blocks(ts, columns)}
+        for column, array in arrays.items():
+            path = os.path.join(location_dir, f"{column}.npy")
+            np.save(path, array)
+            total_bytes += os.path.getsize(path)
+        total_rows += len(rows)
+    # 書き終えてから置き換える（途中で止まっても読み出し側は古い内容か無しのどちらかを見る）
+    shutil.rmtree(directory, ignore_errors=True)
+    os.replace(staging, directory)
+    conn.execute('''
+        INSERT OR REPLACE INTO archive_months (month_start, month_end, rows, bytes, pruned, created)
+        VALUES (?, ?, ?, ?, 0, ?)
+    ''', (month_start, month_end, total_rows, total_bytes, int(time.time())))
+    return total_rows, total_bytes
+
+
+def closed_months(conn, now_epoch=None, table_name="sensor_data"):
+    """まだ書き出していない閉じた月の (開始, 終了)（古い順。最も古いデータの月から続けて並ぶ）"""
+    if now_epoch is None:
+        now_epoch = rollups.naive_epoch(datetime.now())
+    ensure_table(conn)
+    registry = locations.registry(conn)
+    firsts = [conn.execute(f"SELECT MIN(timestamp) FROM {table_name} WHERE location_id = ?",
+                           (registry.id_of(name),)).fetchone()[0] for name in registry.names()]
+    firsts = [timeseries.timestamp_epoch(text) for text in firsts if text]
+    archived_until = cutoff(conn)
+    if not firsts and archived_until is None:
+        return []
+    month_start = archived_until if archived_until is not None else month_range(min(firsts))[0]
+    limit = month_range(now_epoch)[0]
+    for _ in range(ARCHIVE_AFTER_MONTHS):
+        limit = month_range(limit - 1)[0]
+    months = []
+    while month_start < limit:
+        month_end = month_range(month_start)[1]
+        months.append((month_start, month_end))
+        month_start = month_end
+    return months
+
+
+def archive(conn, now_epoch=None, table_name="sensor_data"):
+    """閉じた月をすべて書き出す（コミットする）。[(月, 行数, バイト数), ...] を返す"""
+    rollups.ensure_index(conn, table_name)
+    anomalies.ensure_column(conn, table_name)
+    written = []
+    for month_start, month_end in closed_months(conn, now_epoch, table_name):
+        rows, size = write_month(conn, month_start, month_end, table_name)
+        conn.commit()
+        written.append((month_name(month_start), rows, size))
+    return written
+
+
+def prune(conn, table_name="sensor_data"):
+    """書き出した月の行を sensor_data から削除する（場所ごとに索引の範囲で削除）。削除した行数を返す"""
+    ensure_table(conn)
+    registry = locations.registry(conn)
+    deleted = 0
+    for month_start, month_end in conn.execute(
+            "SELECT month_start, month_end FROM archive_months WHERE pruned = 0 ORDER BY month_start").fetchall():
+        for name in registry.names():
+            deleted += conn.execute(
+                f"DELETE FROM {table_name} WHERE location_id = ? AND timestamp >= ? AND timestamp < ?",
+                (registry.id_of(name), timeseries.epoch_text(month_start), timeseries.epoch_text(month_end))).rowcount
+        conn.execute("UPDATE archive_months SET pruned = 1 WHERE month_start = ?", (month_start,))
+        conn.commit()
+    return deleted
+
+
+def pruned_months(conn):
+    """sensor_data から行を削除した月の [(開始, 終了), ...]"""
+    if not rollups.table_exists(conn, "archive_months"):
+        return []
+    return conn.execute("SELECT month_start, month_end FROM archive_months WHERE pruned = 1 ORDER BY month_start").fetchall()
+
+
+# --- 読み出し ---
+class MonthFiles:
+    """1か月・1場所分の列（mmap）"""
+
+    def __init__(self, directory):
+        self.columns = {column: np.load(os.path.join(directory, f"{column}.npy"), mmap_mode="r")
+                        for column in COLUMN_TYPES}
+        self.blocks = np.load(os.path.join(directory, "blocks.npy"), mmap_mode="r")
+
+    def bounds(self, start_epoch, end_epoch):
+        """[start_epoch, end_epoch) の行の範囲。ブロック索引で絞ってからそのブロックだけを二分探索する"""
+        blocks = self.blocks
+        first = int(np.searchsorted(blocks["end"], start_epoch, side="left"))
+        last = int(np.searchsorted(blocks["start"], end_epoch, side="left"))
+        if first >= last:
+            return 0, 0
+        ts = self.columns["ts"]
+        low, high = first * BLOCK_ROWS, min(last * BLOCK_ROWS, ts.size)
+        window = ts[low:high]
+        return (low + int(np.searchsorted(window, start_epoch, side="left")),
+                low + int(np.searchsorted(window, end_epoch, side="left")))
+
+
+class ArchiveReader:
+    """アーカイブの列ファイルを開いたまま保持する（archive_months が変わったら開き直す）"""
+
+    def __init__(self):
+        self._key = None
+        self._files = {}
+        self._lock = threading.Lock()
+
+    def months(self, conn):
+        """[(月の開始, 終了, ディレクトリ), ...]（古い順）"""
+        if not rollups.table_exists(conn, "archive_months"):
+            return []
+        rows = conn.execute(
+            "SELECT month_start, month_end, rows, created FROM archive_months ORDER BY month_start").fetchall()
+        directory = archive_dir(conn)
+        key = (directory, tuple(rows))
+        with self._lock:
+            if key != self._key:
+                self._files = {}
+                self._key = key
+        return [(start, end, os.path.join(directory, month_name(start))) for start, end, *_ in rows]
+
+    def files(self, directory, location_id):
+        path = os.path.join(directory, str(location_id))
+        with self._lock:
+            if path not in self._files:
+                self._files[path] = MonthFiles(path) if os.path.isdir(path) else None
+            return self._files[path]
+
+
+READER = ArchiveReader()
+
+
+def cutoff(conn):
+    """アーカイブから読む範囲の終わり（最後に書き出した月の終わり。無ければ None）"""
+    if not rollups.table_exists(conn, "archive_months"):
+        return None
+    return conn.execute("SELECT MAX(month_end) FROM archive_months").fetchone()[0]
+
+
+def _decode(column):
+    values = column.astype(float) / compact.SCALE
+    values[column == MISSING] = np.nan
+    return values
+
+
+def load(conn, location_ids, start_epoch, end_epoch):
+    """期間内の (UNIX秒, メトリクス × 行の値（欠損は NaN）, 品質フラグ)。複数の場所はまとめて時刻順にする"""
+    ts_parts, value_parts, quality_parts = [], [], []
+    for month_start, month_end, directory in READER.months(conn):
+        if month_end <= start_epoch or month_start >= end_epoch:
+            continue
+        for files in filter(None, (READER.files(directory, i) for i in location_ids)):
+            low, high = files.bounds(start_epoch, end_epoch)
+            if low == high:
+                continue
+            columns = files.columns
+            ts_parts.append(np.asarray(columns["ts"][low:high]))
+            value_parts.append(np.vstack([_decode(columns[m][low:high]) for m in METRICS]))
+            quality_parts.append(np.asarray(columns["quality"][low:high]))
+    if not ts_parts:
+        return np.empty(0, dtype=np.int64), np.empty((len(METRICS), 0)), np.empty(0, dtype=np.uint16)
+    ts, values, quality = np.concatenate(ts_parts), np.hstack(value_parts), np.concatenate(quality_parts)
+    if len(location_ids) > 1:
+        order = np.argsort(ts, kind="stable")
+        ts, values, quality = ts[order], values[:, order], quality[order]
+    return ts, values, quality
+
+
+def masked(values, quality, include_flagged=False):
+    """品質フラグの付いた値を NaN にする（anomalies.masked_columns と同じ扱い）"""
+    if include_flagged:
+        return values
+    values = values.copy()
+    for i, m in enumerate(METRICS):
+        values[i][(quality & anomalies.metric_mask(m)) != 0] = np.nan
+    return values
+
+
+def search(conn, location_id, metric, start_epoch, end_epoch, below=None, above=None):
+    """値が below 未満（または above 超）の行の (UNIX秒, 値) と、読まずに飛ばしたブロック数
+
+    各ブロックの最小・最大が条件に合わなければ、そのブロックの列は読まない。
+    """
+    low_limit = None if above is None else above * compact.SCALE
+    high_limit = None if below is None else below * compact.SCALE
+    ts_parts, value_parts = [], []
+    skipped = 0
+    for month_start, month_end, directory in READER.months(conn):
+        if month_end <= start_epoch or month_start >= end_epoch:
+            continue
+        files = READER.files(directory, location_id)
+        if files is None:
+            continue
+        blocks = files.blocks
+        candidate = (blocks["end"] >= start_epoch) & (blocks["start"] < end_epoch)
+        candidate &= blocks[f"{metric}_min"] <= blocks[f"{metric}_max"]
+        if high_limit is not None:
+            candidate &= blocks[f"{metric}_min"] < high_limit
+        if low_limit is not None:
+            candidate &= blocks[f"{metric}_max"] > low_limit
+        skipped += int((~candidate).sum())
+        for block in np.flatnonzero(candidate).tolist():
+            low, high = block * BLOCK_ROWS, min((block + 1) * BLOCK_ROWS, files.columns["ts"].size)
+            ts = files.columns["ts"][low:high]
+            column = files.columns[metric][low:high]
+            match = (column != MISSING) & (ts >= start_epoch) & (ts < end_epoch)
+            if high_limit is not None:
+                match &= column < high_limit
+            if low_limit is not None:
+                match &= column > low_limit
+            ts_parts.append(np.asarray(ts[match]))
+            value_parts.append(_decode(np.asarray(column[match])))
+    if not ts_parts:
+        return np.empty(0, dtype=np.int64), np.empty(0), skipped
+    return np.concatenate(ts_parts), np.concatenate(value_parts), skipped
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Archive closed months into memory-mapped column files")
+    parser.add_argument("--db", default=os.getenv("SENSOR_DB_PATH", "sensor_data.db"))
+    parser.add_argument("--prune", action="store_true", help="書き出した月の行を sensor_data から削除する")
+    parser.add_argument("--search", metavar="METRIC", choices=METRICS, help="アーカイブから値の条件で検索する")
+    parser.add_argument("--location", help="検索する場所（省略時は全場所）")
+    parser.add_argument("--below", type=float)
+    parser.add_argument("--above", type=float)
+    args = parser.parse_args(argv)
+    conn = sqlite3.connect(args.db)
+    try:
+        if args.search:
+            registry = locations.registry(conn)
+            names = [args.location] if args.location else registry.names()
+            for name in names:
+                ts, values, skipped = search(conn, registry.id_of(name), args.search, 0, 2 ** 62,
+                                             args.below, args.above)
+                print(f"{name}: {ts.size} rows ({skipped} blocks skipped)")
+                for epoch, value in list(zip(ts.tolist(), values.tolist()))[:20]:
+                    print(f"  {timeseries.epoch_text(epoch)} {value:g}")
+            return
+        for month, rows, size in archive(conn):
+            print(f"✅ {month}: {rows} rows, {size / 1e6:.2f} MB")
+        if args.prune:
+            print(f"🗑️ {prune(conn)} rows removed from sensor_data")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
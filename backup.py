@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+"""
+Hot backup and incremental snapshots of sensor_data.db
+
+ロガー（cron）やダッシュボードを止めずにバックアップを取る。ファイルを直接コピーすると
+コミット途中の状態を写すおそれがあるので、SQLite のオンラインバックアップAPIを使う:
+
+    完全バックアップ  Connection.backup() で BACKUP_PAGES ページずつ一時ファイルへ写し、
+                      quick_check で確かめてから gzip で圧縮する（full-YYYYmmdd-HHMMSS-<最大id>.db.gz）。
+                      読み取りロックは1ステップの間だけ持ち、ステップの間で手放す。
+                      途中で別の接続が書き込むと SQLite が最初からやり直すので、やり直すたびに
+                      帯域の上限を2倍にして、ロガーの書き込みの間隔内に写し終えるようにする
+    差分スナップショット  前回のスナップショットより id の大きい sensor_data の行だけを
+                      gzip した CSV に書き出す（incr-YYYYmmdd-HHMMSS-<最大id>.csv.gz）。
+                      列は id, timestamp, sensor_location, 各メトリクス, quality で、
+                      bulk_import.py でもそのまま取り込める
+
+読み出し・圧縮・書き込みは BACKUP_RATE_MB（MB/秒）を超えないよう間に待ちを入れるので、
+SDカードの帯域をダッシュボードと取り合わない。スナップショットの一覧は保存先の manifest.json に残す。
+
+差分は追加された行だけを含む。既存の行の変更（bulk_import.py による品質フラグの付け直し、
+archive.py --prune による削除）と派生テーブルは次の完全バックアップで反映される。
+復元は最新の完全バックアップを展開し、その後の差分を順に追加する（派生テーブルは各モジュールの --rebuild で作り直す）。
+
+    python backup.py                  # 完全バックアップが FULL_EVERY_DAYS 日以内なら差分、それ以外は完全
+    python backup.py --full
+    python backup.py --restore restored.db
+"""
+
+import argparse
+import csv
+import gzip
+import json
+import os
+import shutil
+import sqlite3
+import time
+from datetime import datetime
+
+import locations
+import rollups
+
+METRICS = ("temperature", "humidity", "soil_moisture")
+BACKUP_DIR = os.getenv("SENSOR_BACKUP_DIR")
+# 読み書きの上限（MB/秒。0 で制限しない）
+BACKUP_RATE_MB = float(os.getenv("BACKUP_RATE_MB", "4"))
+# 完全バックアップの間隔（日）と、残す完全バックアップの数（それより古い差分も消す）
+FULL_EVERY_DAYS = float(os.getenv("BACKUP_FULL_EVERY_DAYS", "7"))
+KEEP_FULL = int(os.getenv("BACKUP_KEEP_FULL", "2"))
+# オンラインバックアップの1ステップで写すページ数
+BACKUP_PAGES = 64
+# ロックを取れなかったときに待つ時間（秒）
+BUSY_PAUSE = 0.05
+# 差分スナップショットで1回に読む行数と、帯域の計算に使う1行あたりのバイト数（索引を含むおおよその値）
+CHUNK_ROWS = 5000
+ROW_BYTES = 80
+COPY_BYTES = 1 << 20
+MANIFEST = "manifest.json"
+COLUMNS = ("id", "timestamp", "sensor_location", *METRICS, "quality")
+
+
+def backup_dir(db_path):
+    """保存先（SENSOR_BACKUP_DIR。未設定ならDBファイルと同じ場所の backups/）"""
+    if BACKUP_DIR:
+        return BACKUP_DIR
+    return os.path.join(os.path.dirname(os.path.abspath(db_path)), "backups")
+
+
+# --- 帯域の制限 ---
+class Throttle:
+    """開始からの平均の転送量を rate バイト/秒以下に抑える"""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.started = time.monotonic()
+        self.bytes = 0
+        self.slept = 0.0
+
+    def consume(self, size):
+        self.bytes += size
+        if not self.rate:
+            return
+        ahead = self.bytes / self.rate - (time.monotonic() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+            self.slept += ahead
+
+    def relax(self):
+        """上限を2倍にする（ここまでの転送量は新しい上限で数え直す）"""
+        if self.rate:
+            self.rate *= 2
+            self.started = time.monotonic()
+            self.bytes = 0
+
+
+# --- スナップショットの一覧 ---
+def load_manifest(directory):
+    path = os.path.join(directory, MANIFEST)
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(directory, snapshots):
+    path = os.path.join(directory, MANIFEST)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(snapshots, f, indent=1)
+    os.replace(tmp_path, path)
+
+
+def latest_full(snapshots):
+    fulls = [s for s in snapshots if s["kind"] == "full"]
+    return fulls[-1] if fulls else None
+
+
+def _stamp():
+    return datetime.now().strftime("%Y%m%d-%H%M%S")
+
+
+def _gzip_file(source_path, target_path, throttle):
+    """COPY_BYTES ずつ読み、帯域を抑えながら圧縮する（一時ファイル経由で置き換える）"""
+    tmp_path = target_path + ".tmp"
+    with open(source_path, "rb") as src, gzip.open(tmp_path, "wb", compresslevel=6) as dst:
+        while True:
+            chunk = src.read(COPY_BYTES)
+            if not chunk:
+                break
+            dst.write(chunk)
+            throttle.consume(len(chunk))
+    os.replace(tmp_path, target_path)
+
+
+# --- 完全バックアップ ---
+def hot_copy(db_path, target_path, throttle, pages=BACKUP_PAGES):
+    """オンラインバックアップAPIで target_path に写す。(ステップ数, やり直した回数) を返す"""
+    source = sqlite3.connect(db_path)
+    target = sqlite3.connect(target_path)
+    page_size = source.execute("PRAGMA page_size").fetchone()[0]
+    state = {"steps": 0, "restarts": 0, "remaining": None}
+
+    def progress(status, remaining, total):
+        # 他の接続が書き込むと残りページ数が増える（SQLite が最初からやり直す）
+        if state["remaining"] is not None and remaining > state["remaining"]:
+            state["restarts"] += 1
+            throttle.relax()
+        state["remaining"] = remaining
+        state["steps"] += 1
+        # ロックを手放しているステップの間で待つ
+        throttle.consume(pages * page_size)
+
+    try:
+        source.backup(target, pages=pages, progress=progress, sleep=BUSY_PAUSE)
+    finally:
+        target.close()
+        source.close()
+    return state["steps"], state["restarts"]
+
+
+def full_backup(db_path, directory, throttle):
+    """完全バックアップを取り、manifest に追加した記録を返す"""
+    os.makedirs(directory, exist_ok=True)
+    started = time.time()
+    stamp = _stamp()
+    copy_path = os.path.join(directory, f".full-{stamp}.db.tmp")
+    try:
+        steps, restarts = hot_copy(db_path, copy_path, throttle)
+        conn = sqlite3.connect(copy_path)
+        try:
+            check = conn.execute("PRAGMA quick_check").fetchone()[0]
+            if check != "ok":
+                raise sqlite3.DatabaseError(f"backup copy failed quick_check: {check}")
+            last_id, rows = conn.execute("SELECT COALESCE(MAX(id), 0), COUNT(*) FROM sensor_data").fetchone()
+        finally:
+            conn.close()
+        db_bytes = os.path.getsize(copy_path)
+        name = f"full-{stamp}-{last_id}.db.gz"
+        _gzip_file(copy_path, os.path.join(directory, name), throttle)
+    finally:
+        if os.path.exists(copy_path):
+            os.remove(copy_path)
+    record = {
+        "kind": "full",
+        "file": name,
+        "created": int(started),
+        "last_id": last_id,
+        "rows": rows,
+        "db_bytes": db_bytes,
+        "bytes": os.path.getsize(os.path.join(directory, name)),
+        "seconds": round(time.time() - started, 2),
+        "steps": steps,
+        "restarts": restarts,
+    }
+    snapshots = load_manifest(directory)
+    snapshots.append(record)
+    save_manifest(directory, prune_snapshots(directory, snapshots))
+    return record
+
+
+def prune_snapshots(directory, snapshots, keep=KEEP_FULL):
+    """新しい方から keep 個より前の完全バックアップと、それに続く差分を消す。残す一覧を返す"""
+    fulls = [i for i, s in enumerate(snapshots) if s["kind"] == "full"]
+    if len(fulls) <= keep:
+        return snapshots
+    first_kept = fulls[-keep]
+    for snapshot in snapshots[:first_kept]:
+        path = os.path.join(directory, snapshot["file"])
+        if os.path.exists(path):
+            os.remove(path)
+    return snapshots[first_kept:]
+
+
+# --- 差分スナップショット ---
+def incremental_snapshot(db_path, directory, throttle, table_name="sensor_data"):
+    """前回のスナップショットより新しい行を書き出し、manifest に追加した記録を返す（新しい行が無ければ None）"""
+    snapshots = load_manifest(directory)
+    if latest_full(snapshots) is None:
+        raise ValueError("no full backup yet; run with --full first")
+    since_id = snapshots[-1]["last_id"]
+    started = time.time()
+    conn = sqlite3.connect(db_path)
+    tmp_path = None
+    try:
+        # 開始時点の最大 id までを写す（書き出し中に追加された行は次の差分に入る）
+        max_id = conn.execute(f"SELECT MAX(id) FROM {table_name}").fetchone()[0]
+        if max_id is None or max_id <= since_id:
+            return None
+        registry = locations.registry(conn)
+        stamp = _stamp()
+        tmp_path = os.path.join(directory, f".incr-{stamp}.csv.gz.tmp")
+        rows = 0
+        last_id = since_id
+        with gzip.open(tmp_path, "wt", newline="", compresslevel=6) as f:
+            writer = csv.writer(f)
+            writer.writerow(COLUMNS)
+            while last_id < max_id:
+                # 1回ごとに読み取りを終えてロックを手放す
+                chunk = conn.execute(f'''
+                    SELECT id, timestamp, location_id, {", ".join(METRICS)}, quality FROM {table_name}
+                    WHERE id > ? AND id <= ? ORDER BY id LIMIT ?
+                ''', (last_id, max_id, CHUNK_ROWS)).fetchall()
+                if not chunk:
+                    break
+                writer.writerows((row[0], row[1], registry.name_of(row[2]), *row[3:]) for row in chunk)
+                rows += len(chunk)
+                last_id = chunk[-1][0]
+                throttle.consume(len(chunk) * ROW_BYTES)
+        name = f"incr-{stamp}-{last_id}.csv.gz"
+        path = os.path.join(directory, name)
+        os.replace(tmp_path, path)
+    finally:
+        conn.close()
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    record = {
+        "kind": "incremental",
+        "file": name,
+        "created": int(started),
+        "since_id": since_id,
+        "last_id": last_id,
+        "rows": rows,
+        "bytes": os.path.getsize(path),
+        "seconds": round(time.time() - started, 2),
+    }
+    snapshots.append(record)
+    save_manifest(directory, snapshots)
+    return record
+
+
+def snapshot(db_path, directory, throttle, full=False, now=None):
+    """完全バックアップが FULL_EVERY_DAYS 日より古い（または無い）か full なら完全、それ以外は差分"""
+    now = time.time() if now is None else now
+    last = latest_full(load_manifest(directory))
+    if full or last is None or now - last["created"] >= FULL_EVERY_DAYS * 86400:
+        return full_backup(db_path, directory, throttle)
+    return incremental_snapshot(db_path, directory, throttle)
+
+
+# --- 復元 ---
+def _number(value):
+    return float(value) if value != "" else None
+
+
+def apply_incremental(conn, path, table_name="sensor_data"):
+    """差分スナップショットの行を id を保ったまま追加する（コミットは呼び出し側）。追加した行数を返す"""
+    added = 0
+    location_ids = {}
+    with gzip.open(path, "rt", newline="") as f:
+        reader = csv.DictReader(f)
+        batch = []
+        for row in reader:
+            name = row["sensor_location"]
+            if name not in location_ids:
+                location_ids[name] = locations.register(conn, name)
+            batch.append((int(row["id"]), row["timestamp"], *(_number(row[m]) for m in METRICS),
+                          location_ids[name], int(row["quality"] or 0)))
+            if len(batch) >= CHUNK_ROWS:
+                added += _insert(conn, batch, table_name)
+                batch = []
+        added += _insert(conn, batch, table_name)
+    return added
+
+
+def _insert(conn, batch, table_name):
+    if not batch:
+        return 0
+    before = conn.total_changes
+    conn.executemany(f'''
+        INSERT OR IGNORE INTO {table_name} (id, timestamp, {", ".join(METRICS)}, location_id, quality)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    ''', batch)
+    return conn.total_changes - before
+
+
+def restore(directory, output_path):
+    """最新の完全バックアップとその後の差分から output_path を作る。(完全バックアップ, 差分の数, 追加した行数)"""
+    if os.path.exists(output_path):
+        raise FileExistsError(output_path)
+    snapshots = load_manifest(directory)
+    last = latest_full(snapshots)
+    if last is None:
+        raise ValueError(f"no full backup in {directory}")
+    tmp_path = output_path + ".tmp"
+    with gzip.open(os.path.join(directory, last["file"]), "rb") as src, open(tmp_path, "wb") as dst:
+        shutil.copyfileobj(src, dst, COPY_BYTES)
+    conn = sqlite3.connect(tmp_path)
+    added = 0
+    try:
+        increments = snapshots[snapshots.index(last) + 1:]
+        for snapshot in increments:
+            added += apply_incremental(conn, os.path.join(directory, snapshot["file"]))
+        conn.commit()
+    finally:
+        conn.close()
+    os.replace(tmp_path, output_path)
+    return last["file"], len(increments), added
+
+
+def has_sensor_data(db_path):
+    # 存在しないパスに空のDBを作らないよう、読み取り専用で開く
+    if not os.path.exists(db_path):
+        return False
+    conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    try:
+        return rollups.table_exists(conn, "sensor_data")
+    finally:
+        conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Back up sensor_data.db without stopping ingest")
+    parser.add_argument("--db", default=os.getenv("SENSOR_DB_PATH", "sensor_data.db"))
+    parser.add_argument("--dir", help="保存先（省略時は SENSOR_BACKUP_DIR、無ければDBと同じ場所の backups/）")
+    parser.add_argument("--full", action="store_true", help="完全バックアップを取る")
+    parser.add_argument("--rate", type=float, default=BACKUP_RATE_MB, help="読み書きの上限（MB/秒。0 で制限しない）")
+    parser.add_argument("--list", action="store_true", help="スナップショットの一覧を表示")
+    parser.add_argument("--restore", metavar="OUTPUT", help="最新の完全バックアップと差分から復元する")
+    args = parser.parse_args(argv)
+    directory = args.dir or backup_dir(args.db)
+    if args.list:
+        for s in load_manifest(directory):
+            print(f"{s['file']}: {s['rows']:,} rows, {s['bytes'] / 1e6:.2f} MB, last_id={s['last_id']}")
+        return
+    if args.restore:
+        full, increments, added = restore(directory, args.restore)
+        print(f"✅ restored {full} + {increments} incremental snapshots ({added:,} rows) to {args.restore}")
+        return
+    if not has_sensor_data(args.db):
+        parser.error(f"{args.db} has no sensor_data table")
+    throttle = Throttle(args.rate * 1e6)
+    record = snapshot(args.db, directory, throttle, full=args.full)
+    if record is None:
+        print("✅ no new rows since the last snapshot")
+        return
+    extra = f", {record['restarts']} restarts" if record["kind"] == "full" else ""
+    print(f"✅ {record['kind']} {record['file']}: {record['rows']:,} rows, {record['bytes'] / 1e6:.2f} MB "
+          f"in {record['seconds']}s (throttled {throttle.slept:.1f}s{extra})")
+
+
+if __name__ == "__main__":
+    main()
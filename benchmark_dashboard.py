@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Dashboard Benchmark Suite
+
+index() / api_data() の処理時間を、実際のBottleルート経由で計測する。
+行数・場所数の異なるSQLite DBを生成し、(range, aggregate, location) の
+全組み合わせについて クエリ時間 / Python後処理時間 / テンプレート描画時間 /
+レスポンスサイズ を計測してJSONに保存する。
+
+--memory-check を指定すると、代わりに /api/data を長期間の生データで1回ずつ
+（ストリーミング / 通常）別プロセスで呼び出し、ピークRSSの増加量を計測する。
+ストリーミングモードの増加量が --rss-budget-mb を超えたら終了コード1。
+
+使い方:
+    python benchmark_dashboard.py --sizes 10k,100k --locations 1,10
+    python benchmark_dashboard.py --baseline bench_old.json --output bench_new.json
+    python benchmark_dashboard.py --memory-check 3M --rss-budget-mb 64
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import resource
+import sqlite3
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+from wsgiref.util import setup_testing_defaults
+
+import bottle
+import dashboard
+import locations
+import rollups
+
+RANGES = ["1h", "6h", "12h", "24h", "3d", "7d", "30d"]
+AGGREGATES = ["raw", "hourly", "daily"]
+ROUTES = {"index": "/", "api_data": "/api/data"}
+
+# 生成データの期間（30dレンジを満たすよう少し長めに取る）
+SEED_SPAN_DAYS = 35
+SEED_BATCH = 50000
+
+
+def parse_size(text):
+    """'10k', '1M' のような表記を整数に変換"""
+    text = text.strip()
+    units = {"k": 1000, "K": 1000, "m": 1000000, "M": 1000000}
+    if text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def location_names(count):
+    return [f"bench_{i:03d}" for i in range(1, count + 1)]
+
+
+# --- DB生成 ---
+def seed_database(path, row_count, location_count, seed=42):
+    """sensor_data テーブルを持つベンチマーク用DBを生成（既存なら再利用）"""
+    if os.path.exists(path):
+        conn = sqlite3.connect(path)
+        try:
+            existing = conn.execute("SELECT COUNT(*) FROM sensor_data").fetchone()[0]
+        except sqlite3.OperationalError:
+            existing = -1
+        conn.close()
+        if existing == row_count:
+            return False
+        os.remove(path)
+
+    rng = random.Random(seed)
+    names = location_names(location_count)
+
+    # ロガーと同じくローカル時刻で生成する（表示期間もローカル時刻基準）
+    end = datetime.now()
+    start = end - timedelta(days=SEED_SPAN_DAYS)
+    step = (end - start).total_seconds() / max(row_count, 1)
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=OFF")
+    conn.execute("PRAGMA synchronous=OFF")
+    locations.ensure_table(conn)
+    conn.executemany("INSERT INTO locations (id, name) VALUES (?, ?)",
+                     [(i + 1, name) for i, name in enumerate(names)])
+    conn.execute(f"CREATE TABLE sensor_data ({locations.SENSOR_DATA_COLUMNS})")
+
+    def rows():
+        for i in range(row_count):
+            ts = start + timedelta(seconds=i * step)
+            yield (
+                ts.strftime("%Y-%m-%d %H:%M:%S.%f"),
+                float(rng.randint(15, 32)),
+                float(rng.randint(30, 80)),
+                round(rng.uniform(10.0, 90.0), 1),
+                i % location_count + 1,
+            )
+
+    insert = "INSERT INTO sensor_data (timestamp, temperature, humidity, soil_moisture, location_id) VALUES (?, ?, ?, ?, ?)"
+    batch = []
+    for row in rows():
+        batch.append(row)
+        if len(batch) >= SEED_BATCH:
+            conn.executemany(insert, batch)
+            batch = []
+    if batch:
+        conn.executemany(insert, batch)
+    conn.commit()
+    # ロガーが読み取りごとに更新する索引とロールアップも用意しておく
+    rollups.ensure_built(conn)
+    conn.close()
+    return True
+
+
+# --- 計測 ---
+def use_database(db_path):
+    """dashboard モジュールの接続先をベンチマーク用DBに切り替える"""
+    dashboard.DB_PATH = db_path
+
+
+def parse_server_timing(value):
+    """Server-Timing ヘッダーを {phase: ミリ秒} に変換"""
+    timings = {}
+    for part in value.split(","):
+        fields = [f.strip() for f in part.split(";")]
+        name = fields[0]
+        for field in fields[1:]:
+            if field.startswith("dur="):
+                timings[name] = float(field[4:])
+    return timings
+
+
+def call_route(app, path, query):
+    """WSGIアプリとしてルートを呼び出し、(status, ヘッダー, 本文バイト数) を返す"""
+    environ = {"PATH_INFO": path, "QUERY_STRING": query, "REQUEST_METHOD": "GET"}
+    setup_testing_defaults(environ)
+    status_holder = {}
+
+    def start_response(status, headers, exc_info=None):
+        status_holder["status"] = status
+        status_holder["headers"] = dict(headers)
+
+    payload_bytes = 0
+    # ダッシュボードのデバッグ出力は計測結果に混ぜない
+    with contextlib.redirect_stdout(io.StringIO()):
+        body = app(environ, start_response)
+        try:
+            for chunk in body:
+                payload_bytes += len(chunk)
+        finally:
+            if hasattr(body, "close"):
+                body.close()
+    return status_holder.get("status", ""), status_holder.get("headers", {}), payload_bytes
+
+
+def run_case(app, route_name, range_param, aggregate_param, location, repeat):
+    query = f"range={range_param}&aggregate={aggregate_param}&location={location}"
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        status, headers, payload_bytes = call_route(app, ROUTES[route_name], query)
+        wall = time.perf_counter() - t0
+        # フェーズ別の内訳は TimingPlugin が付与する Server-Timing ヘッダーから取得
+        timings = parse_server_timing(headers.get("Server-Timing", ""))
+        samples.append({
+            "total_ms": wall * 1000,
+            "query_ms": timings.get("db", 0.0),
+            # format_timestamp ループや丸め等のPython後処理 + JSONシリアライズ
+            "postprocess_ms": timings.get("post", 0.0) + timings.get("json", 0.0),
+            "render_ms": timings.get("render", 0.0),
+            "payload_bytes": payload_bytes,
+            "status": status,
+        })
+    # 繰り返しの中央値（total基準）を代表値とする
+    samples.sort(key=lambda s: s["total_ms"])
+    result = dict(samples[len(samples) // 2])
+    result["min_total_ms"] = samples[0]["total_ms"]
+    result["max_total_ms"] = samples[-1]["total_ms"]
+    for key in ("total_ms", "query_ms", "render_ms", "postprocess_ms", "min_total_ms", "max_total_ms"):
+        result[key] = round(result[key], 3)
+    return result
+
+
+def case_key(case):
+    return "|".join(str(case[k]) for k in ("route", "rows", "locations", "range", "aggregate", "location"))
+
+
+def run_benchmarks(args):
+    sizes = [parse_size(s) for s in args.sizes.split(",")]
+    location_counts = [int(n) for n in args.locations.split(",")]
+    routes = args.routes.split(",")
+    os.makedirs(args.workdir, exist_ok=True)
+
+    app = bottle.default_app()
+    cases = []
+    # 予算超過した組み合わせは、それより大きいサイズではスキップする
+    over_budget = set()
+
+    for location_count in location_counts:
+        for rows in sizes:
+            db_path = os.path.join(args.workdir, f"bench_{rows}_{location_count}loc.db")
+            t0 = time.perf_counter()
+            created = seed_database(db_path, rows, location_count)
+            if created:
+                print(f"🌱 seeded {db_path} ({rows:,} rows) in {time.perf_counter() - t0:.1f}s")
+            use_database(db_path)
+
+            for route_name in routes:
+                for range_param in RANGES:
+                    for aggregate_param in AGGREGATES:
+                        for location in ("all", location_names(location_count)[0]):
+                            combo = (route_name, location_count, range_param, aggregate_param, location == "all")
+                            case = {
+                                "route": route_name,
+                                "rows": rows,
+                                "locations": location_count,
+                                "range": range_param,
+                                "aggregate": aggregate_param,
+                                "location": "all" if location == "all" else "single",
+                            }
+                            if combo in over_budget:
+                                case["skipped"] = True
+                                cases.append(case)
+                                continue
+                            case.update(run_case(app, route_name, range_param, aggregate_param, location, args.repeat))
+                            cases.append(case)
+                            if case["total_ms"] > args.budget_ms:
+                                over_budget.add(combo)
+                            print(f"{case_key(case):60s} total={case['total_ms']:>10.1f}ms "
+                                  f"query={case['query_ms']:>9.1f} post={case['postprocess_ms']:>9.1f} "
+                                  f"render={case['render_ms']:>9.1f} bytes={case['payload_bytes']:,}")
+
+    return {
+        "meta": {
+            "created_at": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sqlite": sqlite3.sqlite_version,
+            "repeat": args.repeat,
+            "budget_ms": args.budget_ms,
+        },
+        "cases": cases,
+    }
+
+
+# --- メモリ使用量の確認 ---
+MEMORY_QUERIES = {
+    "stream": "range=1y&location={location}&stream=1",
+    "buffered": "range=1y&location={location}",
+}
+
+
+def measure_memory_case(db_path, mode):
+    """（子プロセス内で）/api/data を1回呼び出し、RSSの増加量を返す"""
+    from instrumentation import rss_bytes
+    use_database(db_path)
+    app = bottle.default_app()
+    before = rss_bytes()
+    t0 = time.perf_counter()
+    status, _headers, payload_bytes = call_route(
+        app, ROUTES["api_data"], MEMORY_QUERIES[mode].format(location=location_names(1)[0]))
+    elapsed = time.perf_counter() - t0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return {
+        "mode": mode,
+        "status": status,
+        "payload_bytes": payload_bytes,
+        "total_ms": round(elapsed * 1000, 3),
+        "rss_before": before,
+        "rss_peak": peak,
+        "rss_growth": peak - before,
+    }
+
+
+def run_memory_check(args):
+    rows = parse_size(args.memory_check)
+    os.makedirs(args.workdir, exist_ok=True)
+    db_path = os.path.join(args.workdir, f"bench_{rows}_1loc.db")
+    t0 = time.perf_counter()
+    if seed_database(db_path, rows, 1):
+        print(f"🌱 seeded {db_path} ({rows:,} rows) in {time.perf_counter() - t0:.1f}s")
+
+    cases = []
+    for mode in args.memory_modes.split(","):
+        # ピークRSSはプロセス単位でしか取れないため、モードごとに別プロセスで計測する
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--memory-case", mode, "--memory-db", db_path],
+            check=True, capture_output=True, text=True).stdout
+        case = json.loads(output.strip().splitlines()[-1])
+        case["rows"] = rows
+        cases.append(case)
+        print(f"🧠 api_data {mode:9s} rows={rows:,} growth={case['rss_growth'] / 2**20:8.1f}MB "
+              f"peak={case['rss_peak'] / 2**20:8.1f}MB total={case['total_ms']:.0f}ms bytes={case['payload_bytes']:,}")
+
+    budget = args.rss_budget_mb * 2**20
+    over = [c for c in cases if c["mode"] == "stream" and c["rss_growth"] > budget]
+    return {"memory": cases, "rss_budget_mb": args.rss_budget_mb, "memory_ok": not over}
+
+
+def compare_results(baseline, current, threshold):
+    """ベースラインと比較し、閾値以上遅くなったケースを返す"""
+    base_cases = {case_key(c): c for c in baseline.get("cases", []) if not c.get("skipped")}
+    regressions = []
+    for case in current["cases"]:
+        if case.get("skipped"):
+            continue
+        base = base_cases.get(case_key(case))
+        if not base:
+            continue
+        ratio = case["total_ms"] / base["total_ms"] if base["total_ms"] > 0 else 1.0
+        if ratio > 1.0 + threshold:
+            regressions.append({
+                "case": case_key(case),
+                "baseline_ms": base["total_ms"],
+                "current_ms": case["total_ms"],
+                "ratio": round(ratio, 3),
+            })
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark dashboard query and render paths")
+    parser.add_argument("--sizes", default="10k,100k,1M,10M", help="行数（カンマ区切り, k/M表記可）")
+    parser.add_argument("--locations", default="1,10,50", help="場所数（カンマ区切り）")
+    parser.add_argument("--routes", default="index,api_data", help="計測するルート")
+    parser.add_argument("--repeat", type=int, default=3, help="各ケースの繰り返し回数")
+    parser.add_argument("--budget-ms", type=float, default=60000, help="これを超えた組み合わせは以降のサイズでスキップ")
+    parser.add_argument("--workdir", default="bench_data", help="生成DBの保存先")
+    parser.add_argument("--output", default="bench_results.json", help="結果JSONの出力先")
+    parser.add_argument("--baseline", help="比較対象の過去結果JSON")
+    parser.add_argument("--threshold", type=float, default=0.2, help="回帰とみなす悪化率（0.2 = 20%%）")
+    parser.add_argument("--memory-check", metavar="ROWS", help="指定行数のDBで /api/data のRSS増加量を確認する")
+    parser.add_argument("--memory-modes", default="stream,buffered", help="確認するモード（stream, buffered）")
+    parser.add_argument("--rss-budget-mb", type=float, default=64, help="ストリーミングモードで許容するRSS増加量")
+    parser.add_argument("--memory-case", help=argparse.SUPPRESS)
+    parser.add_argument("--memory-db", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.memory_case:
+        print(json.dumps(measure_memory_case(args.memory_db, args.memory_case)))
+        return 0
+
+    if args.memory_check:
+        results = run_memory_check(args)
+        with open(args.output, "w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"📄 Results written to {args.output}")
+        if not results["memory_ok"]:
+            print(f"⚠️ streaming api_data exceeded the {args.rss_budget_mb}MB RSS budget")
+            return 1
+        print(f"✅ streaming api_data stayed within {args.rss_budget_mb}MB")
+        return 0
+
+    results = run_benchmarks(args)
+
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_results(baseline, results, args.threshold)
+        results["regressions"] = regressions
+        if regressions:
+            exit_code = 1
+            print(f"⚠️ {len(regressions)} regressions (>{args.threshold:.0%} slower):")
+            for r in regressions:
+                print(f"   {r['case']}: {r['baseline_ms']}ms -> {r['current_ms']}ms (x{r['ratio']})")
+        else:
+            print("✅ No regressions against baseline")
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"📄 Results written to {args.output}")
+    return exit_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
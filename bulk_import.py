@@ -0,0 +1,452 @@
+# -*- coding: utf-8 -*-
+"""
+Bulk import of historical readings from CSV / JSONL files
+
+ロガーが止まっていた期間の補完や、別のシステムのログの取り込みに使う。
+入力の列（CSV はヘッダー行、JSONL は1行1オブジェクトのキー）:
+
+    timestamp                         'YYYY-MM-DD HH:MM:SS[.ffffff]'・ISO 8601（タイムゾーン付きはローカル時刻に変換）・UNIX秒
+    sensor_location（または location）  省略時は --location の場所
+    temperature / humidity / soil_moisture   空欄・null は欠損
+
+/api/export の CSV はそのまま取り込める（quality 列などの他の列は無視し、取り込み後に検査し直す）。
+
+取り込みは次の順に行う:
+1. 全ファイルを一時テーブル import_staging（主キー (location_id, 秒までの時刻)）に
+   BATCH_ROWS 行ずつ executemany で書き込む。同じ場所・同じ秒の行は重複とみなし、ファイル内では後の行を残す
+2. sensor_data に既に同じ場所・同じ秒の行があるものと、アーカイブ後に sensor_data から
+   削除した月（archive.py --prune）の行を除く
+3. 1つのトランザクションで sensor_data に追加する。既存の行数に対して多い場合は
+   索引を削除してから追加し、最後に作り直す（1行ごとの索引更新より速い）
+4. 追加した場所・期間の品質フラグ・ロールアップ・スケッチ・水やり検出・予測モデル・欠測区間・
+   sensor_compact・アーカイブを作り直す
+
+取り込みの記録は import_runs テーブルに残す。ダッシュボードは最後の記録の id（generation()）を
+タイルのキャッシュキーに含めるので、終了済みのタイルも取り込み後に読み直される。
+
+    python bulk_import.py old_logs.csv --location ohana_002
+    python bulk_import.py export.csv.gz backfill.jsonl
+"""
+
+import argparse
+import csv
+import gzip
+import io
+import json
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+from operator import itemgetter
+
+import anomalies
+import archive
+import compact
+import forecasting
+import gaps
+import locations
+import rollups
+import sketches
+import timeseries
+import watering
+
+METRICS = ("temperature", "humidity", "soil_moisture")
+# executemany 1回あたりの行数
+BATCH_ROWS = 50000
+# 追加する行数が既存の行数のこの割合を超えたら、索引を削除してから追加する
+DEFER_INDEX_RATIO = 0.25
+# 表示する不正な行の数
+MAX_ERRORS = 10
+
+CREATE_STAGING_SQL = '''
+    CREATE TEMP TABLE IF NOT EXISTS import_staging (
+        location_id INTEGER NOT NULL,
+        second TEXT NOT NULL,
+        timestamp TEXT NOT NULL,
+        temperature REAL,
+        humidity REAL,
+        soil_moisture REAL,
+        PRIMARY KEY (location_id, second)
+    ) WITHOUT ROWID
+'''
+
+CREATE_RUNS_SQL = '''
+    CREATE TABLE IF NOT EXISTS import_runs (
+        id INTEGER PRIMARY KEY,
+        source TEXT NOT NULL,
+        started INTEGER NOT NULL,
+        seconds REAL NOT NULL,
+        rows_read INTEGER NOT NULL,
+        inserted INTEGER NOT NULL,
+        duplicates INTEGER NOT NULL,
+        skipped INTEGER NOT NULL,
+        first_timestamp TEXT,
+        last_timestamp TEXT
+    )
+'''
+
+
+def generation(conn):
+    """最後の取り込みの id（取り込んだことが無ければ 0）"""
+    if not rollups.table_exists(conn, "import_runs"):
+        return 0
+    return conn.execute("SELECT COALESCE(MAX(id), 0) FROM import_runs").fetchone()[0]
+
+
+# --- 読み込み ---
+def parse_timestamp(value):
+    """sensor_data の時刻文字列（'YYYY-MM-DD HH:MM:SS.ffffff'、ロガーと同じ形式）に変換"""
+    if isinstance(value, str) and not value.replace(".", "", 1).isdigit():
+        dt = datetime.fromisoformat(value)
+        if dt.tzinfo is None:
+            # よくある形はそのまま使う（isoformat() は fromisoformat() の数倍遅い）
+            if len(value) == 26:
+                return value if value[10] == " " else f"{value[:10]} {value[11:]}"
+            if len(value) == 19:
+                return f"{value[:10]} {value[11:]}.000000"
+        else:
+            dt = dt.astimezone().replace(tzinfo=None)
+    else:
+        dt = datetime.fromtimestamp(float(value))
+    return dt.isoformat(sep=" ", timespec="microseconds")
+
+
+def open_source(path):
+    """テキストとして開く（.gz は展開し、- は標準入力）"""
+    if path == "-":
+        return io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8-sig", newline="")
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8-sig", newline="")
+    return open(path, encoding="utf-8-sig", newline="")
+
+
+def source_format(path):
+    name = path[:-3] if path.endswith(".gz") else path
+    return "jsonl" if name.endswith((".jsonl", ".ndjson")) else "csv"
+
+
+def read_csv(stream):
+    """(行番号, 場所, 時刻, 温度, 湿度, 土壌湿度) を順に返す（1行目はヘッダー。無い列は空欄）
+
+    空行は読み飛ばし、ヘッダーより短い行は足りない列を空欄として読む。
+    """
+    reader = csv.reader(stream)
+    header = [name.strip() for name in next(reader, [])]
+    if "timestamp" not in header:
+        raise ValueError(f"{stream.name}: no timestamp column in the header")
+    location = "sensor_location" if "sensor_location" in header else "location"
+    # 無い列は行末に足した空欄（添字 -1）を読む
+    positions = [header.index(name) if name in header else -1 for name in (location, "timestamp", *METRICS)]
+    width = len(header) + 1
+    fields = itemgetter(*positions)
+    for line_number, row in enumerate(reader, 2):
+        if not row:
+            continue
+        # 行末には必ず空欄を1つ以上足す（無い列の添字 -1 が空欄を読むように）
+        row.extend([""] * max(1, width - len(row)))
+        yield (line_number, *fields(row))
+
+
+def read_jsonl(stream):
+    for line_number, line in enumerate(stream, 1):
+        if line.strip():
+            record = json.loads(line)
+            yield (line_number, record.get("sensor_location") or record.get("location"), record["timestamp"],
+                   *(record.get(m) for m in METRICS))
+
+
+class Stager:
+    """入力の行を import_staging に書き込む（場所は初めて出てきたときに登録する）"""
+
+    def __init__(self, conn, default_location=None, batch_rows=BATCH_ROWS):
+        self.conn = conn
+        self.default_location = default_location
+        self.batch_rows = batch_rows
+        self.location_ids = {}
+        self.rows_read = 0
+        self.invalid = 0
+        self.errors = []
+        self._batch = []
+
+    def add_file(self, path, fmt=None):
+        location_ids, batch = self.location_ids, self._batch
+        with open_source(path) as stream:
+            reader = read_jsonl if (fmt or source_format(path)) == "jsonl" else read_csv
+            for line_number, name, timestamp, temperature, humidity, soil_moisture in reader(stream):
+                self.rows_read += 1
+                try:
+                    location_id = location_ids.get(name) or self._location_id(name)
+                    timestamp = parse_timestamp(timestamp)
+                    batch.append((
+                        location_id, timestamp[:19], timestamp,
+                        None if temperature is None or temperature == "" else float(temperature),
+                        None if humidity is None or humidity == "" else float(humidity),
+                        None if soil_moisture is None or soil_moisture == "" else float(soil_moisture)))
+                except (IndexError, KeyError, TypeError, ValueError) as e:
+                    self.invalid += 1
+                    if len(self.errors) < MAX_ERRORS:
+                        self.errors.append(f"{path}:{line_number}: {e!r}")
+                    continue
+                if len(batch) >= self.batch_rows:
+                    self.flush()
+        self.flush()
+
+    def _location_id(self, name):
+        """場所名（空なら --location の場所）を登録して location_id を返す"""
+        location = name or self.default_location
+        if not location:
+            raise ValueError("no location (add a sensor_location column or use --location)")
+        location_id = self.location_ids[name] = locations.register(self.conn, location)
+        return location_id
+
+    def flush(self):
+        self.conn.executemany(
+            f"INSERT OR REPLACE INTO import_staging (location_id, second, timestamp, {', '.join(METRICS)}) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            self._batch)
+        self._batch.clear()
+
+
+# --- 書き込み ---
+def drop_duplicates(conn, table_name):
+    """sensor_data に同じ場所・同じ秒の行がある行を import_staging から除く。除いた行数を返す
+
+    保存されている時刻は小数秒の有無が行によって違うので、秒の範囲で索引を引く。
+    """
+    return conn.execute(f'''
+        DELETE FROM import_staging WHERE EXISTS (
+            SELECT 1 FROM {table_name} d
+            WHERE d.location_id = import_staging.location_id
+              AND d.timestamp >= import_staging.second AND d.timestamp < import_staging.second || '.9999999')
+    ''').rowcount
+
+
+def drop_pruned(conn):
+    """アーカイブ後に sensor_data から削除した月の行を除く（その月の列ファイルは書き直さない）"""
+    skipped = 0
+    for month_start, month_end in archive.pruned_months(conn):
+        skipped += conn.execute("DELETE FROM import_staging WHERE second >= ? AND second < ?",
+                                (timeseries.epoch_text(month_start), timeseries.epoch_text(month_end))).rowcount
+    return skipped
+
+
+def insert_staged(conn, table_name, defer_indexes):
+    """import_staging の行を sensor_data に追加する（1トランザクション）。追加した行数を返す"""
+    indexes = conn.execute(
+        "SELECT name, sql FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+        (table_name,)).fetchall() if defer_indexes else []
+    conn.commit()
+    conn.execute("BEGIN")
+    try:
+        for index_name, _ in indexes:
+            conn.execute(f"DROP INDEX {index_name}")
+        # 主キー順（場所・時刻順）に追加すると、残した索引への追加も末尾への追記に近くなる
+        inserted = conn.execute(f'''
+            INSERT INTO {table_name} (timestamp, {", ".join(METRICS)}, location_id, quality)
+            SELECT timestamp, {", ".join(METRICS)}, location_id, 0 FROM import_staging
+        ''').rowcount
+        for _, sql in indexes:
+            conn.execute(sql)
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    return inserted
+
+
+# --- 派生データ ---
+def refresh_derived(conn, ranges, appended, table_name="sensor_data", rescan=True):
+    """取り込んだ場所・期間の派生データを作り直す。作り直した {場所名: (最初, 最後のUNIX秒)} を返す
+
+    ranges は {場所名: (最初のUNIX秒, 最後のUNIX秒)}、appended はその場所の既存の行より
+    新しい行だけを追加した場所名。rescan=False なら品質フラグは検査し直さない（検査済みの場合）。
+    まだ作られていない派生テーブルは、ダッシュボードの初回表示（ensure_built）で全体から
+    作られるので触らない。
+    """
+    has_rollups = rollups.table_exists(conn, "sensor_rollups")
+    has_sketches = rollups.table_exists(conn, "sensor_sketches")
+    has_compact = rollups.table_exists(conn, "sensor_compact")
+    sequential = [module for module, table in (
+        (watering, "watering_scan"), (forecasting, "forecast_models"), (gaps, "gap_scan"))
+        if rollups.table_exists(conn, table)]
+    refreshed = {}
+    for name, (start_epoch, end_epoch) in sorted(ranges.items()):
+        if rescan:
+            # 検査は直前の読み取りを見るので、追加した行より後の行のフラグも変わることがある。
+            # 追加した期間の少し前から、保存済みのフラグと一致するまでを検査し直す
+            _, (first_changed, last_changed) = anomalies.rescan_location(
+                conn, name, table_name, start_epoch=start_epoch, end_epoch=end_epoch)
+            if first_changed is not None:
+                start_epoch, end_epoch = min(start_epoch, first_changed), max(end_epoch, last_changed)
+        refreshed[name] = (start_epoch, end_epoch)
+        if has_compact:
+            compact.update_range(conn, locations.location_id(conn, name), start_epoch, end_epoch + 1, table_name)
+        conn.commit()
+        if has_rollups:
+            rollups.rebuild(conn, table_name, name, start_epoch, end_epoch + 1)
+        if has_sketches:
+            sketches.rebuild(conn, table_name, location=name, start_epoch=start_epoch, end_epoch=end_epoch + 1)
+        for module in sequential:
+            # 末尾への追加なら前回の走査位置から続けられる。途中に挟まる行があれば作り直す
+            if name in appended:
+                module.update(conn, table_name, name)
+                conn.commit()
+            else:
+                module.rebuild(conn, table_name, name)
+    if has_compact:
+        compact.update(conn, table_name)
+        conn.commit()
+    return refreshed
+
+
+def rearchive(conn, ranges, table_name="sensor_data"):
+    """アーカイブから読む範囲（cutoff より前）の月に行を追加・変更した場合、その月の列ファイルを
+    書き直す（まだ書き出していない月なら新しく書き出す）。書き直した月の開始のUNIX秒を返す"""
+    cutoff = archive.cutoff(conn)
+    if cutoff is None:
+        return []
+    pruned = {month_start for month_start, _ in archive.pruned_months(conn)}
+    months = set()
+    for start_epoch, end_epoch in ranges.values():
+        month_start = archive.month_range(start_epoch)[0]
+        while month_start <= end_epoch and month_start < cutoff:
+            months.add(month_start)
+            month_start = archive.month_range(month_start)[1]
+    months = sorted(months - pruned)
+    for month_start in months:
+        archive.write_month(conn, month_start, archive.month_range(month_start)[1], table_name)
+        conn.commit()
+    return months
+
+
+# --- 取り込み ---
+def import_files(conn, paths, default_location=None, table_name="sensor_data", fmt=None,
+                 defer_indexes=None, rebuild=True):
+    """ファイルを sensor_data に取り込む。結果の辞書を返す
+
+    defer_indexes は None（行数で決める）・True・False。rebuild=False なら派生データは作り直さない
+    （複数回に分けて取り込み、最後にまとめて各モジュールの --rebuild を実行する場合）。
+    """
+    started = time.time()
+    # 新しいDBへの取り込みではテーブルから作る（models.SensorData と同じ列）
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ({locations.SENSOR_DATA_COLUMNS})")
+    rollups.ensure_index(conn, table_name)
+    anomalies.ensure_column(conn, table_name)
+    conn.execute(CREATE_RUNS_SQL)
+    conn.execute(CREATE_STAGING_SQL)
+    conn.execute("DELETE FROM import_staging")
+    conn.commit()
+
+    stager = Stager(conn, default_location)
+    for path in paths:
+        stager.add_file(path, fmt)
+    staged = conn.execute("SELECT COUNT(*) FROM import_staging").fetchone()[0]
+    duplicates = stager.rows_read - stager.invalid - staged + drop_duplicates(conn, table_name)
+    skipped = drop_pruned(conn)
+    conn.commit()
+
+    registry = locations.registry(conn)
+    ranges, appended = {}, set()
+    for location_id, first, last in conn.execute(
+            "SELECT location_id, MIN(timestamp), MAX(timestamp) FROM import_staging GROUP BY location_id").fetchall():
+        name = registry.name_of(location_id)
+        ranges[name] = (timeseries.timestamp_epoch(first), timeseries.timestamp_epoch(last))
+        latest = conn.execute(f"SELECT MAX(timestamp) FROM {table_name} WHERE location_id = ?",
+                              (location_id,)).fetchone()[0]
+        if latest is None or first > latest:
+            appended.add(name)
+
+    existing = conn.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
+    remaining = conn.execute("SELECT COUNT(*) FROM import_staging").fetchone()[0]
+    if defer_indexes is None:
+        defer_indexes = remaining > existing * DEFER_INDEX_RATIO
+    inserted = insert_staged(conn, table_name, defer_indexes) if remaining else 0
+    first_timestamp, last_timestamp = conn.execute(
+        "SELECT MIN(timestamp), MAX(timestamp) FROM import_staging").fetchone()
+    conn.execute("DELETE FROM import_staging")
+    conn.commit()
+    imported = time.time() - started
+
+    months = []
+    if inserted and rebuild:
+        months = rearchive(conn, refresh_derived(conn, ranges, appended, table_name), table_name)
+    result = {
+        "rows_read": stager.rows_read,
+        "inserted": inserted,
+        "duplicates": duplicates,
+        "invalid": stager.invalid,
+        "skipped_pruned": skipped,
+        "locations": sorted(ranges),
+        "deferred_indexes": bool(inserted and defer_indexes),
+        "rearchived_months": [archive.month_name(month) for month in months],
+        "import_seconds": round(imported, 2),
+        "total_seconds": round(time.time() - started, 2),
+        "errors": stager.errors,
+    }
+    if inserted:
+        record_run(conn, ", ".join(paths), started, result["total_seconds"], stager.rows_read, inserted,
+                   duplicates, stager.invalid + skipped, first_timestamp, last_timestamp)
+    return result
+
+
+def record_run(conn, source, started, seconds, rows_read, inserted, duplicates, skipped,
+               first_timestamp, last_timestamp):
+    """import_runs に1回分を記録してコミットする（generation() が進む）"""
+    conn.execute(CREATE_RUNS_SQL)
+    conn.execute('''
+        INSERT INTO import_runs (source, started, seconds, rows_read, inserted, duplicates, skipped,
+                                 first_timestamp, last_timestamp)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''', (source, int(started), seconds, rows_read, inserted, duplicates, skipped, first_timestamp, last_timestamp))
+    conn.commit()
+
+
+def rescan(conn, table_name="sensor_data"):
+    """既存の全行の品質フラグを検査し直し（anomalies.py --rescan）、フラグが変わった場所・期間の
+    派生データとアーカイブを作り直す。(フラグの付いた行数, 作り直した場所名) を返す
+
+    行を追加しなくても終了済みのタイルの内容は変わるので、フラグが変わった場合は import_runs に
+    記録して generation() を進める。
+    """
+    started = time.time()
+    flagged, changed = anomalies.rescan(conn, table_name)
+    if changed:
+        rearchive(conn, refresh_derived(conn, changed, set(), table_name, rescan=False), table_name)
+        total = conn.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
+        record_run(conn, "anomalies.py --rescan", started, round(time.time() - started, 2), total, 0, 0, 0,
+                   timeseries.epoch_text(min(first for first, _ in changed.values())),
+                   timeseries.epoch_text(max(last for _, last in changed.values())))
+    return flagged, sorted(changed)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Bulk-import historical readings from CSV / JSONL files")
+    parser.add_argument("paths", nargs="+", help="CSV / JSONL ファイル（.gz も可。- は標準入力）")
+    parser.add_argument("--db", default=os.getenv("SENSOR_DB_PATH", "sensor_data.db"))
+    parser.add_argument("--location", help="場所の列が無い行の場所")
+    parser.add_argument("--format", choices=("csv", "jsonl"), help="入力形式（省略時は拡張子で判断）")
+    parser.add_argument("--defer-indexes", choices=("auto", "always", "never"), default="auto",
+                        help="追加の間 sensor_data の索引を削除するか（auto は行数で判断）")
+    parser.add_argument("--no-rebuild", action="store_true", help="派生データを作り直さない")
+    args = parser.parse_args(argv)
+
+    conn = sqlite3.connect(args.db)
+    # 索引の作り直しと重複の確認に使うページキャッシュ（64MB）
+    conn.execute("PRAGMA cache_size = -65536")
+    try:
+        result = import_files(conn, args.paths, args.location, fmt=args.format,
+                              defer_indexes={"auto": None, "always": True, "never": False}[args.defer_indexes],
+                              rebuild=not args.no_rebuild)
+    finally:
+        conn.close()
+    for error in result.pop("errors"):
+        print(f"⚠️ {error}")
+    rate = result["rows_read"] / result["import_seconds"] * 60 if result["import_seconds"] else 0
+    print(f"✅ {result['inserted']:,} rows inserted ({rate:,.0f} rows/min)")
+    for key, value in result.items():
+        print(f"   {key}: {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+"""
+Compact storage encoding for readings (sensor_compact)
+
+sensor_data の1行は id・マイクロ秒付きの時刻文字列（26バイト）・REAL 3列を持ち、
+(location_id, timestamp) 索引が時刻文字列をもう一度持つ。DHT11 の値は整数の °C / %RH、
+土壌湿度は 0.1 単位なので、次の形式で十分に表せる:
+
+    location_id  INTEGER  locations.id
+    ts           INTEGER  UNIX秒（ローカル時刻をUTCとみなす。rollups.naive_epoch と同じ）
+    temperature / humidity / soil_moisture
+                 INTEGER  SCALE 倍して丸めた整数（欠損は NULL）
+    quality      INTEGER  anomalies の品質フラグ
+
+SQLite の整数は値に応じて1〜8バイトで保存されるので、各メトリクスは2バイトで済む。
+WITHOUT ROWID で主キー (location_id, ts) の順に行を並べるため、場所・期間指定の読み出しは
+別の索引を経由せずテーブル本体の範囲走査になる。同じ場所・同じ秒の行は後の行を残す。
+
+変換は sensor_data の id 順に、前回変換した id より新しい行だけを読む。別ファイルに書き出して
+元の形式とファイルサイズ・1行あたりのバイト数・走査速度を比べる:
+    python compact.py --output sensor_compact.db --report
+"""
+
+import argparse
+import os
+import sqlite3
+import time
+
+import numpy as np
+
+import aggregation
+import locations
+import rollups
+import timeseries
+
+METRICS = ("temperature", "humidity", "soil_moisture")
+# 保存時に掛ける倍率（0.1 単位まで保持する）
+SCALE = 10
+
+CREATE_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS sensor_compact (
+        location_id INTEGER NOT NULL,
+        ts INTEGER NOT NULL,
+        temperature INTEGER,
+        humidity INTEGER,
+        soil_moisture INTEGER,
+        quality INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (location_id, ts)
+    ) WITHOUT ROWID
+'''
+
+# 変換済みの sensor_data の最大 id
+CREATE_SCAN_SQL = '''
+    CREATE TABLE IF NOT EXISTS compact_scan (
+        source TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL
+    ) WITHOUT ROWID
+'''
+
+
+def ensure_tables(conn):
+    locations.ensure_table(conn)
+    conn.execute(CREATE_TABLE_SQL)
+    conn.execute(CREATE_SCAN_SQL)
+
+
+def encode(value):
+    return None if value is None else int(round(value * SCALE))
+
+
+def decode(value):
+    return None if value is None else value / SCALE
+
+
+def update(conn, table_name="sensor_data", source="main"):
+    """前回の変換より新しい sensor_data の行を sensor_compact に追加する（コミットは呼び出し側）
+
+    source は sensor_data のあるスキーマ（別ファイルに書き出す場合は ATTACH した名前）。
+    変換した行数を返す。
+    """
+    ensure_tables(conn)
+    if source != "main":
+        conn.execute(f"INSERT OR REPLACE INTO locations SELECT * FROM {source}.locations")
+    row = conn.execute("SELECT last_id FROM compact_scan WHERE source = ?", (table_name,)).fetchone()
+    last_id = row[0] if row else 0
+    max_id = conn.execute(f"SELECT MAX(id) FROM {source}.{table_name}").fetchone()[0]
+    if max_id is None or max_id <= last_id:
+        return 0
+    converted = _convert(conn, f"{source}.{table_name}", "id > ? AND id <= ?", (last_id, max_id))
+    conn.execute("INSERT OR REPLACE INTO compact_scan (source, last_id) VALUES (?, ?)", (table_name, max_id))
+    return converted
+
+
+def update_range(conn, location_id, start_epoch, end_epoch, table_name="sensor_data"):
+    """期間内の行を変換し直す（既存の行の品質フラグを付け直した後など。コミットは呼び出し側）"""
+    ensure_tables(conn)
+    return _convert(conn, table_name, "location_id = ? AND timestamp >= ? AND timestamp < ?",
+                    (location_id, timeseries.epoch_text(start_epoch), timeseries.epoch_text(end_epoch)))
+
+
+def _convert(conn, table, condition, params):
+    scaled = ", ".join(f"CAST(ROUND({m} * {SCALE}) AS INTEGER)" for m in METRICS)
+    # id 順に書き込み、同じ場所・同じ秒の行は後の行で置き換える
+    return conn.execute(f'''
+        INSERT OR REPLACE INTO sensor_compact (location_id, ts, {", ".join(METRICS)}, quality)
+        SELECT location_id, CAST(strftime('%s', timestamp) AS INTEGER), {scaled}, quality
+        FROM {table}
+        WHERE {condition} AND location_id IS NOT NULL AND timestamp IS NOT NULL
+        ORDER BY id
+    ''', params).rowcount
+
+
+def rebuild(conn, table_name="sensor_data", source="main"):
+    ensure_tables(conn)
+    conn.execute("DELETE FROM sensor_compact")
+    conn.execute("DELETE FROM compact_scan")
+    converted = update(conn, table_name, source)
+    conn.commit()
+    return converted
+
+
+# --- 読み出し ---
+def load_columns(conn, location_id, start_epoch, end_epoch):
+    """期間内の (UNIX秒, 温度, 湿度, 土壌湿度) の NumPy 配列。欠損は NaN"""
+    rows = conn.execute(f'''
+        SELECT ts, {", ".join(METRICS)} FROM sensor_compact
+        WHERE location_id = ? AND ts >= ? AND ts < ?
+    ''', (location_id, start_epoch, end_epoch)).fetchall()
+    if not rows:
+        return np.empty(0, dtype=np.int64), *(np.empty(0) for _ in METRICS)
+    data = np.array(rows, dtype=float)
+    return (data[:, 0].astype(np.int64), *(data[:, i + 1] / SCALE for i in range(len(METRICS))))
+
+
+# --- 比較 ---
+def table_bytes(conn, names):
+    """テーブルと索引のページの合計バイト数（dbstat が使えない場合は None）"""
+    placeholders = ", ".join("?" for _ in names)
+    try:
+        return conn.execute(f"SELECT SUM(pgsize) FROM dbstat WHERE name IN ({placeholders})", names).fetchone()[0]
+    except sqlite3.OperationalError:
+        return None
+
+
+def _best_time(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def report(source_conn, compact_conn, table_name="sensor_data", repeat=3):
+    """元の形式と sensor_compact の行数・サイズ・全場所の全期間を NumPy の列に読むまでの時間"""
+    registry = locations.registry(source_conn)
+    ids = [registry.id_of(name) for name in registry.names()]
+    source_indexes = [row[0] for row in source_conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ?", (table_name,))]
+
+    def scan_source():
+        for location_id in ids:
+            rows = source_conn.execute(f'''
+                SELECT timestamp, {", ".join(METRICS)} FROM {table_name}
+                WHERE location_id = ? ORDER BY timestamp
+            ''', (location_id,)).fetchall()
+            if rows:
+                aggregation.epochs_from_text([row[0] for row in rows])
+                aggregation.values_from_rows(rows)
+
+    def scan_compact():
+        for location_id in ids:
+            load_columns(compact_conn, location_id, 0, 2 ** 62)
+
+    rows = source_conn.execute(f"SELECT COUNT(*) FROM {table_name}").fetchone()[0]
+    compact_rows = compact_conn.execute("SELECT COUNT(*) FROM sensor_compact").fetchone()[0]
+    result = {}
+    for label, conn, count, names, scan in (
+            ("sensor_data", source_conn, rows, [table_name, *source_indexes], scan_source),
+            ("sensor_compact", compact_conn, compact_rows, ["sensor_compact"], scan_compact)):
+        size = table_bytes(conn, names)
+        seconds = _best_time(scan, repeat)
+        result[label] = {
+            "rows": count,
+            "file_bytes": os.path.getsize(conn.execute("PRAGMA database_list").fetchone()[2]),
+            "table_bytes": size,
+            "bytes_per_row": round(size / count, 1) if size and count else None,
+            "scan_seconds": round(seconds, 4),
+            "rows_per_second": int(count / seconds) if seconds else None,
+        }
+    return result
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert sensor_data into the compact storage encoding")
+    parser.add_argument("--db", default=os.getenv("SENSOR_DB_PATH", "sensor_data.db"))
+    parser.add_argument("--output", help="書き出し先のDBファイル（省略時は --db と同じファイルに sensor_compact を作る）")
+    parser.add_argument("--rebuild", action="store_true", help="sensor_compact を作り直す")
+    parser.add_argument("--report", action="store_true", help="ファイルサイズ・1行あたりのバイト数・走査速度を比較")
+    args = parser.parse_args(argv)
+
+    source_conn = sqlite3.connect(args.db)
+    rollups.ensure_index(source_conn)
+    source_conn.commit()
+    if args.output:
+        conn = sqlite3.connect(args.output)
+        conn.execute("ATTACH DATABASE ? AS source", (args.db,))
+        source = "source"
+    else:
+        conn, source = source_conn, "main"
+    try:
+        if args.rebuild:
+            converted = rebuild(conn, source=source)
+        else:
+            converted = update(conn, source=source)
+            conn.commit()
+        print(f"✅ {converted} rows converted")
+        if args.output:
+            conn.execute("DETACH DATABASE source")
+            conn.execute("VACUUM")
+        if args.report:
+            for label, values in report(source_conn, conn).items():
+                print(f"{label}: " + ", ".join(f"{key}={value}" for key, value in values.items()))
+    finally:
+        if conn is not source_conn:
+            conn.close()
+        source_conn.close()
+
+
+if __name__ == "__main__":
+    main()
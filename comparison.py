@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Cross-location comparison on shared time buckets
+
+複数の場所の系列を共通のバケット列に揃え、(場所, 変数, バケット) の配列にする。
+場所ごとに別々に読み出すのではなく、ロールアップ（または生データ）を1回の問い合わせで
+読み、np.add.at で配列に加算する。1つのメトリクスを場所ごとに重ねたグラフと、
+変数間・場所間の相関行列はこの配列からベクトル演算で求める。
+
+変数には温度・湿度・土壌湿度に加えて、乾燥速度（土壌湿度のバケット間の変化、%/日。
+水やりによる上昇を含むバケットは除外）を含める。
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+import aggregation
+import anomalies
+import archive
+import gaps
+import locations
+import timeseries
+import watering
+
+METRICS = ("temperature", "humidity", "soil_moisture")
+VARIABLES = METRICS + ("drying_rate",)
+VARIABLE_LABELS = {
+    "temperature": "温度",
+    "humidity": "湿度",
+    "soil_moisture": "土壌湿度",
+    "drying_rate": "乾燥速度",
+}
+
+# 自動で選ぶバケット幅の候補と、1系列あたりの最大点数
+AUTO_BUCKETS = (300, 900, 3600, 6 * 3600, 86400, timeseries.WEEK)
+MAX_BUCKETS = 800
+# 相関を出すのに必要な、両方の値が揃ったバケット数
+MIN_PAIRS = 3
+
+Aligned = namedtuple("Aligned", ["grid", "locations", "values"])
+
+
+def comparison_window(window):
+    """共通のバケット幅を決める
+
+    指定が無いか記録間隔より短い場合（場所ごとに記録の時刻がずれるので揃わない）は、
+    記録間隔以上で点数が MAX_BUCKETS 以下になる最小の幅を選ぶ。
+    """
+    if window.bucket is not None and window.bucket >= gaps.SAMPLE_INTERVAL:
+        return window
+    duration = window.end_epoch - window.start_epoch
+    candidates = [b for b in AUTO_BUCKETS if b >= gaps.SAMPLE_INTERVAL] or [AUTO_BUCKETS[-1]]
+    bucket = next((b for b in candidates if duration / b <= MAX_BUCKETS), candidates[-1])
+    return timeseries.Window(window.start, window.end, bucket, window.range_key)
+
+
+def load_aligned(cursor, table_name, window, names):
+    """場所 × 変数 × バケットの平均値の配列（データの無いバケットは NaN）を1回の問い合わせで作る"""
+    bucket, origin = window.bucket, window.origin
+    first = window.bucket_start(window.start_epoch)
+    grid = np.arange(first, window.end_epoch, bucket, dtype=np.int64)
+    sums = np.zeros((len(names), len(METRICS), grid.size))
+    counts = np.zeros(sums.shape)
+    if not names or not grid.size:
+        return Aligned(grid, list(names), np.full((len(names), len(VARIABLES), grid.size), np.nan))
+    placeholders = ", ".join("?" for _ in names)
+
+    if window.tier is not None:
+        # ロールアップの (件数, 合計) をバケットにまとめる（場所ごとに主キーの範囲走査）
+        columns = ", ".join(f"{m}_sum, {m}_count" for m in METRICS)
+        cursor.execute(f'''
+            SELECT sensor_location, bucket_start, {columns} FROM sensor_rollups
+            WHERE sensor_location IN ({placeholders}) AND width = ? AND bucket_start >= ? AND bucket_start < ?
+        ''', (*names, window.tier, (window.start_epoch // window.tier) * window.tier, window.end_epoch))
+        rows = cursor.fetchall()
+        if rows:
+            ts = np.array([row[1] for row in rows], dtype=float)
+            data = np.array([row[2:] for row in rows], dtype=float).T
+            row_sums, row_counts = data[0::2], data[1::2]
+        index = {name: i for i, name in enumerate(names)}
+        location_index = np.array([index[row[0]] for row in rows], dtype=int)
+    else:
+        registry = locations.registry(cursor.connection)
+        location_ids = [registry.id_of(name) for name in names]
+        # アーカイブ済みの月は列ファイルから、それ以降は sensor_data から読む
+        start_text, archived = window.start_text(), []
+        cutoff = archive.cutoff(cursor.connection)
+        if cutoff is not None and window.start_epoch < cutoff:
+            start_text = timeseries.epoch_text(min(cutoff, window.end_epoch))
+            for i, location_id in enumerate(location_ids):
+                archived_ts, values, quality = archive.load(
+                    cursor.connection, [location_id], window.start_epoch, min(window.end_epoch, cutoff))
+                archived.append((np.full(archived_ts.size, i), archived_ts, archive.masked(values, quality)))
+        cursor.execute(f'''
+            SELECT location_id, timestamp, {anomalies.masked_columns()} FROM {table_name}
+            WHERE location_id IN ({placeholders}) AND timestamp >= ? AND timestamp < ?
+        ''', (*location_ids, start_text, window.end_text()))
+        rows = cursor.fetchall()
+        index = {location_id: i for i, location_id in enumerate(location_ids)}
+        archived.append((np.array([index[row[0]] for row in rows], dtype=int),
+                         aggregation.epochs_from_text([row[1] for row in rows]),
+                         aggregation.values_from_rows(rows, first_column=2)))
+        location_index = np.concatenate([part[0] for part in archived])
+        ts = np.concatenate([part[1] for part in archived])
+        data = np.hstack([part[2] for part in archived])
+        row_counts = (~np.isnan(data)).astype(float)
+        row_sums = np.where(row_counts > 0, data, 0.0)
+
+    if len(location_index):
+        positions = (aggregation.bucket_keys(ts, bucket, origin) - first) // bucket
+        inside = (positions >= 0) & (positions < grid.size)
+        location_index, positions = location_index[inside], positions[inside]
+        for m in range(len(METRICS)):
+            np.add.at(sums[:, m], (location_index, positions), row_sums[m][inside])
+            np.add.at(counts[:, m], (location_index, positions), row_counts[m][inside])
+
+    means = np.full(sums.shape, np.nan)
+    np.divide(sums, counts, out=means, where=counts > 0)
+    values = np.concatenate((means, drying_rate(means[:, METRICS.index("soil_moisture")], bucket)[:, None]), axis=1)
+    return Aligned(grid, list(names), values)
+
+
+def drying_rate(soil, bucket):
+    """土壌湿度 (場所, バケット) から乾燥速度（%/日、減少が正）を求める。水やりを含むバケットは NaN"""
+    rate = np.full(soil.shape, np.nan)
+    if soil.shape[1] < 2:
+        return rate
+    change = soil[:, 1:] - soil[:, :-1]
+    rate[:, 1:] = -change * 86400.0 / bucket
+    rate[:, 1:][change >= watering.RISE_THRESHOLD / 2] = np.nan
+    return rate
+
+
+def correlation(values):
+    """(変数, 観測) の配列の相関行列。NaN を含む観測は組ごとに除外する（pairwise complete）
+
+    組ごとの件数・合計・二乗和・積和を行列積でまとめて求めるので、変数の数が増えても
+    Python のループは回らない。揃った観測が MIN_PAIRS 未満の組は NaN。
+    """
+    values = np.atleast_2d(values)
+    mask = (~np.isnan(values)).astype(float)
+    x = np.where(mask > 0, values, 0.0)
+    n = mask @ mask.T
+    sx = x @ mask.T            # sx[i, j] = 変数 j も揃っている観測での変数 i の合計
+    sxx = (x * x) @ mask.T
+    sxy = x @ x.T
+    cov = n * sxy - sx * sx.T
+    var = (n * sxx - sx * sx) * (n * sxx.T - sx.T * sx.T)
+    result = np.full(cov.shape, np.nan)
+    np.divide(cov, np.sqrt(np.maximum(var, 0.0)), out=result, where=(var > 0) & (n >= MIN_PAIRS))
+    return np.clip(result, -1.0, 1.0)
+
+
+def variable_correlation(aligned):
+    """変数間の相関行列（全場所をまとめる）
+
+    場所ごとの平均を引いてからまとめるので、場所による水準の違いではなく、
+    時間とともに一緒に変化する度合いを表す。
+    """
+    values = aligned.values
+    present = ~np.isnan(values)
+    count = present.sum(axis=2, keepdims=True)
+    mean = np.where(present, values, 0.0).sum(axis=2, keepdims=True) / np.maximum(count, 1)
+    return correlation((values - mean).transpose(1, 0, 2).reshape(len(VARIABLES), -1))
+
+
+def location_correlation(aligned, variable):
+    """1つの変数について、場所 × 場所 の相関行列"""
+    return correlation(aligned.values[:, VARIABLES.index(variable)])
+
+
+def matrix_list(matrix, digits=3):
+    return [aggregation.to_list(row, digits) for row in matrix]
@@ -1,8 +1,52 @@
-from bottle import route, run, template, request, static_file, response
+from bottle import route, run, template, request, static_file, response, install, hook
 import sqlite3
 from datetime import datetime, timedelta
 import json
+import os
 import re
+from bisect import bisect_right
+from operator import itemgetter
+
+import numpy as np
+
+import metrics
+from instrumentation import TimingPlugin, TimedConnection, MemoryTracker, observe_memory, timed, snapshot as timing_snapshot
+from streaming_stats import WindowStats
+import aggregation
+import anomalies
+import archive
+import bulk_import
+import comparison
+import export
+import forecasting
+import gaps
+import hotcache
+import locations
+import maintenance
+import rollups
+import sketches
+import smoothing
+import tiles
+import timeseries
+import watering
+
+# --- DB設定 ---
+# ベンチマーク等から別DBを指定できるよう環境変数で上書き可能にする
+DB_PATH = os.getenv("SENSOR_DB_PATH", "sensor_data.db")
+
+def get_connection():
+    """ダッシュボード用のSQLite接続を取得"""
+    return sqlite3.connect(DB_PATH, factory=TimedConnection)
+
+# --- リクエスト計測（Server-Timing ヘッダー / /api/metrics / ?profile=1） ---
+install(TimingPlugin())
+
+# --- DBメンテナンス（リクエストの無い間に optimize / vacuum / ANALYZE / quick_check） ---
+MAINTENANCE = maintenance.Scheduler(DB_PATH)
+
+@hook('before_request')
+def track_request():
+    MAINTENANCE.touch()
 
 @route('/static/<filename:path>')
 def send_static(filename):
@@ -126,311 +170,476 @@ def get_optimal_time_format(range_param, aggregate_param, data_count, screen_wid
     
     return rule
 
-@route('/')
-def index():
-    # クエリパラメータから設定を取得
-    range_param = request.query.range or "24h"
-    aggregate_param = request.query.aggregate or "raw"
-    location_param = request.query.location or "all"  # センサー場所フィルター
-    screen_width = int(request.query.width or "1200")  # JavaScript から画面幅を受信
-    
-    # 時間条件の設定
-    time_conditions = {
-        "1h": "datetime('now', '-1 hours')",
-        "6h": "datetime('now', '-6 hours')",
-        "12h": "datetime('now', '-12 hours')",
-        "24h": "datetime('now', '-1 days')",
-        "3d": "datetime('now', '-3 days')",
-        "7d": "datetime('now', '-7 days')",
-        "30d": "datetime('now', '-30 days')"
-    }
-    
-    time_condition = time_conditions.get(range_param, time_conditions["24h"])
-    
-    conn = sqlite3.connect("sensor_data.db")
-    cursor = conn.cursor()
-    
-    # テーブル名を確認して適切なものを使用
+METRICS = ("temperature", "humidity", "soil_moisture")
+
+def resolve_table_name(cursor, verbose=False):
+    """テーブル名を確認して適切なものを返す（タイポ版 sensro_data にも対応）"""
     cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
     tables = [row[0] for row in cursor.fetchall()]
-    
-    # 実際のテーブル名を特定
+
     table_name = "sensor_data"  # デフォルト（正しいスペル）
     if "sensor_data" in tables:
         table_name = "sensor_data"  # 正しい名前が存在する場合
-        print(f"✅ Using table: {table_name}")
     elif "sensro_data" in tables:
         table_name = "sensro_data"  # タイポ版が存在する場合
-        print(f"✅ Using table: {table_name}")
-    else:
-        print(f"⚠️ Available tables: {tables}")
+    elif tables:
         # フォールバックとして最初のテーブルを使用
-        if tables:
-            table_name = tables[0]
-            print(f"📍 Fallback to: {table_name}")
-    
-    # 利用可能なセンサー場所を取得
-    try:
-        cursor.execute(f"SELECT DISTINCT sensor_location FROM {table_name} WHERE sensor_location IS NOT NULL ORDER BY sensor_location")
-        locations = [row[0] for row in cursor.fetchall()]
-        if not locations:
-            locations = ["default"]  # フォールバック
-    except sqlite3.OperationalError:
-        # sensor_locationカラムが存在しない場合
-        locations = ["default"]
-    
-    # 現在選択中のセンサー場所情報を設定
-    current_location = "全ての場所"
-    if location_param != "all" and location_param in locations:
-        current_location = location_param
+        if verbose:
+            print(f"⚠️ Available tables: {tables}")
+        table_name = tables[0]
+    if verbose:
+        print(f"✅ Using table: {table_name}")
+    return table_name
 
-    # グラフデータの取得（修正版）
-    if location_param == "all":
-        # 全ての場所選択時: 場所別にデータを分けて取得
-        chart_data_by_location = {}
-        
-        for location in locations:
-            # 各場所のデータを個別に取得
-            location_condition = f" AND sensor_location = '{location}'"
-            
-            if aggregate_param == "raw":
-                # 生データ
-                cursor.execute(f'''
-                    SELECT timestamp, temperature, humidity, soil_moisture 
-                    FROM {table_name}
-                    WHERE timestamp >= {time_condition}{location_condition}
-                    ORDER BY timestamp
-                ''')
-            elif aggregate_param == "hourly":
-                # 1時間平均
-                cursor.execute(f'''
-                    SELECT 
-                        strftime('%Y-%m-%d %H:00:00', timestamp) as hour_timestamp,
-                        AVG(temperature) as temperature,
-                        AVG(humidity) as humidity,
-                        AVG(soil_moisture) as soil_moisture
-                    FROM {table_name}
-                    WHERE timestamp >= {time_condition}{location_condition}
-                    GROUP BY strftime('%Y-%m-%d %H', timestamp)
-                    ORDER BY hour_timestamp
-                ''')
-            elif aggregate_param == "daily":
-                # 1日平均
-                cursor.execute(f'''
-                    SELECT 
-                        strftime('%Y-%m-%d 00:00:00', timestamp) as day_timestamp,
-                        AVG(temperature) as temperature,
-                        AVG(humidity) as humidity,
-                        AVG(soil_moisture) as soil_moisture
-                    FROM {table_name}
-                    WHERE timestamp >= {time_condition}{location_condition}
-                    GROUP BY strftime('%Y-%m-%d', timestamp)
-                    ORDER BY day_timestamp
-                ''')
-            
-            # この場所のデータを取得
-            location_data = cursor.fetchall()
-            
-            # 高度な時間フォーマット処理
-            data_count = len(location_data)
-            formatted_timestamps = []
-            for r in location_data:
-                timestamp_str = r[0]
-                formatted_time = format_timestamp(timestamp_str, aggregate_param, range_param, data_count, screen_width)
-                formatted_timestamps.append(formatted_time)
-            
-            # データを整理
-            chart_data_by_location[location] = {
-                'labels': formatted_timestamps,
-                'temperature': [round(r[1], 1) if r[1] else None for r in location_data],
-                'humidity': [round(r[2], 1) if r[2] else None for r in location_data],
-                'soil_moisture': [round(r[3], 1) if r[3] else None for r in location_data]
-            }
-        
-        # テンプレートに渡すデータ
-        chart_data = chart_data_by_location
-        # 全体統計用のタイムスタンプ（最初の場所のものを使用）
-        timestamps = chart_data[locations[0]]['labels'] if locations and locations[0] in chart_data else []
-        
-    else:
-        # 個別場所選択時: 現在と同じロジック
-        location_condition = ""
-        if location_param != "all" and location_param in locations:
-            location_condition = f" AND sensor_location = '{location_param}'"
-        
-        # 集計方法による SQL クエリの変更
-        if aggregate_param == "raw":
-            cursor.execute(f'''
-                SELECT timestamp, temperature, humidity, soil_moisture
-                FROM {table_name}
-                WHERE timestamp >= {time_condition}{location_condition}
-                ORDER BY timestamp ASC
-            ''')
-            rows = cursor.fetchall()
-            
-            # 高度な時間フォーマット処理
-            data_count = len(rows)
-            time_format_rule = get_optimal_time_format(range_param, aggregate_param, data_count, screen_width)
-            
-            timestamps = []
-            for r in rows:
-                timestamp_str = r[0]
-                formatted_time = format_timestamp(timestamp_str, aggregate_param, range_param, data_count, screen_width)
-                timestamps.append(formatted_time)
-            
-            temperatures = [r[1] for r in rows]
-            humidities = [r[2] for r in rows]
-            moistures = [r[3] for r in rows]
-            
-        elif aggregate_param == "hourly":
-            cursor.execute(f'''
-                SELECT 
-                    strftime('%Y-%m-%d %H:00:00', timestamp) as hour_timestamp,
-                    AVG(temperature) as avg_temp,
-                    AVG(humidity) as avg_humidity,
-                    AVG(soil_moisture) as avg_moisture
-                FROM {table_name}
-                WHERE timestamp >= {time_condition}{location_condition}
-                GROUP BY strftime('%Y-%m-%d %H', timestamp)
-                ORDER BY hour_timestamp ASC
-            ''')
-            rows = cursor.fetchall()
-            
-            data_count = len(rows)
-            time_format_rule = get_optimal_time_format(range_param, aggregate_param, data_count, screen_width)
-            
-            timestamps = []
-            for r in rows:
-                timestamp_str = r[0]
-                formatted_time = format_timestamp(timestamp_str, aggregate_param, range_param, data_count, screen_width)
-                timestamps.append(formatted_time)
-            
-            temperatures = [round(r[1], 1) if r[1] else None for r in rows]
-            humidities = [round(r[2], 1) if r[2] else None for r in rows]
-            moistures = [round(r[3], 1) if r[3] else None for r in rows]
-            
-        elif aggregate_param == "daily":
-            cursor.execute(f'''
-                SELECT 
-                    strftime('%Y-%m-%d 00:00:00', timestamp) as day_timestamp,
-                    AVG(temperature) as avg_temp,
-                    AVG(humidity) as avg_humidity,
-                    AVG(soil_moisture) as avg_moisture
-                FROM {table_name}
-                WHERE timestamp >= {time_condition}{location_condition}
-                GROUP BY strftime('%Y-%m-%d', timestamp)
-                ORDER BY day_timestamp ASC
-            ''')
-            rows = cursor.fetchall()
-            
-            data_count = len(rows)
-            time_format_rule = get_optimal_time_format(range_param, aggregate_param, data_count, screen_width)
-            
-            timestamps = []
-            for r in rows:
-                timestamp_str = r[0]
-                formatted_time = format_timestamp(timestamp_str, aggregate_param, range_param, data_count, screen_width)
-                timestamps.append(formatted_time)
-            
-            temperatures = [round(r[1], 1) if r[1] else None for r in rows]
-            humidities = [round(r[2], 1) if r[2] else None for r in rows]
-            moistures = [round(r[3], 1) if r[3] else None for r in rows]
-
-        # 個別場所用のデータ整理
-        chart_data = {
-            'labels': timestamps,
-            'temperature': temperatures,
-            'humidity': humidities,
-            'soil_moisture': moistures
+class SeriesBuilder:
+    """1場所分（または全体）のグラフ系列と統計
+
+    生データ（SQLの行・ホットキャッシュの列）は NumPy の列にまとめ、バケット集計と統計を
+    aggregation モジュールでベクトル演算する。ロールアップの部分集計行（add_partial_rows）は
+    バケットごとの合計・件数として集計し、統計は WindowStats にマージする。
+    """
+
+    def __init__(self, window, interval=gaps.SAMPLE_INTERVAL):
+        self.window = window
+        self.interval = interval                  # 想定の記録間隔（秒）。欠測で線を途切れさせる判定に使う
+        self.ts = np.empty(0)                    # UNIX秒
+        self.values = np.empty((len(METRICS), 0))  # メトリクス × 行（欠損は NaN）
+        self.texts = None                         # SQLから読んだ生データの時刻文字列
+        self.stats = None                         # ロールアップ経由の統計（WindowStats）
+        self.last_timestamp = None
+        self._partials = None
+        self._series = None
+        self._means = None
+        self._smoothed = {}
+
+    def add_rows(self, rows):
+        """SQLの行 (timestamp, temperature, humidity, soil_moisture) を時刻順に受け取る"""
+        if not rows:
+            return
+        self.texts = [row[0] for row in rows]
+        self.ts = aggregation.epochs_from_text(self.texts)
+        self.values = aggregation.values_from_rows(rows)
+        self.last_timestamp = self.texts[-1]
+
+    def add_columns(self, ts, columns):
+        """ホットキャッシュの列（array('d')）をコピーせずに受け取る"""
+        if not len(ts):
+            return
+        self.ts = np.frombuffer(ts)
+        self.values = np.vstack([np.frombuffer(column) for column in columns])
+        self.last_timestamp = hotcache.epoch_text(ts[-1])
+
+    def add_archived(self, ts, values):
+        """アーカイブの列（UNIX秒, メトリクス × 行）を、SQLから読んだ行より前に加える"""
+        if not len(ts):
+            return
+        if self.texts is not None:
+            self.texts = [timeseries.epoch_text(t) for t in ts.tolist()] + self.texts
+        else:
+            self.last_timestamp = timeseries.epoch_text(int(ts[-1]))
+        self.ts = np.concatenate((ts, self.ts))
+        self.values = np.hstack((values, self.values))
+
+    def add_partial_rows(self, rows):
+        """ロールアップ行 (bucket_start, count, *rollups.PARTIAL_COLUMNS) を受け取る"""
+        self.stats = WindowStats(METRICS)
+        starts, totals, counts = [], [], []
+        for bucket_start, count, *flat in rows:
+            partials = [flat[i * 5:(i + 1) * 5] for i in range(len(METRICS))]
+            self.stats.add_partials(count, partials)
+            starts.append(bucket_start)
+            totals.append([p[1] for p in partials])
+            counts.append([p[0] for p in partials])
+        self._partials = (np.array(starts, dtype=np.int64),
+                          np.array(totals, dtype=float).reshape(-1, len(METRICS)).T,
+                          np.array(counts, dtype=float).reshape(-1, len(METRICS)).T)
+
+    def set_last(self, timestamp_str, values):
+        """ロールアップから作った場合の最新値"""
+        self.last_timestamp = timestamp_str
+        for metric, value in zip(METRICS, values):
+            self.stats.series[metric].set_last(value)
+
+    def series(self):
+        """(時刻文字列のリスト, 3列のリスト) を返す。バケット集計値は小数1桁に丸める"""
+        if self._series is not None:
+            return self._series
+        window = self.window
+        digits = 1
+        if self._partials is not None:
+            points, means = aggregation.merge_partials(*self._partials, window.bucket, window.origin)
+            timestamps = [timeseries.epoch_text(int(key)) for key in points]
+        elif window.bucket is None:
+            points, means, digits = self.ts, self.values, None
+            timestamps = self.texts if self.texts is not None else [hotcache.epoch_text(t) for t in self.ts.tolist()]
+        else:
+            buckets = aggregation.bucket_aggregate(self.ts, self.values, window.bucket, window.origin)
+            points, means = buckets.start, buckets.mean
+            timestamps = [timeseries.epoch_text(key) for key in buckets.start.tolist()]
+        positions = gaps.break_positions(points, max(window.bucket or 0, self.interval * gaps.GAP_FACTOR))
+        if positions:
+            # 欠測区間には値のない点を挟み、線で結ばずに途切れさせる
+            step = window.bucket or self.interval
+            timestamps = list(timestamps)
+            for position in reversed(positions):
+                timestamps.insert(position, timeseries.epoch_text(int(points[position - 1] + step)))
+            means = np.insert(means, positions, np.nan, axis=1)
+        columns = [aggregation.to_list(column, digits) for column in means]
+        self._means = means
+        self._series = (timestamps, columns)
+        return self._series
+
+    def smoothed(self, overlay):
+        """系列を平滑化した3列のリスト（overlay = (方式, 点数) ごとに系列と一緒にキャッシュする）"""
+        columns = self._smoothed.get(overlay)
+        if columns is None:
+            self.series()
+            values = smoothing.smooth(self._means, *overlay)
+            columns = self._smoothed[overlay] = [aggregation.to_list(column, 1) for column in values]
+        return columns
+
+    @property
+    def columns(self):
+        return self.series()[1]
+
+    def raw_timestamps(self):
+        return self.series()[0]
+
+    def summary(self):
+        if self.stats is not None:
+            return self.stats.summary()
+        return aggregation.summarize(self.values, METRICS)
+
+    def chart_data(self, screen_width, overlay=None):
+        timestamps, columns = self.series()
+        data_count = len(timestamps)
+        format_type = self.window.format_type()
+        labels = [
+            format_timestamp(ts, format_type, self.window.range_key, data_count, screen_width)
+            for ts in timestamps
+        ]
+        data = {
+            'labels': labels,
+            'temperature': columns[0],
+            'humidity': columns[1],
+            'soil_moisture': columns[2],
         }
-    
-    # 統計情報の計算（集計方法に応じて変更）
-    if aggregate_param == "raw":
-        # 生データ: 最新の1件
-        cursor.execute(f'''
-            SELECT 
-                1 as count,
-                temperature as avg_temp,
-                temperature as min_temp,
-                temperature as max_temp,
-                humidity as avg_humidity,
-                humidity as min_humidity,
-                humidity as max_humidity,
-                soil_moisture as avg_moisture,
-                soil_moisture as min_moisture,
-                soil_moisture as max_moisture
-            FROM {table_name}
-            WHERE timestamp >= {time_condition}{(" AND sensor_location = '" + location_param + "'") if location_param != "all" and location_param in locations else ""}
-            ORDER BY timestamp DESC
-            LIMIT 1
-        ''')
-    elif aggregate_param == "hourly":
-        # 1時間平均: 直近1時間の平均
+        if overlay is not None:
+            data['smoothed'] = dict(zip(METRICS, self.smoothed(overlay)))
+        return data
+
+def load_series(cursor, table_name, window, location=None, with_stats=True, include_flagged=False):
+    """期間内の系列を読み出す。バケット幅に応じて生データかロールアップを使う
+
+    品質フラグ（anomalies）の付いた値は欠損として扱う。include_flagged=True の場合は
+    生データのまま読む（ロールアップとホットキャッシュはフラグの付いた値を含まない）。
+    """
+    builder = SeriesBuilder(window, gap_interval(cursor, location))
+    location_condition = " AND location_id = ?" if location is not None else ""
+    location_params = (location_id(cursor, location),) if location is not None else ()
+    columns = anomalies.masked_columns(include_flagged)
+
+    if window.tier is None and not include_flagged and hotcache.CACHE.covers(window.start_epoch):
+        # 直近の期間はメモリ上の列を二分探索で切り出す
+        ts, *columns = hotcache.CACHE.slice(location, window.start_epoch, window.end_epoch)
+        builder.add_columns(ts, columns)
+        return builder
+
+    if window.tier is None or include_flagged:
+        # アーカイブ済みの月はメモリマップした列から、それ以降は sensor_data から読む
+        start_text, archived = archived_columns(cursor, window, location, include_flagged)
         cursor.execute(f'''
-            SELECT 
-                COUNT(*) as count,
-                AVG(temperature) as avg_temp,
-                MIN(temperature) as min_temp,
-                MAX(temperature) as max_temp,
-                AVG(humidity) as avg_humidity,
-                MIN(humidity) as min_humidity,
-                MAX(humidity) as max_humidity,
-                AVG(soil_moisture) as avg_moisture,
-                MIN(soil_moisture) as min_moisture,
-                MAX(soil_moisture) as max_moisture
+            SELECT timestamp, {columns}
             FROM {table_name}
-            WHERE timestamp >= datetime('now', '-1 hours'){(" AND sensor_location = '" + location_param + "'") if location_param != "all" and location_param in locations else ""}
-        ''')
-    elif aggregate_param == "daily":
-        # 1日平均: 直近1日の平均
+            WHERE timestamp >= ? AND timestamp < ?{location_condition}
+            ORDER BY timestamp ASC
+        ''', (start_text, window.end_text(), *location_params))
+        builder.add_rows(cursor.fetchall())
+        builder.add_archived(*archived)
+        return builder
+
+    builder.add_partial_rows(rollups.fetch_partials(
+        cursor, window.tier, location, window.start_epoch, window.end_epoch, table_name))
+    if with_stats and builder.stats.rows:
+        # 最新値は (location_id, timestamp) 索引で1行だけ参照する
         cursor.execute(f'''
-            SELECT 
-                COUNT(*) as count,
-                AVG(temperature) as avg_temp,
-                MIN(temperature) as min_temp,
-                MAX(temperature) as max_temp,
-                AVG(humidity) as avg_humidity,
-                MIN(humidity) as min_humidity,
-                MAX(humidity) as max_humidity,
-                AVG(soil_moisture) as avg_moisture,
-                MIN(soil_moisture) as min_moisture,
-                MAX(soil_moisture) as max_moisture
+            SELECT timestamp, {columns}
             FROM {table_name}
-            WHERE timestamp >= datetime('now', '-1 days'){(" AND sensor_location = '" + location_param + "'") if location_param != "all" and location_param in locations else ""}
-        ''')
-    
-    stats = cursor.fetchone()
-    conn.close()
+            WHERE timestamp >= ? AND timestamp < ?{location_condition}
+            ORDER BY timestamp DESC LIMIT 1
+        ''', (window.start_text(), window.end_text(), *location_params))
+        row = cursor.fetchone()
+        if row:
+            builder.set_last(row[0], row[1:])
+    return builder
+
+def archived_columns(cursor, window, location, include_flagged=False):
+    """期間のうちアーカイブ済みの部分の (UNIX秒, メトリクス × 行) と、sensor_data から読み始める時刻文字列"""
+    cutoff = archive.cutoff(cursor.connection)
+    if cutoff is None or window.start_epoch >= cutoff:
+        return window.start_text(), (np.empty(0, dtype=np.int64), np.empty((len(METRICS), 0)))
+    if location is None:
+        registry = locations.registry(cursor.connection)
+        location_ids = [registry.id_of(name) for name in registry.names()]
+    else:
+        location_ids = [location_id(cursor, location)]
+    ts, values, quality = archive.load(cursor.connection, location_ids, window.start_epoch,
+                                       min(window.end_epoch, cutoff))
+    start_text = timeseries.epoch_text(cutoff) if window.end_epoch > cutoff else window.end_text()
+    return start_text, (ts, archive.masked(values, quality, include_flagged))
+
+def list_locations(cursor, table_name):
+    """利用可能なセンサー場所（無ければ ["default"]）
+
+    sensor_data を走査せず、locations テーブルのプロセス内キャッシュから返す。
+    """
+    rollups.ensure_index(cursor.connection, table_name)
+    return locations.names(cursor.connection) or ["default"]  # フォールバック
+
+def location_id(cursor, location):
+    """場所名の location_id（キャッシュ参照。未登録なら None で、どの行にも一致しない）"""
+    return locations.location_id(cursor.connection, location)
+
+def gap_interval(cursor, location):
+    """グラフの欠測判定に使う記録間隔（秒）。1場所ならその場所の設定、全体なら既定値"""
+    if location is None:
+        return gaps.SAMPLE_INTERVAL
+    return gaps.interval_for(cursor.connection, location)
+
+def location_labels(conn, names):
+    """場所名 → 表示名（未設定なら場所名）"""
+    registry = locations.registry(conn)
+    return {name: registry.get(name).label if registry.get(name) else name for name in names}
+
+def prepare_sources(conn, table_name):
+    """ロールアップ・分位点スケッチ・水やり検出・予測モデル・欠測区間・ホットキャッシュを用意する（ホットキャッシュは新しい行を取り込む）"""
+    built = rollups.ensure_built(conn, table_name)
+    sketches.ensure_built(conn, table_name)
+    watering.ensure_built(conn, table_name)
+    forecasting.ensure_built(conn, table_name)
+    gaps.ensure_built(conn, table_name)
+    hotcache.CACHE.ensure(conn, DB_PATH, table_name, rollups.naive_epoch(datetime.now()),
+                          bulk_import.generation(conn))
+    return built
+
+def watering_summary(state):
+    """水やり状態の1行表示（水やりを検出していなければ空文字）"""
+    if not state or not state["last_watered"]:
+        return ""
+    parts = [f"🚿 {state['days_since_watering']:.1f}日前に水やり"]
+    if state["drying_rate_per_day"] is not None:
+        parts.append(f"乾燥 {state['drying_rate_per_day']:+.1f}%/日")
+    if state["hours_until_threshold"] is not None:
+        parts.append(f"{state['threshold']:g}%まで約{state['hours_until_threshold']:.0f}時間")
+    return " | ".join(parts)
+
+def forecast_summary(result):
+    """土壌湿度予測の1行表示（予測できなければ空文字）"""
+    if not result["ready"] or result["predicted_at"] is None:
+        return ""
+    return (f"🔮 {result['threshold']:g}%到達予測 {result['predicted_at'][:16]}"
+            f"（約{result['hours_until_threshold']:.0f}時間後）")
+
+def refresh_gaps(conn, table_name, locations):
+    """欠測区間を新しい行の分だけ更新する（索引だけの走査なので表示のたびに呼んでよい）"""
+    for location in locations:
+        gaps.update(conn, table_name, location)
+    conn.commit()
+
+def uptime_summary(report):
+    """稼働状況の1行表示（停止中なら最後の読み取り時刻も出す）"""
+    if report["last_reading"] is None:
+        return ""
+    periods = " / ".join(
+        f"{name} {u['availability_pct']:.1f}%" for name, u in report["uptime"].items()
+        if u["availability_pct"] is not None)
+    if report["online"]:
+        return f"📶 稼働率 {periods}"
+    return f"⛔ 停止中（最終 {report['last_reading'][:16]}） | 稼働率 {periods}"
+
+def add_projection(chart, result, window, screen_width):
+    """グラフの右端に土壌湿度の予測線を追加する（ラベルを未来側に延ばし、実測の最後の点から繋げる）"""
+    labels = chart['labels']
+    if not result["ready"] or not labels:
+        return
+    format_type = window.format_type()
+    future = result["projection"][1:]
+    chart['labels'] = labels + [
+        format_timestamp(timeseries.epoch_text(t), format_type, window.range_key, len(labels), screen_width)
+        for t, _ in future
+    ]
+    chart['projection'] = [None] * (len(labels) - 1) + [result["projection"][0][1]] + [v for _, v in future]
+
+def exact_quantiles(cursor, table_name, window, location, quantiles):
+    """期間内の値から求めた正確な分位点 {メトリクス: {q: 値}}（スケッチが無い場合の代わり）"""
+    start_text, (_, archived) = archived_columns(cursor, window, location)
+    location_condition = " AND location_id = ?" if location is not None else ""
+    location_params = (location_id(cursor, location),) if location is not None else ()
+    rows = cursor.execute(f'''
+        SELECT {anomalies.masked_columns()} FROM {table_name}
+        WHERE timestamp >= ? AND timestamp < ?{location_condition}
+    ''', (start_text, window.end_text(), *location_params)).fetchall()
+    values = np.hstack((archived, aggregation.values_from_rows(rows, first_column=0)))
+    result = {}
+    for metric, column in zip(METRICS, values):
+        column = column[~np.isnan(column)]
+        if column.size:
+            result[metric] = dict(zip(quantiles, np.quantile(column, quantiles).tolist()))
+    return result
+
+def apply_sketch_percentiles(conn, table_name, window, builders, overall):
+    """ロールアップ経由の統計に、t-digest スケッチから求めた分位点を設定する
+
+    スケッチの無い場所・メトリクスは、期間内の値から正確な分位点を求める。
+    """
+    merged = sketches.load_merged(conn, window.start, window.end)
+    quantiles = list(overall.series[METRICS[0]].quantiles)
+    cursor = conn.cursor()
+    totals = {}
+    incomplete = set()
+    exact = None
+    for location, builder in builders.items():
+        digests = merged.get(location, {})
+        exact = None
+        for metric in METRICS:
+            if not builder.stats.series[metric].count:
+                continue
+            digest = digests.get(metric)
+            if digest is None:
+                incomplete.add(metric)
+                if exact is None:
+                    exact = exact_quantiles(cursor, table_name, window, location, quantiles)
+                values = exact.get(metric, {})
+            else:
+                values = {q: digest.quantile(q) for q in quantiles}
+                if metric in totals:
+                    totals[metric].merge(digest)
+                else:
+                    totals[metric] = digest
+            for q, value in values.items():
+                builder.stats.series[metric].set_quantile(q, value)
+    if incomplete and len(builders) > 1:
+        exact = exact_quantiles(cursor, table_name, window, None, quantiles)
+    for metric in METRICS:
+        if metric in incomplete:
+            values = exact.get(metric, {})
+        elif metric in totals:
+            values = {q: totals[metric].quantile(q) for q in quantiles}
+        else:
+            continue
+        for q, value in values.items():
+            overall.series[metric].set_quantile(q, value)
+
+def overall_summary(conn, table_name, window, builders):
+    """表示中の全場所をまとめた統計。最新値は最も新しいデータを持つ場所の値にする
+
+    ロールアップ経由の場合は、場所別の統計にもスケッチの分位点を設定する。
+    """
+    if all(builder.stats is None for builder in builders.values()):
+        values = [builder.values for builder in builders.values()]
+        result = aggregation.summarize(np.hstack(values) if values else np.empty((len(METRICS), 0)), METRICS)
+    else:
+        overall = WindowStats(METRICS)
+        for builder in builders.values():
+            overall.merge(builder.stats)
+        apply_sketch_percentiles(conn, table_name, window, builders, overall)
+        result = overall.summary()
+    latest = max((b for b in builders.values() if b.last_timestamp), key=lambda b: b.last_timestamp, default=None)
+    if latest is not None:
+        latest_summary = latest.summary()
+        for metric in METRICS:
+            result[metric]["last"] = latest_summary[metric]["last"]
+    return result
+
+@route('/')
+def index():
+    # クエリパラメータから設定を取得
+    range_param = request.query.range or "24h"
+    aggregate_param = request.query.aggregate or "raw"
+    location_param = request.query.location or "all"  # センサー場所フィルター
+    screen_width = int(request.query.width or "1200")  # JavaScript から画面幅を受信
+    from_param = request.query.get("from") or ""
+    to_param = request.query.to or ""
+    include_flagged = request.query.quality == "all"  # 品質フラグの付いた値も含める
+
+    # 表示期間とバケット幅（不正な指定は24時間・生データに戻して通知する）
+    notice = ""
+    try:
+        window = timeseries.resolve_window(range_param, aggregate_param, from_param, to_param)
+    except ValueError as e:
+        notice = f"⚠️ 指定された期間・集計方法を解釈できませんでした（{e}）。過去24時間の生データを表示しています。"
+        range_param, aggregate_param, from_param, to_param = "24h", "raw", "", ""
+        window = timeseries.resolve_window(range_param, aggregate_param)
+
+    # 平滑化オーバーレイ（不正な指定は平滑化なしにして通知する）
+    smooth_param = request.query.smooth or "none"
+    smooth_points_param = request.query.smooth_points or ""
+    try:
+        overlay = smoothing.parse_smoothing(smooth_param, smooth_points_param)
+    except ValueError as e:
+        notice = (notice + " " if notice else "") + f"⚠️ 平滑化の指定が不正です（{e}）。平滑化なしで表示しています。"
+        smooth_param, smooth_points_param, overlay = "none", "", None
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    table_name = resolve_table_name(cursor, verbose=True)
+    if prepare_sources(conn, table_name):
+        print("📦 Built sensor_rollups from existing data")
     
-    # 統計データの整理（None対応）
-    if stats and stats[0] > 0:  # データが存在する場合
-        statistics = {
-            'count': stats[0],
-            'temperature': {
-                'avg': round(stats[1], 1) if stats[1] is not None else 0,
-                'min': round(stats[2], 1) if stats[2] is not None else 0,
-                'max': round(stats[3], 1) if stats[3] is not None else 0
-            },
-            'humidity': {
-                'avg': round(stats[4], 1) if stats[4] is not None else 0,
-                'min': round(stats[5], 1) if stats[5] is not None else 0,
-                'max': round(stats[6], 1) if stats[6] is not None else 0
-            },
-            'soil_moisture': {
-                'avg': round(stats[7], 1) if stats[7] is not None else 0,
-                'min': round(stats[8], 1) if stats[8] is not None else 0,
-                'max': round(stats[9], 1) if stats[9] is not None else 0
-            }
-        }
-    else:  # データが存在しない場合
-        statistics = {
-            'count': 0,
-            'temperature': {'avg': 0, 'min': 0, 'max': 0},
-            'humidity': {'avg': 0, 'min': 0, 'max': 0},
-            'soil_moisture': {'avg': 0, 'min': 0, 'max': 0}
-        }
+    # 利用可能なセンサー場所を取得
+    locations = list_locations(cursor, table_name)
     
-    return template('''
+    # 現在選択中のセンサー場所情報を設定
+    if location_param not in locations:
+        location_param = "all"
+    labels = location_labels(conn, locations)
+    current_location = "全ての場所" if location_param == "all" else labels[location_param]
+    data_generation = bulk_import.generation(conn)
+
+    # グラフデータと統計情報を1回の走査で作成（場所ごとに索引の範囲走査）
+    target_locations = locations if location_param == "all" else [location_param]
+    builders = {
+        location: load_series(cursor, table_name, window, location, include_flagged=include_flagged)
+        for location in target_locations
+    }
+    statistics = overall_summary(conn, table_name, window, builders)
+    # 表示期間が現在まで続く場合は、期間の1/4（1〜72時間）先までの予測線を重ねる
+    now_epoch = rollups.naive_epoch(datetime.now())
+    forecasts = {}
+    if window.end_epoch >= now_epoch - 60:
+        horizon = min(max((window.end_epoch - window.start_epoch) / 4 / 3600, 1), 72)
+        forecasts = {location: forecasting.forecast(conn, location, horizon_hours=horizon, points=12, now_epoch=now_epoch)
+                     for location in target_locations}
+    refresh_gaps(conn, table_name, target_locations)
+    location_notes = {
+        location: " | ".join(text for text in (
+            uptime_summary(gaps.report(conn, location, now_epoch)),
+            watering_summary(watering.status(conn, location, now_epoch)),
+            forecast_summary(forecasts[location]) if location in forecasts else "",
+        ) if text)
+        for location in target_locations
+    }
+    conn.close()
+    location_statistics = {}
+
+    if location_param == "all":
+        # 全ての場所選択時: 場所別のグラフデータと統計
+        chart_data = {}
+        for location, builder in builders.items():
+            chart_data[location] = builder.chart_data(screen_width, overlay)
+            location_statistics[location] = builder.summary()
+            if location in forecasts:
+                add_projection(chart_data[location], forecasts[location], window, screen_width)
+        timestamps = []
+    else:
+        # 個別場所選択時: 単一グラフセット
+        chart_data = builders[location_param].chart_data(screen_width, overlay)
+        timestamps = chart_data['labels']
+        if location_param in forecasts:
+            add_projection(chart_data, forecasts[location_param], window, screen_width)
+
+    with timed("render"):
+        page = template('''
         <!DOCTYPE html>
         <html>
         <head>
@@ -447,6 +656,9 @@ def index():
             
             <!-- Chart.js -->
             <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
+            <!-- ズーム・パン（詳細ビュー） -->
+            <script src="https://cdn.jsdelivr.net/npm/hammerjs@2.0.8"></script>
+            <script src="https://cdn.jsdelivr.net/npm/chartjs-plugin-zoom@2.0.1/dist/chartjs-plugin-zoom.min.js"></script>
             
             <style>
                 :root {
@@ -602,6 +814,13 @@ def index():
                     text-align: center;
                     margin: 0;
                 }
+
+                .stat-detail {
+                    font-size: 0.8rem;
+                    color: var(--text-gray);
+                    text-align: center;
+                    margin-top: 0.3rem;
+                }
                 
                 .temp { color: var(--accent-red); }
                 .humidity { color: var(--accent-blue); }
@@ -632,6 +851,13 @@ def index():
                     border-bottom: 2px solid var(--border-light); 
                 }
 
+                .location-stats {
+                    font-size: 0.85rem;
+                    color: var(--text-gray);
+                    text-align: center;
+                    padding: 0.4rem 1rem;
+                }
+
                 .chart-container h4 {
                     margin-bottom: 1rem;
                     font-size: 1.1rem;
@@ -643,6 +869,21 @@ def index():
                     margin: 0;              /* 1.5rem 0 → 0 に変更 */
                 }
                 
+                .detail-container .chart-container {
+                    height: 400px;
+                    margin: 0.5rem 0 0 0;
+                }
+                
+                .detail-controls {
+                    display: flex;
+                    flex-wrap: wrap;
+                    gap: 1rem;
+                    align-items: center;
+                    padding: 0 1.5rem;
+                    font-size: 0.85rem;
+                    color: var(--text-gray);
+                }
+                
                 .update-info { 
                     margin: 1rem 0;
                     color: var(--text-gray);
@@ -653,6 +894,10 @@ def index():
                     border-left: 4px solid var(--primary-green);
                 }
                 
+                .update-info.notice {
+                    border-left-color: #e67e22;
+                }
+                
                 .time-format-info {
                     margin: 0.5rem 0;
                     padding: 0.5rem;
@@ -721,6 +966,9 @@ def index():
                         <input type="hidden" name="aggregate" value="{{aggregate_param}}">
                         <input type="hidden" name="location" value="{{location_param}}">
                         <input type="hidden" name="width" id="screenWidth" value="{{screen_width}}">
+                        <input type="hidden" name="smooth" value="{{smooth_param}}">
+                        <input type="hidden" name="smooth_points" value="{{smooth_points_param}}">
+                        <input type="hidden" name="quality" value="{{quality_param}}">
                         <label for="range">📅 表示期間:</label>
                         <select name="range" onchange="updateWithScreenWidth(this.form)">
                             <option value="1h" {{'selected' if range_param=='1h' else ''}}>過去1時間</option>
@@ -730,38 +978,119 @@ def index():
                             <option value="3d" {{'selected' if range_param=='3d' else ''}}>過去3日間</option>
                             <option value="7d" {{'selected' if range_param=='7d' else ''}}>過去7日間</option>
                             <option value="30d" {{'selected' if range_param=='30d' else ''}}>過去30日間</option>
+                            <option value="90d" {{'selected' if range_param=='90d' else ''}}>過去90日間</option>
+                            <option value="1y" {{'selected' if range_param=='1y' else ''}}>過去1年間</option>
+                            % if from_param or to_param:
+                            <option value="custom" selected disabled>カスタム期間</option>
+                            % end
                         </select>
                     </form>
                     
                     <form method="get" id="aggregateForm">
                         <input type="hidden" name="range" value="{{range_param}}">
+                        <input type="hidden" name="from" value="{{from_param}}">
+                        <input type="hidden" name="to" value="{{to_param}}">
                         <input type="hidden" name="location" value="{{location_param}}">
                         <input type="hidden" name="width" id="screenWidth2" value="{{screen_width}}">
+                        <input type="hidden" name="smooth" value="{{smooth_param}}">
+                        <input type="hidden" name="smooth_points" value="{{smooth_points_param}}">
+                        <input type="hidden" name="quality" value="{{quality_param}}">
                         <label for="aggregate">📊 集計方法:</label>
                         <select name="aggregate" onchange="updateWithScreenWidth(this.form)">
                             <option value="raw" {{'selected' if aggregate_param=='raw' else ''}}>生データ</option>
+                            <option value="5m" {{'selected' if aggregate_param=='5m' else ''}}>5分平均</option>
+                            <option value="15m" {{'selected' if aggregate_param=='15m' else ''}}>15分平均</option>
                             <option value="hourly" {{'selected' if aggregate_param=='hourly' else ''}}>1時間平均</option>
+                            <option value="6h" {{'selected' if aggregate_param=='6h' else ''}}>6時間平均</option>
                             <option value="daily" {{'selected' if aggregate_param=='daily' else ''}}>1日平均</option>
+                            <option value="weekly" {{'selected' if aggregate_param=='weekly' else ''}}>1週間平均</option>
+                            % if aggregate_param not in ('raw', '5m', '15m', 'hourly', '6h', 'daily', 'weekly'):
+                            <option value="{{aggregate_param}}" selected>{{aggregate_text}}</option>
+                            % end
                         </select>
                     </form>
                     
                     <form method="get" id="locationForm">
                         <input type="hidden" name="range" value="{{range_param}}">
+                        <input type="hidden" name="from" value="{{from_param}}">
+                        <input type="hidden" name="to" value="{{to_param}}">
                         <input type="hidden" name="aggregate" value="{{aggregate_param}}">
                         <input type="hidden" name="width" id="screenWidth3" value="{{screen_width}}">
+                        <input type="hidden" name="smooth" value="{{smooth_param}}">
+                        <input type="hidden" name="smooth_points" value="{{smooth_points_param}}">
+                        <input type="hidden" name="quality" value="{{quality_param}}">
                         <label for="location">📍 センサー場所:</label>
                         <select name="location" onchange="updateWithScreenWidth(this.form)">
                             <option value="all" {{'selected' if location_param=='all' else ''}}>全ての場所</option>
                             % for loc in locations:
-                                <option value="{{loc}}" {{'selected' if location_param==loc else ''}}>{{loc}}</option>
+                                <option value="{{loc}}" {{'selected' if location_param==loc else ''}}>{{labels[loc]}}</option>
                             % end
                         </select>
+                        % if location_param == "all" and len(locations) > 1:
+                        <a href="/compare?range={{range_param}}&from={{from_param}}&to={{to_param}}&aggregate={{aggregate_param}}">📈 場所を比較</a>
+                        % end
+                    </form>
+                    
+                    <form method="get" id="smoothingForm">
+                        <input type="hidden" name="range" value="{{range_param}}">
+                        <input type="hidden" name="from" value="{{from_param}}">
+                        <input type="hidden" name="to" value="{{to_param}}">
+                        <input type="hidden" name="aggregate" value="{{aggregate_param}}">
+                        <input type="hidden" name="location" value="{{location_param}}">
+                        <input type="hidden" name="width" id="screenWidth5" value="{{screen_width}}">
+                        <input type="hidden" name="smooth_points" value="{{smooth_points_param}}">
+                        <input type="hidden" name="quality" value="{{quality_param}}">
+                        <label for="smooth">〰️ 平滑化:</label>
+                        <select name="smooth" onchange="updateWithScreenWidth(this.form)">
+                            <option value="none" {{'selected' if smooth_param=='none' else ''}}>なし</option>
+                            % for method, method_label in smoothing_methods.items():
+                            <option value="{{method}}" {{'selected' if smooth_param==method else ''}}>{{method_label}}</option>
+                            % end
+                        </select>
+                    </form>
+
+                    <form method="get" id="qualityForm">
+                        <input type="hidden" name="range" value="{{range_param}}">
+                        <input type="hidden" name="from" value="{{from_param}}">
+                        <input type="hidden" name="to" value="{{to_param}}">
+                        <input type="hidden" name="aggregate" value="{{aggregate_param}}">
+                        <input type="hidden" name="location" value="{{location_param}}">
+                        <input type="hidden" name="width" id="screenWidth6" value="{{screen_width}}">
+                        <input type="hidden" name="smooth" value="{{smooth_param}}">
+                        <input type="hidden" name="smooth_points" value="{{smooth_points_param}}">
+                        <label for="quality">🩺 品質:</label>
+                        <select name="quality" onchange="updateWithScreenWidth(this.form)">
+                            <option value="good" {{'selected' if quality_param!='all' else ''}}>正常値のみ</option>
+                            <option value="all" {{'selected' if quality_param=='all' else ''}}>フラグ付きも含める</option>
+                        </select>
+                    </form>
+                    
+                    <form method="get" id="customRangeForm">
+                        <input type="hidden" name="aggregate" value="{{aggregate_param}}">
+                        <input type="hidden" name="location" value="{{location_param}}">
+                        <input type="hidden" name="width" id="screenWidth4" value="{{screen_width}}">
+                        <input type="hidden" name="smooth" value="{{smooth_param}}">
+                        <input type="hidden" name="smooth_points" value="{{smooth_points_param}}">
+                        <input type="hidden" name="quality" value="{{quality_param}}">
+                        <label for="from">🗓️ 期間指定:</label>
+                        <input type="datetime-local" name="from" value="{{window_from}}">
+                        〜
+                        <input type="datetime-local" name="to" value="{{window_to}}">
+                        <button type="submit" onclick="updateWithScreenWidth(this.form); return false;">表示</button>
                     </form>
                 </div>
                 
+                % if notice:
+                <div class="update-info notice">{{notice}}</div>
+                % end
+                
                 <div class="update-info">
                     📈 データ数: {{statistics['count']}}件 | 
-                    集計方法: {{'生データ' if aggregate_param=='raw' else '1時間平均' if aggregate_param=='hourly' else '1日平均'}} |
+                    集計方法: {{aggregate_text}} |
+                    % if smoothing_text:
+                    平滑化: {{smoothing_text}} |
+                    % end
+                    期間: {{window_from.replace('T', ' ')}} 〜 {{window_to.replace('T', ' ')}} |
                     最終更新: {{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}} |
                     📍 場所: {{current_location}}
                     
@@ -774,31 +1103,45 @@ def index():
                     % end
                 </div>
                 
-                <!-- 統計カード -->
+                <!-- 統計カード（表示期間全体の統計） -->
                 <div class="stats">
+                    % for metric, title, css in [('temperature', '🌡️ 温度 (℃)', 'temp'), ('humidity', '💧 湿度 (%)', 'humidity'), ('soil_moisture', '🌱 土壌湿度 (%)', 'moisture')]:
                     <div class="stat-card">
-                        <div class="stat-title temp">🌡️ 温度 (℃)</div>
-                        <div class="stat-value temp">{{statistics['temperature']['avg']}}</div>
-                        <div class="stat-range">範囲: {{statistics['temperature']['min']}} ~ {{statistics['temperature']['max']}}</div>
-                    </div>
-                    <div class="stat-card">
-                        <div class="stat-title humidity">💧 湿度 (%)</div>
-                        <div class="stat-value humidity">{{statistics['humidity']['avg']}}</div>
-                        <div class="stat-range">範囲: {{statistics['humidity']['min']}} ~ {{statistics['humidity']['max']}}</div>
-                    </div>
-                    <div class="stat-card">
-                        <div class="stat-title moisture">🌱 土壌湿度 (%)</div>
-                        <div class="stat-value moisture">{{statistics['soil_moisture']['avg']}}</div>
-                        <div class="stat-range">範囲: {{statistics['soil_moisture']['min']}} ~ {{statistics['soil_moisture']['max']}}</div>
+                        <div class="stat-title {{css}}">{{title}}</div>
+                        <div class="stat-value {{css}}">{{statistics[metric]['avg']}}</div>
+                        <div class="stat-range">範囲: {{statistics[metric]['min']}} ~ {{statistics[metric]['max']}}</div>
+                        <div class="stat-detail">
+                            σ {{statistics[metric]['std']}} |
+                            p5/p50/p95: {{statistics[metric]['p5']}} / {{statistics[metric]['p50']}} / {{statistics[metric]['p95']}} |
+                            最新: {{statistics[metric]['last']}}
+                        </div>
                     </div>
+                    % end
                 </div>
                 
+                % if location_param != "all" and location_notes.get(location_param):
+                <div class="update-info">{{location_notes[location_param]}}</div>
+                % end
+                
                 <!-- グラフ表示部分 (修正版) -->
                 % if location_param == "all":
                     <!-- 全ての場所選択時: 場所別複合グラフを縦に並べる -->
                     % for location in locations:
                         <div class="location-chart-container">
-                            <h3 class="location-title">📍 {{location}}</h3>
+                            <h3 class="location-title">📍 {{labels[location]}}</h3>
+                            % loc_stats = location_statistics.get(location)
+                            % if loc_stats:
+                            <div class="location-stats">
+                                {{loc_stats['count']}}件 |
+                                🌡️ 平均 {{loc_stats['temperature']['avg']}}℃ ({{loc_stats['temperature']['min']}}~{{loc_stats['temperature']['max']}}) |
+                                💧 平均 {{loc_stats['humidity']['avg']}}% ({{loc_stats['humidity']['min']}}~{{loc_stats['humidity']['max']}}) |
+                                🌱 平均 {{loc_stats['soil_moisture']['avg']}}% ({{loc_stats['soil_moisture']['min']}}~{{loc_stats['soil_moisture']['max']}}) |
+                                最新 {{loc_stats['soil_moisture']['last']}}%
+                                % if location_notes.get(location):
+                                <br>{{location_notes[location]}}
+                                % end
+                            </div>
+                            % end
                             
                             <!-- 複合グラフ（温度・湿度・土壌湿度の3線） -->
                             <div class="chart-container">
@@ -814,9 +1157,63 @@ def index():
                     </div>
                 % end
                 
+                <!-- 詳細ビュー: ホイール/ピンチでズーム、ドラッグでパン。表示範囲のタイルだけ取得する -->
+                <div class="location-chart-container detail-container">
+                    <h3 class="location-title">🔍 詳細ビュー</h3>
+                    <div class="detail-controls">
+                        <select id="detailLocation">
+                            % for loc in locations:
+                                <option value="{{loc}}" {{'selected' if location_param==loc else ''}}>{{labels[loc]}}</option>
+                            % end
+                        </select>
+                        <button type="button" id="detailReset">全体表示</button>
+                        <span id="detailInfo"></span>
+                    </div>
+                    <div class="chart-container">
+                        <canvas id="detailChart"></canvas>
+                    </div>
+                </div>
+                
             </div>
             
             <script>
+                // 平滑化オーバーレイ（サーバー側で計算済みの系列を破線で重ねる）
+                const SMOOTHING_LABEL = {{!json.dumps(smoothing_text)}};
+                function smoothingDatasets(data) {
+                    if (!data.smoothed) return [];
+                    const lines = [
+                        ['🌡️ 温度', data.smoothed.temperature, '#c0392b'],
+                        ['💧 湿度', data.smoothed.humidity, '#2471a3'],
+                        ['🌱 土壌湿度', data.smoothed.soil_moisture, '#1e8449']
+                    ];
+                    return lines.map(([name, values, color]) => ({
+                        label: `${name} ${SMOOTHING_LABEL}`,
+                        data: values,
+                        borderColor: color,
+                        borderDash: [6, 4],
+                        borderWidth: 2,
+                        fill: false,
+                        tension: 0.3,
+                        pointRadius: 0,
+                        pointHoverRadius: 0
+                    }));
+                }
+
+                // 土壌湿度の予測線（サーバー側のモデルで計算済み）
+                function projectionDatasets(data) {
+                    if (!data.projection) return [];
+                    return [{
+                        label: '🔮 土壌湿度予測 (%)',
+                        data: data.projection,
+                        borderColor: '#8e44ad',
+                        borderDash: [2, 4],
+                        borderWidth: 2,
+                        fill: false,
+                        pointRadius: 0,
+                        pointHoverRadius: 4
+                    }];
+                }
+
                 // Chart.js グラフ生成ロジック (修正版)
                 function createLocationChart(canvasId, locationData, location) {
                     const ctx = document.getElementById(canvasId);
@@ -872,7 +1269,7 @@ def index():
                                         return value < 30 ? '#e74c3c' : '#27ae60';
                                     }
                                 }
-                            ]
+                            ].concat(smoothingDatasets(locationData), projectionDatasets(locationData))
                         },
                         options: {
                             responsive: true,
@@ -988,6 +1385,184 @@ def index():
                     });
                 }
 
+                // --- 詳細ビュー（ズーム・パンとタイル読み込み） ---
+                const TILE_SIZE = {{tile_size}};
+                const TILE_BUCKETS = {{json.dumps(tile_buckets)}};
+                const WEEK = 7 * 86400;
+                const WEEK_ORIGIN = 4 * 86400;
+                // 時刻はタイムゾーンなしの保存値をUTCとして扱ったミリ秒（表示もUTCの値をそのまま使う）
+                const DETAIL_START = {{window_start_ms}};
+                const DETAIL_END = {{window_end_ms}};
+                // 一括取り込みの世代（取り込み後は別の URL になり、ブラウザのキャッシュを使わない）
+                const DATA_GENERATION = {{data_generation}};
+                // タイルのクライアント側キャッシュ: "場所|バケット幅|タイル番号" → Promise
+                const tileCache = new Map();
+
+                function chooseBucket(spanMs, widthPx) {
+                    // 3px に1点程度になる最小のバケット幅
+                    const target = spanMs / 1000 / Math.max(widthPx / 3, 1);
+                    return TILE_BUCKETS.find(b => b >= target) || TILE_BUCKETS[TILE_BUCKETS.length - 1];
+                }
+
+                function fetchTile(location, bucket, index) {
+                    const key = `${location}|${bucket}|${index}`;
+                    if (!tileCache.has(key)) {
+                        const params = new URLSearchParams({location: location, bucket: `${bucket}s`, tile: index, v: DATA_GENERATION});
+                        const promise = fetch(`/api/tiles?${params}`).then(r => {
+                            if (!r.ok) throw new Error(`tile ${key}: ${r.status}`);
+                            return r.json();
+                        });
+                        promise.catch(() => tileCache.delete(key));
+                        tileCache.set(key, promise);
+                    }
+                    return tileCache.get(key);
+                }
+
+                async function loadVisibleTiles(chart) {
+                    const location = document.getElementById('detailLocation').value;
+                    const min = chart.scales.x.min, max = chart.scales.x.max;
+                    const bucket = chooseBucket(max - min, chart.width);
+                    const origin = bucket % WEEK === 0 ? WEEK_ORIGIN : 0;
+                    const span = bucket * TILE_SIZE;
+                    const first = Math.floor((min / 1000 - origin) / span);
+                    const last = Math.floor((max / 1000 - origin) / span);
+                    const cachedBefore = tileCache.size;
+                    const requested = [];
+                    for (let i = first; i <= last; i++) requested.push(fetchTile(location, bucket, i));
+                    const tiles = await Promise.all(requested);
+                    // 読み込み中に別の範囲へ移動していたら反映しない
+                    if (chart.scales.x.min !== min || chart.scales.x.max !== max) return;
+
+                    const series = {temperature: [], humidity: [], soil_moisture: []};
+                    tiles.forEach(tile => {
+                        tile.t.forEach((t, i) => {
+                            series.temperature.push({x: t, y: tile.temperature[i]});
+                            series.humidity.push({x: t, y: tile.humidity[i]});
+                            series.soil_moisture.push({x: t, y: tile.soil_moisture[i]});
+                        });
+                    });
+                    chart.data.datasets[0].data = series.temperature;
+                    chart.data.datasets[1].data = series.humidity;
+                    chart.data.datasets[2].data = series.soil_moisture;
+                    chart.update('none');
+
+                    const fetched = tileCache.size - cachedBefore;
+                    document.getElementById('detailInfo').textContent =
+                        `粒度: ${formatBucket(bucket)} | タイル: ${tiles.length}件（新規取得 ${fetched}件） | 点数: ${series.temperature.length}`;
+                }
+
+                function formatBucket(seconds) {
+                    if (seconds % WEEK === 0) return `${seconds / WEEK}週`;
+                    if (seconds % 86400 === 0) return `${seconds / 86400}日`;
+                    if (seconds % 3600 === 0) return `${seconds / 3600}時間`;
+                    return `${seconds / 60}分`;
+                }
+
+                function formatDetailTick(value, spanMs) {
+                    const iso = new Date(value).toISOString();
+                    if (spanMs <= 2 * 86400 * 1000) return iso.slice(11, 16);
+                    if (spanMs <= 90 * 86400 * 1000) return `${iso.slice(5, 10)} ${iso.slice(11, 13)}時`;
+                    return iso.slice(0, 10);
+                }
+
+                function createDetailChart() {
+                    const ctx = document.getElementById('detailChart');
+                    if (!ctx) return null;
+                    if (window.ChartZoom) Chart.register(window.ChartZoom);
+
+                    let timer;
+                    const scheduleLoad = ({chart}) => {
+                        clearTimeout(timer);
+                        timer = setTimeout(() => loadVisibleTiles(chart).catch(e => console.warn(e)), 150);
+                    };
+                    const dataset = (label, color) => ({
+                        label: label,
+                        data: [],
+                        borderColor: color,
+                        fill: false,
+                        tension: 0.2,
+                        pointRadius: 0,
+                        spanGaps: false
+                    });
+
+                    const chart = new Chart(ctx, {
+                        type: 'line',
+                        data: {
+                            datasets: [
+                                dataset('🌡️ 温度 (℃)', '#e74c3c'),
+                                dataset('💧 湿度 (%)', '#3498db'),
+                                dataset('🌱 土壌湿度 (%)', '#27ae60')
+                            ]
+                        },
+                        options: {
+                            responsive: true,
+                            maintainAspectRatio: false,
+                            animation: false,
+                            parsing: false,
+                            interaction: {
+                                intersect: false,
+                                mode: 'nearest',
+                                axis: 'x'
+                            },
+                            plugins: {
+                                legend: {
+                                    position: 'top',
+                                    labels: { usePointStyle: true }
+                                },
+                                tooltip: {
+                                    callbacks: {
+                                        title: items => items.length ? new Date(items[0].parsed.x).toISOString().slice(0, 16).replace('T', ' ') : ''
+                                    }
+                                },
+                                zoom: {
+                                    limits: {
+                                        x: { minRange: 30 * 60 * 1000 }
+                                    },
+                                    pan: {
+                                        enabled: true,
+                                        mode: 'x',
+                                        onPanComplete: scheduleLoad
+                                    },
+                                    zoom: {
+                                        wheel: { enabled: true },
+                                        pinch: { enabled: true },
+                                        drag: { enabled: true, modifierKey: 'shift' },
+                                        mode: 'x',
+                                        onZoomComplete: scheduleLoad
+                                    }
+                                }
+                            },
+                            scales: {
+                                x: {
+                                    type: 'linear',
+                                    min: DETAIL_START,
+                                    max: DETAIL_END,
+                                    ticks: {
+                                        maxTicksLimit: window.innerWidth < 768 ? 6 : 12,
+                                        callback: function(value) {
+                                            return formatDetailTick(value, this.max - this.min);
+                                        }
+                                    }
+                                },
+                                y: {
+                                    beginAtZero: true,
+                                    max: 100
+                                }
+                            }
+                        }
+                    });
+
+                    document.getElementById('detailLocation').addEventListener('change', () => scheduleLoad({chart}));
+                    document.getElementById('detailReset').addEventListener('click', () => {
+                        if (chart.resetZoom) chart.resetZoom();
+                        scheduleLoad({chart});
+                    });
+                    scheduleLoad({chart});
+                    return chart;
+                }
+
+                window.addEventListener('load', createDetailChart);
+
                 // 画面幅の検出と送信
                 function updateWithScreenWidth(form) {
                     const screenWidth = window.innerWidth;
@@ -1003,6 +1578,9 @@ def index():
                     document.getElementById('screenWidth').value = window.innerWidth;
                     document.getElementById('screenWidth2').value = window.innerWidth;
                     document.getElementById('screenWidth3').value = window.innerWidth;
+                    document.getElementById('screenWidth4').value = window.innerWidth;
+                    document.getElementById('screenWidth5').value = window.innerWidth;
+                    document.getElementById('screenWidth6').value = window.innerWidth;
                 });
                 
                 // 画面リサイズ時の対応
@@ -1099,7 +1677,7 @@ def index():
                                             return value < 30 ? '#e74c3c' : '#27ae60';
                                         }
                                     }
-                                ]
+                                ].concat(smoothingDatasets(chartData), projectionDatasets(chartData))
                             },
                             options: {
                                 responsive: true,
@@ -1237,15 +1815,20 @@ def index():
                         '24h': '24H',
                         '3d': '3D',
                         '7d': '7D',
-                        '30d': '30D'
+                        '30d': '30D',
+                        '90d': '90D',
+                        '1y': '1Y'
                     };
                     const aggregateText = {
                         'raw': 'RAW',
                         'hourly': 'H-AVG',
-                        'daily': 'D-AVG'
+                        'daily': 'D-AVG',
+                        'weekly': 'W-AVG'
                     };
+                    const rangeLabel = {{'true' if from_param or to_param else 'false'}} ? 'CUSTOM' : (rangeText['{{range_param}}'] || '{{range_param}}'.toUpperCase());
+                    const aggregateLabel = aggregateText['{{aggregate_param}}'] || '{{aggregate_param}}'.toUpperCase() + '-AVG';
                     
-                    document.title = `植物管理 - ${rangeText['{{range_param}}']} ${aggregateText['{{aggregate_param}}']} - ${time}`;
+                    document.title = `植物管理 - ${rangeLabel} ${aggregateLabel} - ${time}`;
                 }
                 
                 updateTitle();
@@ -1258,22 +1841,241 @@ def index():
                 console.log(`- Range: {{range_param}}`);
                 console.log(`- Aggregate: {{aggregate_param}}`);
                 console.log(`- Mobile mode: ${window.innerWidth < 768}`);
+                // サーバー側の処理時間（Server-Timing ヘッダー）
+                const navEntry = performance.getEntriesByType('navigation')[0];
+                if (navEntry && navEntry.serverTiming) {
+                    navEntry.serverTiming.forEach(t => {
+                        console.log(`- Server ${t.name}: ${t.duration.toFixed(1)}ms`);
+                    });
+                }
             </script>
         </body>
         </html>
-    ''', 
-    chart_data=chart_data,
-    range_param=range_param,
-    aggregate_param=aggregate_param,
-    location_param=location_param,
-    statistics=statistics,
-    current_location=current_location,
-    locations=locations,
-    screen_width=screen_width,
-    timestamps=timestamps if location_param != "all" else [],
-    len=len,
-    json=json,
-    datetime=datetime)
+        ''', 
+        chart_data=chart_data,
+        range_param=range_param,
+        aggregate_param=aggregate_param,
+        aggregate_text=timeseries.aggregate_label(aggregate_param, window.bucket),
+        from_param=from_param,
+        to_param=to_param,
+        window_from=window.start.strftime("%Y-%m-%dT%H:%M"),
+        window_to=window.end.strftime("%Y-%m-%dT%H:%M"),
+        notice=notice,
+        smooth_param=smooth_param,
+        smooth_points_param=smooth_points_param,
+        quality_param="all" if include_flagged else "good",
+        smoothing_methods=smoothing.METHODS,
+        smoothing_text=smoothing.label(*overlay) if overlay else "",
+        window_start_ms=window.start_epoch * 1000,
+        window_end_ms=window.end_epoch * 1000,
+        tile_size=tiles.TILE_SIZE,
+        tile_buckets=list(tiles.TILE_BUCKETS),
+        data_generation=data_generation,
+        location_param=location_param,
+        statistics=statistics,
+        location_statistics=location_statistics,
+        location_notes=location_notes,
+        current_location=current_location,
+        locations=locations,
+        labels=labels,
+        screen_width=screen_width,
+        timestamps=timestamps if location_param != "all" else [],
+        len=len,
+        json=json,
+        datetime=datetime)
+    return page
+
+def compare_params():
+    """/compare と /api/compare のクエリを検証して (メトリクス, Window) を返す。不正な値は ValueError"""
+    metric = request.query.metric or "soil_moisture"
+    if metric not in comparison.VARIABLES:
+        raise ValueError(f"metric must be one of {list(comparison.VARIABLES)}")
+    window = timeseries.resolve_window(request.query.range or "7d", request.query.aggregate or "raw",
+                                       request.query.get("from"), request.query.to)
+    return metric, comparison.comparison_window(window)
+
+def compare_data(cursor, table_name, window, metric, locations):
+    """場所ごとに重ねる1メトリクスの系列と、変数間・場所間の相関行列"""
+    aligned = comparison.load_aligned(cursor, table_name, window, locations)
+    variable = comparison.VARIABLES.index(metric)
+    return {
+        "timestamps": [timeseries.epoch_text(t) for t in aligned.grid.tolist()],
+        "series": {location: aggregation.to_list(aligned.values[i, variable], 2)
+                   for i, location in enumerate(aligned.locations)},
+        "variables": list(comparison.VARIABLES),
+        "correlation": comparison.matrix_list(comparison.variable_correlation(aligned)),
+        "locations": aligned.locations,
+        "location_correlation": comparison.matrix_list(comparison.location_correlation(aligned, metric)),
+    }
+
+@route('/compare')
+def compare():
+    """1つのメトリクスを全場所で重ねたグラフと相関行列"""
+    try:
+        metric, window = compare_params()
+    except ValueError as e:
+        response.status = 400
+        return str(e)
+    range_param = request.query.range or "7d"
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        table_name = resolve_table_name(cursor)
+        prepare_sources(conn, table_name)
+        locations = list_locations(cursor, table_name)
+        data = compare_data(cursor, table_name, window, metric, locations)
+    finally:
+        conn.close()
+    data["labels"] = [format_timestamp(ts, window.format_type(), window.range_key, len(data["timestamps"]))
+                      for ts in data["timestamps"]]
+
+    with timed("render"):
+        page = template('''
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <meta charset="UTF-8">
+            <meta name="viewport" content="width=device-width, initial-scale=1.0">
+            <title>🌱 場所の比較</title>
+            <script src="https://cdn.jsdelivr.net/npm/chart.js"></script>
+            <style>
+                body { font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; margin: 0;
+                       background: #f8f9fa; color: #2c3e50; }
+                .container { max-width: 1200px; margin: 0 auto; padding: 20px; }
+                .panel { background: #fff; padding: 1.5rem; border-radius: 12px; margin-bottom: 1.5rem;
+                         box-shadow: 0 2px 4px rgba(0,0,0,0.1); }
+                .controls { display: flex; flex-wrap: wrap; gap: 1rem; align-items: center; }
+                .chart-container { position: relative; height: 420px; }
+                table.matrix { border-collapse: collapse; font-size: 0.85rem; }
+                table.matrix th, table.matrix td { padding: 0.3rem 0.5rem; text-align: center; border: 1px solid #ecf0f1; }
+                .matrix-scroll { overflow-x: auto; }
+            </style>
+        </head>
+        <body>
+            <div class="container">
+                <div class="panel controls">
+                    <a href="/?range={{range_param}}&location=all">← ダッシュボード</a>
+                    <form method="get">
+                        <input type="hidden" name="from" value="{{request.query.get('from') or ''}}">
+                        <input type="hidden" name="to" value="{{request.query.to or ''}}">
+                        <label>📏 メトリクス:</label>
+                        <select name="metric" onchange="this.form.submit()">
+                            % for name in variables:
+                            <option value="{{name}}" {{'selected' if name == metric else ''}}>{{variable_labels[name]}}</option>
+                            % end
+                        </select>
+                        <label>📅 期間:</label>
+                        <select name="range" onchange="this.form.submit()">
+                            % for key in ('24h', '3d', '7d', '30d', '90d', '1y'):
+                            <option value="{{key}}" {{'selected' if key == range_param else ''}}>{{key}}</option>
+                            % end
+                        </select>
+                        <input type="hidden" name="aggregate" value="{{bucket_text}}">
+                    </form>
+                    <span>📊 {{bucket_text}}平均 × {{len(data['locations'])}}か所</span>
+                </div>
+
+                <div class="panel">
+                    <div class="chart-container"><canvas id="compareChart"></canvas></div>
+                </div>
+
+                <div class="panel matrix-scroll">
+                    <h3>🔗 変数間の相関（場所ごとの平均を引いて全場所をまとめたもの）</h3>
+                    <table class="matrix" id="variableMatrix"></table>
+                </div>
+
+                <div class="panel matrix-scroll">
+                    <h3>🔗 場所間の相関（{{variable_labels[metric]}}）</h3>
+                    <table class="matrix" id="locationMatrix"></table>
+                </div>
+            </div>
+
+            <script>
+                const data = {{!json.dumps(data)}};
+                const variableLabels = {{!json.dumps(variable_labels)}};
+
+                // 場所の数に応じて色相を等間隔に割り当てる
+                function color(i, n, alpha) {
+                    return `hsla(${Math.round(360 * i / Math.max(n, 1))}, 65%, 45%, ${alpha})`;
+                }
+
+                new Chart(document.getElementById('compareChart'), {
+                    type: 'line',
+                    data: {
+                        labels: data.labels,
+                        datasets: data.locations.map((location, i) => ({
+                            label: location,
+                            data: data.series[location],
+                            borderColor: color(i, data.locations.length, 1),
+                            backgroundColor: color(i, data.locations.length, 0.1),
+                            borderWidth: data.locations.length > 10 ? 1 : 2,
+                            pointRadius: 0,
+                            spanGaps: false
+                        }))
+                    },
+                    options: {
+                        responsive: true,
+                        maintainAspectRatio: false,
+                        animation: false,
+                        interaction: { mode: 'nearest', intersect: false },
+                        plugins: { legend: { display: data.locations.length <= 20 } }
+                    }
+                });
+
+                // 相関係数 -1〜1 を青〜赤の背景色で表示する
+                function renderMatrix(tableId, names, matrix) {
+                    const rows = [`<tr><th></th>${names.map(n => `<th>${n}</th>`).join('')}</tr>`];
+                    matrix.forEach((row, i) => {
+                        const cells = row.map(v => {
+                            if (v === null) return '<td>–</td>';
+                            const hue = v >= 0 ? 0 : 210;
+                            return `<td style="background: hsla(${hue}, 70%, 50%, ${Math.abs(v) * 0.6})">${v.toFixed(2)}</td>`;
+                        });
+                        rows.push(`<tr><th>${names[i]}</th>${cells.join('')}</tr>`);
+                    });
+                    document.getElementById(tableId).innerHTML = rows.join('');
+                }
+                renderMatrix('variableMatrix', data.variables.map(v => variableLabels[v]), data.correlation);
+                renderMatrix('locationMatrix', data.locations, data.location_correlation);
+            </script>
+        </body>
+        </html>
+        ''',
+        data=data,
+        metric=metric,
+        variables=comparison.VARIABLES,
+        variable_labels=comparison.VARIABLE_LABELS,
+        range_param=range_param,
+        bucket_text=timeseries.bucket_label(window.bucket),
+        request=request,
+        len=len,
+        json=json)
+    return page
+
+@route('/api/compare')
+def api_compare():
+    """1つのメトリクスを共通のバケットに揃えた場所別の系列と相関行列"""
+    response.content_type = 'application/json'
+    try:
+        metric, window = compare_params()
+    except ValueError as e:
+        response.status = 400
+        return json.dumps({"error": str(e)}, ensure_ascii=False)
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        table_name = resolve_table_name(cursor)
+        prepare_sources(conn, table_name)
+        locations = list_locations(cursor, table_name)
+        if request.query.locations:
+            requested = request.query.locations.split(",")
+            locations = [location for location in locations if location in requested]
+        body = compare_data(cursor, table_name, window, metric, locations)
+    finally:
+        conn.close()
+    body["metadata"] = {"metric": metric, "range": request.query.range or "7d", **window.metadata()}
+    with timed("json"):
+        return json.dumps(body, ensure_ascii=False)
 
 @route('/api/data')
 def api_data():
@@ -1282,73 +2084,545 @@ def api_data():
     aggregate_param = request.query.aggregate or "raw"
     location_param = request.query.location or "all"
     screen_width = int(request.query.width or "1200")
-    
-    time_conditions = {
-        "1h": "datetime('now', '-1 hours')",
-        "6h": "datetime('now', '-6 hours')",
-        "12h": "datetime('now', '-12 hours')",
-        "24h": "datetime('now', '-1 days')",
-        "3d": "datetime('now', '-3 days')",
-        "7d": "datetime('now', '-7 days')",
-        "30d": "datetime('now', '-30 days')"
-    }
-    
-    time_condition = time_conditions.get(range_param, time_conditions["24h"])
-    
-    conn = sqlite3.connect("sensor_data.db")
+
+    response.content_type = 'application/json'
+    try:
+        window = timeseries.resolve_window(range_param, aggregate_param, request.query.get("from"), request.query.to)
+        overlay = smoothing.parse_smoothing(request.query.smooth, request.query.smooth_points)
+        if overlay is not None and request.query.stream == "1":
+            raise ValueError("smooth is not available with stream=1")
+    except ValueError as e:
+        response.status = 400
+        return json.dumps({"error": str(e)}, ensure_ascii=False)
+
+    conn = get_connection()
     cursor = conn.cursor()
-    
-    # テーブル名を確認して適切なものを使用
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-    tables = [row[0] for row in cursor.fetchall()]
-    
-    table_name = "sensor_data"
-    if "sensor_data" in tables:
-        table_name = "sensor_data"
-    elif "sensro_data" in tables:
-        table_name = "sensro_data"
-    
-    # センサー場所によるフィルター条件を追加
-    location_condition = ""
-    if location_param != "all":
-        location_condition = f" AND sensor_location = '{location_param}'"
-    
-    cursor.execute(f'''
-        SELECT timestamp, temperature, humidity, soil_moisture
-        FROM {table_name}
-        WHERE timestamp >= {time_condition}{location_condition}
-        ORDER BY timestamp ASC
-    ''')
-    
-    rows = cursor.fetchall()
+    table_name = resolve_table_name(cursor)
+    prepare_sources(conn, table_name)
+    location = None if location_param == "all" else location_param
+    metadata = {
+        "range": range_param,
+        "aggregate": aggregate_param,
+        "location": location_param,
+        "screen_width": screen_width,
+        **window.metadata(),
+    }
+    include_flagged = request.query.quality == "all"
+    metadata["quality"] = "all" if include_flagged else "good"
+    if request.query.stream == "1":
+        # チャンク単位で読み出して逐次出力する（接続はジェネレーター側で閉じる）
+        return stream_api_data(conn, cursor, table_name, window, location, metadata, screen_width,
+                               MemoryTracker(), request.route.rule, include_flagged)
+
+    builder = load_series(cursor, table_name, window, location, with_stats=False, include_flagged=include_flagged)
     conn.close()
-    
+
     # 高度な時間フォーマット適用
-    data_count = len(rows)
-    formatted_timestamps = []
-    
-    for r in rows:
-        formatted_time = format_timestamp(r[0], aggregate_param, range_param, data_count, screen_width)
-        formatted_timestamps.append(formatted_time)
-    
+    chart = builder.chart_data(screen_width, overlay)
+    data_count = len(chart['labels'])
+
     data = {
-        "timestamps": formatted_timestamps,
-        "raw_timestamps": [r[0] for r in rows],
-        "temperatures": [r[1] for r in rows],
-        "humidities": [r[2] for r in rows],
-        "moistures": [r[3] for r in rows],
+        "timestamps": chart['labels'],
+        "raw_timestamps": builder.raw_timestamps(),
+        "temperatures": chart['temperature'],
+        "humidities": chart['humidity'],
+        "moistures": chart['soil_moisture'],
         "metadata": {
-            "range": range_param,
-            "aggregate": aggregate_param,
-            "location": location_param,
+            **metadata,
             "data_count": data_count,
-            "screen_width": screen_width,
-            "format_info": get_optimal_time_format(range_param, aggregate_param, data_count, screen_width)
+            "format_info": get_optimal_time_format(window.range_key, window.format_type(), data_count, screen_width),
         }
     }
+    if overlay is not None:
+        smoothed = chart['smoothed']
+        data["smoothed"] = {
+            "method": overlay[0],
+            "points": overlay[1],
+            "temperatures": smoothed['temperature'],
+            "humidities": smoothed['humidity'],
+            "moistures": smoothed['soil_moisture'],
+        }
     
+    with timed("json"):
+        body = json.dumps(data, ensure_ascii=False, indent=2)
+    return body
+
+# ストリーミングモードで1回に読み出す行数
+STREAM_CHUNK = 2000
+STREAM_COLUMNS = ["timestamp", "raw_timestamp", "temperature", "humidity", "soil_moisture"]
+
+def merge_chunks(cursors, size=STREAM_CHUNK):
+    """時刻順の行を返すカーソル（先頭の列が時刻文字列）を、時刻順にまとめてチャンクごとに返す
+
+    各カーソルから size 行ずつ読み、全てのカーソルで読み終えた時刻（各カーソルの読んだ最後の行の
+    時刻の最小値）までの行だけを並べ替えて返す。整列済みの連なりのマージなので速く、メモリは
+    カーソル数 × size 行で済む。
+    """
+    readers = [[cursor, rows] for cursor in cursors for rows in [cursor.fetchmany(size)] if rows]
+    while readers:
+        frontier = min(rows[-1][0] for _, rows in readers)
+        merged = []
+        for reader in readers:
+            cursor, rows = reader
+            cut = bisect_right([row[0] for row in rows], frontier)
+            merged.extend(rows[:cut])
+            reader[1] = rows[cut:] or cursor.fetchmany(size)
+        readers = [reader for reader in readers if reader[1]]
+        merged.sort(key=itemgetter(0))
+        yield merged
+
+def stream_api_data(conn, cursor, table_name, window, location, metadata, screen_width, memory, route_name,
+                    include_flagged=False):
+    """/api/data?stream=1 の本文を生成する
+
+    5本の並列リストを作らず、1行 = [表示用時刻, 時刻, 温度, 湿度, 土壌湿度] の
+    配列として STREAM_CHUNK 行ずつJSONを出力する。メモリ使用量は末尾の "memory" に入る。
+    """
+    format_type = window.format_type()
+    try:
+        if window.bucket is None:
+            start_text, (archived_ts, archived_values) = archived_columns(cursor, window, location, include_flagged)
+            names = [location] if location is not None else locations.names(cursor.connection)
+            location_ids = [location_id(cursor, name) for name in names]
+            interval = gap_interval(cursor, location)
+
+            def row_chunks(columns):
+                # アーカイブ済みの月の行を先に、続けて sensor_data の行を返す
+                for i in range(0, len(archived_ts), STREAM_CHUNK):
+                    texts = [timeseries.epoch_text(t) for t in archived_ts[i:i + STREAM_CHUNK].tolist()]
+                    if not columns:
+                        yield [(text,) for text in texts]
+                        continue
+                    yield list(zip(texts, *(aggregation.to_list(column[i:i + STREAM_CHUNK])
+                                            for column in archived_values)))
+                # 場所ごとに (location_id, timestamp) 索引の順に読み、時刻順にマージする
+                # （全ての場所でも ORDER BY timestamp の並べ替えをしない）
+                readers = []
+                for loc_id in location_ids:
+                    reader = conn.cursor()
+                    reader.execute(f'''
+                        SELECT timestamp{columns} FROM {table_name}
+                        WHERE location_id = ? AND timestamp >= ? AND timestamp < ?
+                        ORDER BY timestamp
+                    ''', (loc_id, start_text, window.end_text()))
+                    readers.append(reader)
+                yield from merge_chunks(readers)
+
+            def breaks(chunks):
+                """チャンクごとに (行, [(欠測の行を挟む位置, 直前の点のUNIX秒), ...]) を返す
+                （チャンクの境目も前のチャンクの最後と比べる）"""
+                previous = None
+                for rows in chunks:
+                    ts = aggregation.epochs_from_text([row[0] for row in rows])
+                    if previous is not None:
+                        ts = np.concatenate(([previous], ts))
+                    offset = 0 if previous is None else 1
+                    yield rows, [(position - offset, ts[position - 1])
+                                 for position in gaps.break_positions(ts, interval * gaps.GAP_FACTOR)]
+                    previous = ts[-1]
+
+            # 表示用時刻の形式は出力する行数（欠測の行を含む）で決まるため、先に索引だけで数える
+            data_count = sum(len(rows) + len(found) for rows, found in breaks(row_chunks("")))
+            columns = ", " + anomalies.masked_columns(include_flagged)
+
+            def chunks():
+                for rows, found in breaks(row_chunks(columns)):
+                    # 欠測区間には値のない行を挟む
+                    for position, before in reversed(found):
+                        rows.insert(position, (timeseries.epoch_text(int(before + interval)), None, None, None))
+                    yield rows
+        else:
+            # バケット集計済みの系列は件数が小さいのでまとめて作る
+            builder = load_series(cursor, table_name, window, location, with_stats=False,
+                                  include_flagged=include_flagged)
+            raw_timestamps = builder.raw_timestamps()
+            data_count = len(raw_timestamps)
+
+            def chunks():
+                for i in range(0, data_count, STREAM_CHUNK):
+                    yield list(zip(raw_timestamps[i:i + STREAM_CHUNK],
+                                   *(column[i:i + STREAM_CHUNK] for column in builder.columns)))
+
+        metadata = {
+            **metadata,
+            "data_count": data_count,
+            "format_info": get_optimal_time_format(window.range_key, format_type, data_count, screen_width),
+        }
+        yield ('{"metadata": %s, "columns": %s, "rows": [\n'
+               % (json.dumps(metadata, ensure_ascii=False), json.dumps(STREAM_COLUMNS))).encode("utf-8")
+        separator = ""
+        for rows in chunks():
+            lines = [
+                json.dumps([format_timestamp(ts, format_type, window.range_key, data_count, screen_width), ts, t, h, m])
+                for ts, t, h, m in rows
+            ]
+            yield (separator + ",\n".join(lines)).encode("utf-8")
+            separator = ",\n"
+            memory.sample()
+    finally:
+        conn.close()
+    memory.sample()
+    observe_memory(route_name, memory)
+    yield ('\n], "memory": %s}\n' % json.dumps(memory.report())).encode("utf-8")
+
+def load_tile(location, bucket, index):
+    """1タイル分の平均値系列（時刻はUNIXミリ秒）"""
+    start, end = tiles.tile_range(bucket, index)
+    window = timeseries.Window(
+        timeseries.epoch_datetime(start), timeseries.epoch_datetime(end), bucket, "30d")
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        table_name = resolve_table_name(cursor)
+        prepare_sources(conn, table_name)
+        builder = load_series(cursor, table_name, window, location, with_stats=False)
+    finally:
+        conn.close()
+    return {
+        "bucket": bucket,
+        "tile": index,
+        "start": start * 1000,
+        "end": end * 1000,
+        "t": [timeseries.timestamp_epoch(ts) * 1000 for ts in builder.raw_timestamps()],
+        "temperature": builder.columns[0],
+        "humidity": builder.columns[1],
+        "soil_moisture": builder.columns[2],
+    }
+
+@route('/api/tiles')
+def api_tiles():
+    """ズーム・パン用のタイル（場所・バケット幅・タイル番号で固定の範囲）"""
+    location_param = request.query.location or "all"
+    response.content_type = 'application/json'
+    try:
+        bucket = timeseries.parse_bucket(request.query.bucket or "1h")
+    except ValueError as e:
+        response.status = 400
+        return json.dumps({"error": str(e)}, ensure_ascii=False)
+    try:
+        index = int(request.query.tile)
+    except ValueError:
+        response.status = 400
+        return json.dumps({"error": "tile must be an integer"})
+    if bucket not in tiles.TILE_BUCKETS:
+        response.status = 400
+        return json.dumps({"error": f"bucket must be one of {[timeseries.bucket_label(b) for b in tiles.TILE_BUCKETS]}"})
+
+    location = None if location_param == "all" else location_param
+    # 終了済みのタイルは一括取り込み（bulk_import.py）が無い限り不変なので、取り込みの世代をキーに含めて
+    # 期限なしでキャッシュし、ブラウザにも長期キャッシュさせる（ページは URL に世代 v を付ける）
+    now = rollups.naive_epoch(datetime.now())
+    complete = tiles.tile_range(bucket, index)[1] <= now
+    ttl = None if complete else tiles.OPEN_TILE_TTL
+    conn = get_connection()
+    try:
+        generation = bulk_import.generation(conn)
+    finally:
+        conn.close()
+    tile, hit = tiles.CACHE.get_or_load(
+        (location, bucket, index, generation), lambda: load_tile(location, bucket, index), ttl)
+
+    response.set_header('Cache-Control', 'public, max-age=31536000, immutable' if complete else f'max-age={tiles.OPEN_TILE_TTL}')
+    response.set_header('X-Tile-Cache', 'hit' if hit else 'miss')
+    with timed("json"):
+        body = json.dumps(tile, separators=(",", ":"))
+    return body
+
+@route('/api/export')
+def api_export():
+    """期間・場所を指定して sensor_data を CSV / Parquet / Arrow でストリーミング出力"""
+    location_param = request.query.location or "all"
+    fmt = request.query.format or "csv"
+    try:
+        content_type, extension = export.check_format(fmt)
+        window = timeseries.resolve_window(request.query.range or "24h", "raw", request.query.get("from"), request.query.to)
+    except ValueError as e:
+        response.status = 400
+        response.content_type = 'application/json'
+        return json.dumps({"error": str(e)}, ensure_ascii=False)
+
+    conn = get_connection()
+    cursor = conn.cursor()
+    table_name = resolve_table_name(cursor)
+    rollups.ensure_index(conn, table_name)
+    anomalies.ensure_column(conn, table_name)
+    names = locations.names(conn) if location_param == "all" else [location_param]
+    # 場所名は行ごとに持たないので、場所ごとの問い合わせで定数として出力する
+    columns = ", ".join("? AS sensor_location" if column == "sensor_location" else column for column in export.COLUMNS)
+
+    cutoff = archive.cutoff(conn)
+    archived = cutoff is not None and window.start_epoch < cutoff
+    start_text = window.start_text()
+    if archived:
+        start_text = timeseries.epoch_text(cutoff) if window.end_epoch > cutoff else window.end_text()
+
+    def chunks():
+        # 場所ごとに (location_id, timestamp) 索引の範囲走査で読み出す（ソート用の一時領域を使わない）
+        try:
+            for name in names:
+                if archived:
+                    yield from export.archived_chunks(name, *archive.load(
+                        conn, [location_id(cursor, name)], window.start_epoch, min(window.end_epoch, cutoff)))
+                yield from export.iter_chunks(cursor, f'''
+                    SELECT {columns}
+                    FROM {table_name}
+                    WHERE location_id = ? AND timestamp >= ? AND timestamp < ?
+                    ORDER BY timestamp ASC
+                ''', (name, location_id(cursor, name), start_text, window.end_text()))
+        finally:
+            conn.close()
+
+    filename = f"sensor_data_{location_param}_{window.start:%Y%m%d%H%M}-{window.end:%Y%m%d%H%M}.{extension}"
+    response.content_type = content_type
+    response.set_header('Content-Disposition', f'attachment; filename="{filename}"')
+    return export.stream(chunks(), fmt)
+
+@route('/api/watering')
+def api_watering():
+    """場所別の水やり状態（最後の水やり・乾燥速度・閾値までの予測時間）と期間内の水やり"""
     response.content_type = 'application/json'
-    return json.dumps(data, ensure_ascii=False, indent=2)
+    location_param = request.query.location or "all"
+    try:
+        threshold = float(request.query.threshold) if request.query.threshold else None
+    except ValueError:
+        response.status = 400
+        return json.dumps({"error": "threshold must be a number"})
+    try:
+        window = timeseries.resolve_window(request.query.range or "30d", "raw", request.query.get("from"), request.query.to)
+    except ValueError as e:
+        response.status = 400
+        return json.dumps({"error": str(e)}, ensure_ascii=False)
+
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        table_name = resolve_table_name(cursor)
+        prepare_sources(conn, table_name)
+        location = None if location_param == "all" else location_param
+        if location is None:
+            locations = [row[0] for row in cursor.execute("SELECT sensor_location FROM watering_scan ORDER BY sensor_location")]
+        else:
+            locations = [location]
+        body = {
+            "status": [watering.status(conn, loc, threshold=threshold) for loc in locations],
+            "events": watering.events(conn, location, window.start_epoch, window.end_epoch),
+            "metadata": {"location": location_param, **window.metadata()},
+        }
+    finally:
+        conn.close()
+    with timed("json"):
+        return json.dumps(body, ensure_ascii=False, indent=2)
+
+@route('/api/gaps')
+def api_gaps():
+    """期間内の欠測区間（想定の記録間隔から、読み取りが途切れていた区間を場所別に求める）"""
+    response.content_type = 'application/json'
+    location_param = request.query.location or "all"
+    try:
+        window = timeseries.resolve_window(request.query.range or "7d", "raw", request.query.get("from"), request.query.to)
+    except ValueError as e:
+        response.status = 400
+        return json.dumps({"error": str(e)}, ensure_ascii=False)
+
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        table_name = resolve_table_name(cursor)
+        prepare_sources(conn, table_name)
+        locations = gap_locations(cursor, location_param)
+        refresh_gaps(conn, table_name, locations)
+        now_epoch = rollups.naive_epoch(datetime.now())
+        body = {
+            "gaps": [gap for location in locations
+                     for gap in gaps.find_gaps(conn, location, window.start_epoch, window.end_epoch, now_epoch)],
+            "metadata": {"location": location_param, "sample_interval_seconds": gaps.SAMPLE_INTERVAL,
+                         "gap_seconds": gaps.GAP_SECONDS, **window.metadata()},
+        }
+    finally:
+        conn.close()
+    with timed("json"):
+        return json.dumps(body, ensure_ascii=False, indent=2)
+
+@route('/api/uptime')
+def api_uptime():
+    """場所別の稼働状況と 24h / 7d / 30d の稼働率"""
+    response.content_type = 'application/json'
+    location_param = request.query.location or "all"
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        table_name = resolve_table_name(cursor)
+        prepare_sources(conn, table_name)
+        locations = gap_locations(cursor, location_param)
+        refresh_gaps(conn, table_name, locations)
+        now_epoch = rollups.naive_epoch(datetime.now())
+        body = {"uptime": [gaps.report(conn, location, now_epoch) for location in locations]}
+    finally:
+        conn.close()
+    with timed("json"):
+        return json.dumps(body, ensure_ascii=False, indent=2)
+
+def gap_locations(cursor, location_param):
+    if location_param != "all":
+        return [location_param]
+    return [row[0] for row in cursor.execute("SELECT sensor_location FROM gap_scan ORDER BY sensor_location")]
+
+@route('/api/locations')
+def api_locations():
+    """登録されている場所と設定（表示名・植物の種類・乾燥の閾値・校正値・記録間隔）"""
+    response.content_type = 'application/json'
+    conn = get_connection()
+    try:
+        rollups.ensure_index(conn, resolve_table_name(conn.cursor()))
+        registry = locations.registry(conn)
+        body = {"locations": [registry.get(name).to_dict() for name in registry.names()]}
+    finally:
+        conn.close()
+    return json.dumps(body, ensure_ascii=False, indent=2)
+
+@route('/api/locations/<name>', method='PUT')
+def api_update_location(name):
+    """場所の設定を更新する（未登録なら登録する）。本文は設定項目のJSON"""
+    response.content_type = 'application/json'
+    fields = request.json
+    if not isinstance(fields, dict):
+        response.status = 400
+        return json.dumps({"error": "request body must be a JSON object"})
+    conn = get_connection()
+    try:
+        rollups.ensure_index(conn, resolve_table_name(conn.cursor()))
+        location = locations.configure(conn, name, **fields)
+        conn.commit()
+    except (ValueError, TypeError, sqlite3.Error) as e:
+        response.status = 400
+        return json.dumps({"error": str(e)}, ensure_ascii=False)
+    finally:
+        conn.close()
+    return json.dumps(location.to_dict(), ensure_ascii=False, indent=2)
+
+@route('/api/anomalies')
+def api_anomalies():
+    """期間内に品質フラグ（外れ値・固着・あり得ない値・センサー間の矛盾）が付いた読み取り値"""
+    response.content_type = 'application/json'
+    location_param = request.query.location or "all"
+    try:
+        window = timeseries.resolve_window(request.query.range or "7d", "raw", request.query.get("from"), request.query.to)
+    except ValueError as e:
+        response.status = 400
+        return json.dumps({"error": str(e)}, ensure_ascii=False)
+
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        table_name = resolve_table_name(cursor)
+        prepare_sources(conn, table_name)
+        location = None if location_param == "all" else location_param
+        body = {
+            "anomalies": anomalies.flagged(conn, table_name, location, window.start_epoch, window.end_epoch),
+            "metadata": {"location": location_param, "action": anomalies.ANOMALY_ACTION, **window.metadata()},
+        }
+    finally:
+        conn.close()
+    with timed("json"):
+        return json.dumps(body, ensure_ascii=False, indent=2)
+
+@route('/api/forecast')
+def api_forecast():
+    """場所別の土壌湿度予測（閾値を下回る予測時刻と予測線）"""
+    response.content_type = 'application/json'
+    location_param = request.query.location or "all"
+    try:
+        threshold = float(request.query.threshold) if request.query.threshold else None
+        horizon = float(request.query.hours or "48")
+    except ValueError:
+        response.status = 400
+        return json.dumps({"error": "threshold and hours must be numbers"})
+    if not 0 < horizon <= forecasting.MAX_HORIZON_HOURS:
+        response.status = 400
+        return json.dumps({"error": f"hours must be between 0 and {forecasting.MAX_HORIZON_HOURS}"})
+
+    conn = get_connection()
+    try:
+        cursor = conn.cursor()
+        table_name = resolve_table_name(cursor)
+        prepare_sources(conn, table_name)
+        if location_param == "all":
+            locations = [row[0] for row in cursor.execute("SELECT sensor_location FROM forecast_models ORDER BY sensor_location")]
+        else:
+            locations = [location_param]
+        results = []
+        for location in locations:
+            result = forecasting.forecast(conn, location, threshold, horizon)
+            result["projection"] = [[timeseries.epoch_text(t), value] for t, value in result["projection"]]
+            results.append(result)
+    finally:
+        conn.close()
+    with timed("json"):
+        return json.dumps({"forecasts": results}, ensure_ascii=False, indent=2)
+
+@route('/api/metrics')
+def api_metrics():
+    """ルート別・フェーズ別の処理時間ヒストグラム"""
+    response.content_type = 'application/json'
+    return json.dumps(timing_snapshot(), ensure_ascii=False, indent=2)
+
+@route('/api/percentiles')
+def api_percentiles():
+    """場所別の分位点（時間・日単位の t-digest をマージして算出）"""
+    response.content_type = 'application/json'
+    range_param = request.query.range or "30d"
+    try:
+        window = timeseries.resolve_window(range_param, "raw", request.query.get("from"), request.query.to)
+    except ValueError as e:
+        response.status = 400
+        return json.dumps({"error": str(e)}, ensure_ascii=False)
+    location_param = request.query.location or "all"
+    try:
+        quantiles = [float(q) for q in (request.query.q or "5,50,95").split(",")]
+    except ValueError:
+        response.status = 400
+        return json.dumps({"error": "q must be a comma-separated list of percentiles"})
+    metrics_param = [m for m in (request.query.metrics or ",".join(sketches.METRICS)).split(",") if m in sketches.METRICS]
+
+    conn = get_connection()
+    try:
+        sketches.ensure_built(conn, resolve_table_name(conn.cursor()))
+        merged = sketches.load_merged(conn, window.start, window.end,
+                                      None if location_param == "all" else location_param, metrics_param)
+    finally:
+        conn.close()
+
+    result = {}
+    for location, digests in sorted(merged.items()):
+        result[location] = {}
+        for metric, digest in digests.items():
+            values = {f"p{q:g}": round(digest.quantile(q / 100), 2) for q in quantiles}
+            values["count"] = int(digest.total)
+            result[location][metric] = values
+
+    with timed("json"):
+        body = json.dumps({
+            "range": None if request.query.get("from") or request.query.to else range_param,
+            "from": window.start.isoformat(timespec="seconds"),
+            "to": window.end.isoformat(timespec="seconds"),
+            "percentiles": result,
+        }, ensure_ascii=False, indent=2)
+    return body
+
+@route('/metrics')
+def prometheus_metrics():
+    """Prometheus テキスト形式のメトリクス（ダッシュボード + ロガー）"""
+    sources = [("dashboard", metrics.REGISTRY.expose())]
+    # ロガーはcron実行のため、最後に書き出したファイルを読む。両方のプロセスが持つメトリクス
+    # （DBメンテナンス等）は process ラベルで区別して1つのメトリクスにまとめる
+    try:
+        with open(metrics.LOGGER_TEXTFILE) as f:
+            sources.append(("logger", f.read()))
+    except OSError:
+        pass
+    body = metrics.merge_expositions(sources)
+    response.content_type = 'text/plain; version=0.0.4; charset=utf-8'
+    return body
 
 @route('/api/format-test')
 def format_test():
@@ -1380,4 +2654,17 @@ if __name__ == '__main__':
     print("🎯 新機能:")
     print("   📊 全ての場所 → 場所別グラフが縦に並ぶ")
     print("   📍 個別場所 → 従来通り単一グラフセット")
+    # 直近期間のホットキャッシュを起動時に読み込んでおく
+    if hotcache.CACHE.enabled:
+        conn = get_connection()
+        try:
+            prepare_sources(conn, resolve_table_name(conn.cursor()))
+            print(f"   🔥 ホットキャッシュ: 直近{hotcache.CACHE.days:g}日 {hotcache.CACHE.size():,}行")
+        except sqlite3.OperationalError as e:
+            print(f"   ⚠️ ホットキャッシュを読み込めませんでした: {e}")
+        finally:
+            conn.close()
+    if MAINTENANCE.enabled:
+        MAINTENANCE.start()
+        print(f"   🧹 DBメンテナンス: {MAINTENANCE.idle_seconds:g}秒アイドル後に最大{MAINTENANCE.budget_seconds:g}秒")
     run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
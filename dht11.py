@@ -1,6 +1,12 @@
 import time
 import RPi
 
+import metrics
+
+# --- メトリクス（ビット読み取り後にのみ記録し、タイミングに影響させない） ---
+READS = metrics.counter("dht11_reads_total", "DHT11 read attempts by result", ("result",))
+READ_SECONDS = metrics.histogram("dht11_read_seconds", "DHT11 read latency in seconds")
+
 
 class DHT11Result:
     'DHT11 sensor result returned by DHT11.read() method'
@@ -22,6 +28,13 @@ class DHT11Result:
         return self.error_code == DHT11Result.ERR_NO_ERROR
 
 
+_RESULT_COUNTERS = {
+    DHT11Result.ERR_NO_ERROR: READS.labels("ok"),
+    DHT11Result.ERR_MISSING_DATA: READS.labels("missing_data"),
+    DHT11Result.ERR_CRC: READS.labels("crc"),
+}
+
+
 class DHT11:
     'DHT11 sensor reader class for Raspberry'
 
@@ -31,6 +44,13 @@ class DHT11:
         self.__pin = pin
 
     def read(self):
+        start = time.perf_counter()
+        result = self.__read()
+        READ_SECONDS.observe(time.perf_counter() - start)
+        _RESULT_COUNTERS[result.error_code].inc()
+        return result
+
+    def __read(self):
         RPi.GPIO.setup(self.__pin, RPi.GPIO.OUT)
 
         # send initial high
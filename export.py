@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""
+Streaming export of sensor_data (CSV / Parquet / Arrow)
+
+行は fetchmany() で EXPORT_CHUNK 件ずつ読み出し（アーカイブ済みの月は列ファイルから）、チャンクごとにエンコードして
+バイト列として yield する。期間がどれだけ長くてもメモリ使用量は
+チャンク1つ分で一定になる。
+
+Parquet / Arrow は pyarrow がある場合のみ（pip install pyarrow）。
+"""
+
+import csv
+import io
+
+import aggregation
+import timeseries
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow は任意
+    pa = None
+    pq = None
+
+EXPORT_CHUNK = 5000
+# quality は品質フラグ（anomalies.describe() で内容を確認できる。0 = 正常）
+COLUMNS = ("timestamp", "sensor_location", "temperature", "humidity", "soil_moisture", "quality")
+
+FORMATS = {
+    "csv": ("text/csv; charset=utf-8", "csv"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+    "arrow": ("application/vnd.apache.arrow.stream", "arrows"),
+}
+
+
+class ExportError(ValueError):
+    pass
+
+
+def check_format(fmt):
+    """形式名を検証して (Content-Type, 拡張子) を返す"""
+    if fmt not in FORMATS:
+        raise ExportError(f"format must be one of {sorted(FORMATS)}")
+    if fmt != "csv" and pa is None:
+        raise ExportError(f"{fmt} export requires pyarrow (pip install pyarrow)")
+    return FORMATS[fmt]
+
+
+def iter_chunks(cursor, sql, params, chunk_size=EXPORT_CHUNK):
+    """クエリ結果を chunk_size 件ずつのリストで返す"""
+    cursor.execute(sql, params)
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield rows
+
+
+def archived_chunks(location, ts, values, quality, chunk_size=EXPORT_CHUNK):
+    """アーカイブの列（archive.load の戻り値）を COLUMNS の順の行にして chunk_size 件ずつ返す"""
+    for i in range(0, len(ts), chunk_size):
+        part = slice(i, i + chunk_size)
+        fields = {
+            "timestamp": [timeseries.epoch_text(t) for t in ts[part].tolist()],
+            "sensor_location": [location] * len(ts[part]),
+            "temperature": aggregation.to_list(values[0][part]),
+            "humidity": aggregation.to_list(values[1][part]),
+            "soil_moisture": aggregation.to_list(values[2][part]),
+            "quality": quality[part].tolist(),
+        }
+        yield list(zip(*(fields[column] for column in COLUMNS)))
+
+
+# --- CSV ---
+def csv_stream(chunks):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(COLUMNS)
+    for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue().encode("utf-8")
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode("utf-8")
+
+
+# --- Parquet / Arrow ---
+class _ChunkSink(io.RawIOBase):
+    """pyarrow の書き込み先。書かれたバイト列を溜めて drain() で取り出す"""
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._parts.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+def _schema():
+    return pa.schema([
+        ("timestamp", pa.timestamp("us")),
+        ("sensor_location", pa.string()),
+        ("temperature", pa.float64()),
+        ("humidity", pa.float64()),
+        ("soil_moisture", pa.float64()),
+        ("quality", pa.int32()),
+    ])
+
+
+def _record_batch(rows, schema):
+    columns = list(zip(*rows))
+    timestamps = pa.array(columns[0], pa.string()).cast(schema.field("timestamp").type)
+    arrays = [timestamps] + [pa.array(col, schema.field(i + 1).type) for i, col in enumerate(columns[1:])]
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+def arrow_stream(chunks, fmt):
+    """Parquet（1チャンク = 1行グループ）または Arrow IPC ストリームを逐次出力する"""
+    schema = _schema()
+    sink = _ChunkSink()
+    if fmt == "parquet":
+        writer = pq.ParquetWriter(sink, schema, compression="zstd")
+    else:
+        writer = pa.ipc.new_stream(sink, schema)
+    try:
+        for rows in chunks:
+            writer.write_batch(_record_batch(rows, schema))
+            data = sink.drain()
+            if data:
+                yield data
+    finally:
+        writer.close()
+    data = sink.drain()
+    if data:
+        yield data
+
+
+def stream(chunks, fmt):
+    if fmt == "csv":
+        return csv_stream(chunks)
+    return arrow_stream(chunks, fmt)
@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+"""
+Soil-moisture forecasting (exponential decay with temperature / humidity covariates)
+
+土壌湿度 m は水やりの間、下限 FLOOR に向かって指数的に減衰するとみなす:
+
+    dm/dt = -k (m - FLOOR),   k = θ0 + θ1 (温度 - 20) + θ2 (湿度 - 50)
+
+読み取り値は1時間ごとの平均にまとめ、連続する2時間の平均から乾燥速度を求めて
+θ を忘却係数つきの逐次最小二乗法（RLS）で更新する。状態は場所ごとに定数サイズなので、
+新しい行が届くたびに forecast_models テーブルの1行を更新するだけで済み、履歴を再走査しない。
+水やり（急な上昇）を含む区間は学習に使わない。
+
+予測では直近1時間の温度・湿度が続くと仮定して m(t) を外挿し、閾値を下回る時刻を求める。
+
+既存データからの作成:
+    python forecasting.py --rebuild
+"""
+
+import argparse
+import json
+import math
+import os
+import sqlite3
+from datetime import datetime
+
+import anomalies
+import locations
+import rollups
+import timeseries
+import watering
+
+FLOOR = float(os.getenv("FORECAST_FLOOR", "0"))
+# 1時間ごとの更新で過去の重みを掛ける係数（0.995 で約200時間 = 8日分の記憶）
+FORGETTING = 0.995
+# 学習に使った時間数がこれ未満のモデルでは予測しない
+MIN_SAMPLES = 12
+# 予測する最長期間（時間）
+MAX_HORIZON_HOURS = 14 * 24
+TEMPERATURE_REF = 20.0
+HUMIDITY_REF = 50.0
+
+CREATE_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS forecast_models (
+        sensor_location TEXT PRIMARY KEY,
+        last_timestamp TEXT NOT NULL,
+        state TEXT NOT NULL
+    ) WITHOUT ROWID
+'''
+
+
+class DecayModel:
+    """1場所分のモデルと、1時間平均を作るための途中状態"""
+
+    def __init__(self):
+        self.theta = [0.0, 0.0, 0.0]
+        self.p = [[1.0 if i == j else 0.0 for j in range(3)] for i in range(3)]
+        self.samples = 0
+        # 集計中の1時間（開始時刻, 件数, 土壌湿度・温度・湿度の合計）
+        self.hour = None
+        # 直前に確定した1時間の平均 (開始時刻, 土壌湿度, 温度, 湿度)
+        self.previous = None
+
+    # --- 学習 ---
+    def add(self, epoch, soil_moisture, temperature, humidity):
+        if soil_moisture is None or temperature is None or humidity is None:
+            return
+        hour_start = epoch // 3600 * 3600
+        if self.hour is not None and hour_start != self.hour[0]:
+            self._close_hour()
+        elif self.hour is not None and soil_moisture - self.hour[2] / self.hour[1] >= watering.RISE_THRESHOLD:
+            # 1時間の途中で水やりされたら、そこで区切って水やり前後を平均に混ぜない
+            self._close_hour()
+            self.previous = None
+            self.hour = None
+        if self.hour is None or hour_start != self.hour[0]:
+            self.hour = [hour_start, 0, 0.0, 0.0, 0.0]
+        self.hour[1] += 1
+        self.hour[2] += soil_moisture
+        self.hour[3] += temperature
+        self.hour[4] += humidity
+
+    def _close_hour(self):
+        start, n, m, t, h = self.hour
+        current = (start, m / n, t / n, h / n)
+        previous, self.previous = self.previous, current
+        if previous is None:
+            return
+        hours = (current[0] - previous[0]) / 3600.0
+        change = current[1] - previous[1]
+        # 水やりを含む区間と、欠測で間が空いた区間は使わない
+        if hours > 3 or change >= watering.RISE_THRESHOLD / 2:
+            return
+        level = (current[1] + previous[1]) / 2 - FLOOR
+        if level <= 0:
+            return
+        x = self._regressors(level, (current[2] + previous[2]) / 2, (current[3] + previous[3]) / 2)
+        self._rls_update(x, -change / hours)
+
+    @staticmethod
+    def _regressors(level, temperature, humidity):
+        return [level, level * (temperature - TEMPERATURE_REF), level * (humidity - HUMIDITY_REF)]
+
+    def _rls_update(self, x, y):
+        p = self.p
+        px = [sum(p[i][j] * x[j] for j in range(3)) for i in range(3)]
+        denominator = FORGETTING + sum(x[i] * px[i] for i in range(3))
+        gain = [v / denominator for v in px]
+        error = y - sum(x[i] * self.theta[i] for i in range(3))
+        self.theta = [self.theta[i] + gain[i] * error for i in range(3)]
+        self.p = [[(p[i][j] - gain[i] * px[j]) / FORGETTING for j in range(3)] for i in range(3)]
+        self.samples += 1
+
+    # --- 予測 ---
+    def latest(self):
+        """予測の起点: 集計中の1時間（無ければ直前の1時間）の平均 (時刻, 土壌湿度, 温度, 湿度)"""
+        if self.hour is not None and self.hour[1]:
+            start, n, m, t, h = self.hour
+            return start, m / n, t / n, h / n
+        return self.previous
+
+    def rate(self, temperature, humidity):
+        """減衰率 k（1/時）"""
+        return (self.theta[0] + self.theta[1] * (temperature - TEMPERATURE_REF)
+                + self.theta[2] * (humidity - HUMIDITY_REF))
+
+    def predict(self, hours, level, k):
+        return FLOOR + (level - FLOOR) * math.exp(-k * hours)
+
+    def hours_until(self, threshold, level, k):
+        """level から threshold を下回るまでの時間（下回らなければ None）"""
+        if level <= threshold:
+            return 0.0
+        if k <= 0 or threshold <= FLOOR:
+            return None
+        hours = math.log((level - FLOOR) / (threshold - FLOOR)) / k
+        return hours if hours <= MAX_HORIZON_HOURS else None
+
+    # --- 保存 ---
+    def to_dict(self):
+        return {"theta": self.theta, "p": self.p, "samples": self.samples,
+                "hour": self.hour, "previous": self.previous}
+
+    @classmethod
+    def from_dict(cls, data):
+        model = cls()
+        model.theta = data["theta"]
+        model.p = data["p"]
+        model.samples = data["samples"]
+        model.hour = data["hour"]
+        model.previous = tuple(data["previous"]) if data["previous"] else None
+        return model
+
+
+def ensure_table(conn):
+    conn.execute(CREATE_TABLE_SQL)
+
+
+def load_model(conn, location):
+    """(モデル, 最後に取り込んだ時刻文字列)。未学習なら (None, "")"""
+    row = conn.execute(
+        "SELECT last_timestamp, state FROM forecast_models WHERE sensor_location = ?", (location,)).fetchone()
+    if row is None:
+        return None, ""
+    return DecayModel.from_dict(json.loads(row[1])), row[0]
+
+
+def update(conn, table_name="sensor_data", location=None, batch_size=10000):
+    """前回取り込んだ時刻より新しい行でモデルを更新する（コミットは呼び出し側）。学習した時間数を返す"""
+    ensure_table(conn)
+    registry = locations.registry(conn)
+    names = registry.names() if location is None else [location]
+    learned = 0
+    for loc in names:
+        model, last_timestamp = load_model(conn, loc)
+        model = model or DecayModel()
+        before = model.samples
+        cursor = conn.execute(f'''
+            SELECT timestamp, {anomalies.masked_columns()} FROM {table_name}
+            WHERE location_id = ? AND timestamp > ?
+            ORDER BY timestamp
+        ''', (registry.id_of(loc), last_timestamp))
+        new_rows = False
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            new_rows = True
+            for timestamp_str, temperature, humidity, soil_moisture in rows:
+                model.add(timeseries.timestamp_epoch(timestamp_str), soil_moisture, temperature, humidity)
+            last_timestamp = rows[-1][0]
+        if new_rows:
+            conn.execute(
+                "INSERT OR REPLACE INTO forecast_models (sensor_location, last_timestamp, state) VALUES (?, ?, ?)",
+                (loc, last_timestamp, json.dumps(model.to_dict())))
+            learned += model.samples - before
+    return learned
+
+
+def ensure_built(conn, table_name="sensor_data"):
+    """テーブルが無ければ作成して既存データから学習する。学習した場合 True"""
+    if not rollups.table_exists(conn, table_name) or rollups.table_exists(conn, "forecast_models"):
+        return False
+    rollups.ensure_index(conn, table_name)
+    anomalies.ensure_column(conn, table_name)
+    update(conn, table_name)
+    conn.commit()
+    return True
+
+
+def rebuild(conn, table_name="sensor_data", location=None):
+    rollups.ensure_index(conn, table_name)
+    anomalies.ensure_column(conn, table_name)
+    ensure_table(conn)
+    if location is None:
+        conn.execute("DELETE FROM forecast_models")
+    else:
+        conn.execute("DELETE FROM forecast_models WHERE sensor_location = ?", (location,))
+    learned = update(conn, table_name, location)
+    conn.commit()
+    return learned
+
+
+# --- 問い合わせ ---
+def forecast(conn, location, threshold=None, horizon_hours=48, points=24, now_epoch=None):
+    """閾値（省略時は場所の閾値）を下回る予測時刻と、予測線（UNIX秒, 土壌湿度）の点列"""
+    if now_epoch is None:
+        now_epoch = rollups.naive_epoch(datetime.now())
+    if threshold is None:
+        threshold = watering.threshold_for(conn, location)
+    result = {
+        "location": location,
+        "threshold": threshold,
+        "ready": False,
+        "samples": 0,
+        "decay_per_day": None,
+        "hours_until_threshold": None,
+        "predicted_at": None,
+        "projection": [],
+    }
+    model, _ = load_model(conn, location)
+    if model is None:
+        return result
+    result["samples"] = model.samples
+    latest = model.latest()
+    if model.samples < MIN_SAMPLES or latest is None:
+        return result
+    start, level, temperature, humidity = latest
+    # 集計中の1時間の平均は、その1時間の中央の時刻の値とみなす
+    origin = start + 1800
+    k = model.rate(temperature, humidity)
+    result["ready"] = True
+    result["decay_per_day"] = round(k * 24, 4)
+    hours = model.hours_until(threshold, level, k)
+    if hours is not None:
+        predicted = origin + hours * 3600
+        result["hours_until_threshold"] = round(max(0.0, (predicted - now_epoch) / 3600), 1)
+        result["predicted_at"] = timeseries.epoch_text(int(predicted))
+    step = horizon_hours / points
+    result["projection"] = [
+        (int(origin + i * step * 3600), round(model.predict(i * step, level, k), 1))
+        for i in range(points + 1)
+    ]
+    return result
+
+
+def alert_values(result):
+    """アラートルールで参照できる派生メトリクス"""
+    if result["hours_until_threshold"] is None:
+        return {}
+    return {"forecast_hours_until_dry": result["hours_until_threshold"]}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Fit per-location soil-moisture forecasting models")
+    parser.add_argument("--db", default=os.getenv("SENSOR_DB_PATH", "sensor_data.db"))
+    parser.add_argument("--rebuild", action="store_true", help="sensor_data から学習し直す")
+    parser.add_argument("--forecast", action="store_true", help="場所ごとの予測を表示")
+    args = parser.parse_args(argv)
+    conn = sqlite3.connect(args.db)
+    try:
+        if args.rebuild:
+            print(f"✅ models fitted on {rebuild(conn)} hourly samples")
+        if args.forecast:
+            ensure_built(conn)
+            for (location,) in conn.execute("SELECT sensor_location FROM forecast_models ORDER BY sensor_location").fetchall():
+                result = forecast(conn, location)
+                print(location, {k: v for k, v in result.items() if k != "projection"})
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+Gap detection and sensor uptime per location
+
+ロガーは cron で SAMPLE_INTERVAL 秒ごとに1件書き込む。連続する2件の間隔が
+その GAP_FACTOR 倍を超えたら、その間を欠測（ロガーの停止・センサー故障など）とみなす。
+
+欠測区間は sensor_gaps テーブルに保存し、場所ごとの走査位置を gap_scan に持つ。
+update() は前回の走査位置より新しい行の時刻だけを (location_id, timestamp) 索引から
+読む（索引だけで完結する走査）ので、履歴が長くなってもコストは新しい行の数だけで済む。
+稼働率は期間と欠測区間の重なりから求める。記録間隔は場所ごとに locations.sample_interval で
+変えられる（未設定なら SAMPLE_INTERVAL）。
+
+最後の読み取りから GAP_SECONDS 以上経っている場合は、現在まで続く欠測（ongoing）として扱う。
+
+既存データからの作成:
+    python gaps.py --rebuild
+"""
+
+import argparse
+import os
+import sqlite3
+from datetime import datetime
+
+import locations
+import rollups
+import timeseries
+
+# ロガーの実行間隔（秒、場所ごとの設定が無い場合）と、欠測とみなす間隔の倍率
+SAMPLE_INTERVAL = int(os.getenv("SAMPLE_INTERVAL_SECONDS", "600"))
+GAP_FACTOR = 2.5
+GAP_SECONDS = SAMPLE_INTERVAL * GAP_FACTOR
+
+# 稼働率を求める期間
+UPTIME_PERIODS = {"24h": 86400, "7d": 7 * 86400, "30d": 30 * 86400}
+
+CREATE_GAPS_SQL = '''
+    CREATE TABLE IF NOT EXISTS sensor_gaps (
+        sensor_location TEXT NOT NULL,
+        gap_start INTEGER NOT NULL,
+        gap_end INTEGER NOT NULL,
+        PRIMARY KEY (sensor_location, gap_start)
+    ) WITHOUT ROWID
+'''
+
+CREATE_SCAN_SQL = '''
+    CREATE TABLE IF NOT EXISTS gap_scan (
+        sensor_location TEXT PRIMARY KEY,
+        first_timestamp TEXT NOT NULL,
+        last_timestamp TEXT NOT NULL
+    ) WITHOUT ROWID
+'''
+
+
+def ensure_tables(conn):
+    conn.execute(CREATE_GAPS_SQL)
+    conn.execute(CREATE_SCAN_SQL)
+
+
+def interval_for(conn, location):
+    """場所の想定の記録間隔（秒）"""
+    entry = locations.registry(conn).get(location)
+    return entry.sample_interval if entry and entry.sample_interval else SAMPLE_INTERVAL
+
+
+def update(conn, table_name="sensor_data", location=None, batch_size=10000):
+    """前回の走査位置より新しい行の時刻から欠測区間を探す（コミットは呼び出し側）。見つけた数を返す"""
+    ensure_tables(conn)
+    registry = locations.registry(conn)
+    names = registry.names() if location is None else [location]
+    found = 0
+    for loc in names:
+        gap_seconds = interval_for(conn, loc) * GAP_FACTOR
+        scan = conn.execute(
+            "SELECT first_timestamp, last_timestamp FROM gap_scan WHERE sensor_location = ?", (loc,)).fetchone()
+        first_timestamp, last_timestamp = scan if scan else (None, "")
+        previous = timeseries.timestamp_epoch(last_timestamp) if scan else None
+        cursor = conn.execute(f'''
+            SELECT timestamp FROM {table_name}
+            WHERE location_id = ? AND timestamp > ?
+            ORDER BY timestamp
+        ''', (registry.id_of(loc), last_timestamp))
+        gaps = []
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            if first_timestamp is None:
+                first_timestamp = rows[0][0]
+            for (timestamp_str,) in rows:
+                epoch = timeseries.timestamp_epoch(timestamp_str)
+                if previous is not None and epoch - previous > gap_seconds:
+                    gaps.append((loc, previous, epoch))
+                previous = epoch
+            last_timestamp = rows[-1][0]
+        if first_timestamp is None:
+            continue
+        conn.executemany(
+            "INSERT OR REPLACE INTO sensor_gaps (sensor_location, gap_start, gap_end) VALUES (?, ?, ?)", gaps)
+        conn.execute(
+            "INSERT OR REPLACE INTO gap_scan (sensor_location, first_timestamp, last_timestamp) VALUES (?, ?, ?)",
+            (loc, first_timestamp, last_timestamp))
+        found += len(gaps)
+    return found
+
+
+def ensure_built(conn, table_name="sensor_data"):
+    """テーブルが無ければ作成して既存データを走査する。走査した場合 True"""
+    if not rollups.table_exists(conn, table_name) or rollups.table_exists(conn, "gap_scan"):
+        return False
+    rollups.ensure_index(conn, table_name)
+    update(conn, table_name)
+    conn.commit()
+    return True
+
+
+def rebuild(conn, table_name="sensor_data", location=None):
+    rollups.ensure_index(conn, table_name)
+    ensure_tables(conn)
+    for table in ("sensor_gaps", "gap_scan"):
+        if location is None:
+            conn.execute(f"DELETE FROM {table}")
+        else:
+            conn.execute(f"DELETE FROM {table} WHERE sensor_location = ?", (location,))
+    found = update(conn, table_name, location)
+    conn.commit()
+    return found
+
+
+# --- 問い合わせ ---
+def _gap(start, end, interval, ongoing=False):
+    return {
+        "start": timeseries.epoch_text(start),
+        "end": timeseries.epoch_text(end),
+        "seconds": int(end - start),
+        "missing_samples": max(int((end - start) // interval) - 1, 0),
+        "ongoing": ongoing,
+    }
+
+
+def _intervals(conn, location, start_epoch, end_epoch, now_epoch, interval):
+    """期間と重なる欠測区間 (開始, 終了, 継続中か)。現在まで続く欠測も含める"""
+    rows = conn.execute('''
+        SELECT gap_start, gap_end FROM sensor_gaps
+        WHERE sensor_location = ? AND gap_end > ? AND gap_start < ?
+        ORDER BY gap_start
+    ''', (location, start_epoch, end_epoch)).fetchall()
+    intervals = [(start, end, False) for start, end in rows]
+    scan = conn.execute("SELECT last_timestamp FROM gap_scan WHERE sensor_location = ?", (location,)).fetchone()
+    if scan:
+        last = timeseries.timestamp_epoch(scan[0])
+        if now_epoch - last > interval * GAP_FACTOR and last < end_epoch:
+            intervals.append((last, now_epoch, True))
+    return intervals
+
+
+def find_gaps(conn, location, start_epoch, end_epoch, now_epoch=None):
+    """期間と重なる欠測区間のリスト（古い順）"""
+    if now_epoch is None:
+        now_epoch = rollups.naive_epoch(datetime.now())
+    ensure_tables(conn)
+    interval = interval_for(conn, location)
+    return [
+        {"location": location, **_gap(start, end, interval, ongoing)}
+        for start, end, ongoing in _intervals(conn, location, start_epoch, end_epoch, now_epoch, interval)
+    ]
+
+
+def uptime(conn, location, seconds, now_epoch=None):
+    """直近 seconds 秒の稼働率
+
+    計測の対象は最初の読み取り以降の時間だけ。欠測区間のうち、本来は次の読み取りが
+    届いているはずの時刻（開始 + 記録間隔）以降を停止時間として数える。
+    """
+    if now_epoch is None:
+        now_epoch = rollups.naive_epoch(datetime.now())
+    ensure_tables(conn)
+    scan = conn.execute("SELECT first_timestamp FROM gap_scan WHERE sensor_location = ?", (location,)).fetchone()
+    result = {"seconds": seconds, "monitored_seconds": 0, "downtime_seconds": 0, "gaps": 0,
+              "longest_gap_seconds": 0, "availability_pct": None}
+    if scan is None:
+        return result
+    start = max(now_epoch - seconds, timeseries.timestamp_epoch(scan[0]))
+    if start >= now_epoch:
+        return result
+    downtime = 0
+    interval = interval_for(conn, location)
+    intervals = _intervals(conn, location, start, now_epoch, now_epoch, interval)
+    for gap_start, gap_end, _ in intervals:
+        downtime += max(min(gap_end, now_epoch) - max(gap_start + interval, start), 0)
+        result["longest_gap_seconds"] = max(result["longest_gap_seconds"], int(gap_end - gap_start))
+    monitored = now_epoch - start
+    result.update({
+        "monitored_seconds": int(monitored),
+        "downtime_seconds": int(downtime),
+        "gaps": len(intervals),
+        "availability_pct": round(100.0 * (1 - downtime / monitored), 2),
+    })
+    return result
+
+
+def report(conn, location, now_epoch=None):
+    """場所ごとの稼働状況（最後の読み取り・現在欠測中か・期間ごとの稼働率）"""
+    if now_epoch is None:
+        now_epoch = rollups.naive_epoch(datetime.now())
+    ensure_tables(conn)
+    scan = conn.execute("SELECT last_timestamp FROM gap_scan WHERE sensor_location = ?", (location,)).fetchone()
+    last = scan[0] if scan else None
+    interval = interval_for(conn, location)
+    return {
+        "location": location,
+        "last_reading": last,
+        "online": last is not None and now_epoch - timeseries.timestamp_epoch(last) <= interval * GAP_FACTOR,
+        "sample_interval_seconds": interval,
+        "uptime": {name: uptime(conn, location, seconds, now_epoch) for name, seconds in UPTIME_PERIODS.items()},
+    }
+
+
+def break_positions(ts, max_step):
+    """時刻順の配列で、直前の点から max_step 秒を超えて離れている点の位置（グラフを途切れさせる位置）"""
+    if len(ts) < 2:
+        return []
+    return [i + 1 for i in (ts[1:] - ts[:-1] > max_step).nonzero()[0].tolist()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Find sampling gaps and report sensor uptime")
+    parser.add_argument("--db", default=os.getenv("SENSOR_DB_PATH", "sensor_data.db"))
+    parser.add_argument("--rebuild", action="store_true", help="sensor_data から欠測区間を作り直す")
+    parser.add_argument("--report", action="store_true", help="場所ごとの稼働率を表示")
+    args = parser.parse_args(argv)
+    conn = sqlite3.connect(args.db)
+    try:
+        if args.rebuild:
+            print(f"✅ {rebuild(conn)} gaps found")
+        if args.report:
+            ensure_built(conn)
+            for (location,) in conn.execute("SELECT sensor_location FROM gap_scan ORDER BY sensor_location").fetchall():
+                result = report(conn, location)
+                periods = ", ".join(f"{name} {u['availability_pct']}%" for name, u in result["uptime"].items())
+                print(f"{location}: last={result['last_reading']} online={result['online']} {periods}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
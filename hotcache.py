@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+In-memory columnar cache of the most recent sensor_data rows
+
+場所ごとに直近 HOT_CACHE_DAYS 日分の 時刻（UNIX秒）・温度・湿度・土壌湿度 を
+array('d') の列として保持する。欠損値と品質フラグの付いた値（anomalies）は NaN。ダッシュボードへの問い合わせの大半は
+直近1時間〜7日なので、その範囲は二分探索で切り出すだけで SQLite を読まずに済む。
+
+- 起動時（または最初のリクエスト時）に load() で期間内の行を読み込む
+- 以降は refresh() で rowid が前回より大きい行だけを追加する
+  （ロガーは別プロセスのcronなので、リクエスト時に REFRESH_SECONDS 間隔で確認する）
+- 保持期間より古くなった先頭部分は、ある程度溜まった時点でまとめて切り捨てる
+- 一括取り込み（bulk_import.py）の後は既存の行の品質フラグも変わるので、世代が変わったら読み込み直す
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from array import array
+from bisect import bisect_left, bisect_right
+
+import numpy as np
+
+import anomalies
+import timeseries
+
+HOT_CACHE_DAYS = float(os.getenv("HOT_CACHE_DAYS", "7"))
+REFRESH_SECONDS = 1.0
+METRICS = ("temperature", "humidity", "soil_moisture")
+
+NAN = float("nan")
+
+
+class LocationColumns:
+    """1場所分の列（時刻昇順）"""
+
+    __slots__ = ("ts", "columns")
+
+    def __init__(self):
+        self.ts = array("d")
+        self.columns = tuple(array("d") for _ in METRICS)
+
+    def append(self, epoch, values):
+        if self.ts and epoch < self.ts[-1]:
+            # 遅れて届いた行は挿入位置を探して入れる
+            index = bisect_right(self.ts, epoch)
+            self.ts.insert(index, epoch)
+            for column, value in zip(self.columns, values):
+                column.insert(index, NAN if value is None else value)
+            return
+        self.ts.append(epoch)
+        for column, value in zip(self.columns, values):
+            column.append(NAN if value is None else value)
+
+    def trim(self, horizon):
+        """horizon より古い行を削除する（削除対象が半分を超えたときだけコピーする）"""
+        index = bisect_left(self.ts, horizon)
+        if index and index * 2 >= len(self.ts):
+            del self.ts[:index]
+            for column in self.columns:
+                del column[:index]
+
+    def slice(self, start, end):
+        """[start, end) の範囲を (時刻, 温度, 湿度, 土壌湿度) の配列で返す"""
+        lo = bisect_left(self.ts, start)
+        hi = bisect_left(self.ts, end, lo)
+        return (self.ts[lo:hi],) + tuple(column[lo:hi] for column in self.columns)
+
+    def __len__(self):
+        return len(self.ts)
+
+
+def parse_epoch(timestamp_str):
+    """'YYYY-MM-DD HH:MM:SS[.ffffff]' をマイクロ秒付きのUNIX秒に変換"""
+    seconds = timeseries.timestamp_epoch(timestamp_str)
+    fraction = timestamp_str[20:26]
+    return seconds + int(fraction.ljust(6, "0")) / 1e6 if fraction else float(seconds)
+
+
+_day_texts = {}
+
+
+def epoch_text(epoch):
+    """UNIX秒を保存時と同じ 'YYYY-MM-DD HH:MM:SS.ffffff' 形式に戻す"""
+    seconds = int(epoch)
+    micro = int(round((epoch - seconds) * 1e6))
+    if micro == 1000000:
+        seconds, micro = seconds + 1, 0
+    day, rest = divmod(seconds, 86400)
+    prefix = _day_texts.get(day)
+    if prefix is None:
+        prefix = _day_texts[day] = timeseries.epoch_text(day * 86400)[:10]
+    hour, rest = divmod(rest, 3600)
+    minute, second = divmod(rest, 60)
+    return f"{prefix} {hour:02d}:{minute:02d}:{second:02d}.{micro:06d}"
+
+
+class HotCache:
+    """場所 → LocationColumns。DBファイルごとに1つ"""
+
+    def __init__(self, days=HOT_CACHE_DAYS):
+        self.days = days
+        self.locations = {}
+        self.db_path = None
+        self.table_name = None
+        self.generation = None
+        self.last_rowid = 0
+        self.horizon = None
+        self._checked = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.days > 0
+
+    def ensure(self, conn, db_path, table_name, now_epoch, generation=0):
+        """未読み込み（または取り込みの世代が変わった）なら読み込み、読み込み済みなら新しい行を取り込む"""
+        if not self.enabled:
+            return False
+        with self._lock:
+            try:
+                if (self.db_path, self.table_name, self.generation) != (db_path, table_name, generation):
+                    self._load(conn, db_path, table_name, now_epoch)
+                    self.generation = generation
+                elif self.horizon is not None and time.monotonic() - self._checked >= REFRESH_SECONDS:
+                    self._refresh(conn, now_epoch)
+            except sqlite3.OperationalError:
+                # location_id に変換できない古いDBなどはキャッシュせずSQLで読む
+                self.locations = {}
+                self.horizon = None
+                return False
+        return True
+
+    def _load(self, conn, db_path, table_name, now_epoch):
+        self.locations = {}
+        self.db_path = db_path
+        self.table_name = table_name
+        self.last_rowid = 0
+        self.horizon = now_epoch - self.days * 86400
+        start_text = timeseries.epoch_text(int(self.horizon))
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT MAX(rowid) FROM {table_name}")
+        self.last_rowid = cursor.fetchone()[0] or 0
+        cursor.execute(f'''
+            SELECT l.name, timestamp, {anomalies.masked_columns()}
+            FROM {table_name} d JOIN locations l ON l.id = d.location_id
+            WHERE timestamp >= ? AND d.rowid <= ?
+            ORDER BY d.location_id, timestamp
+        ''', (start_text, self.last_rowid))
+        self._append_rows(cursor)
+        self._checked = time.monotonic()
+
+    def _refresh(self, conn, now_epoch):
+        self.horizon = now_epoch - self.days * 86400
+        cursor = conn.cursor()
+        cursor.execute(f"SELECT MAX(rowid) FROM {self.table_name}")
+        last_rowid = cursor.fetchone()[0] or 0
+        # 一括取り込み（bulk_import.py）で追加された古い行は保持期間外なので読まない
+        cursor.execute(f'''
+            SELECT l.name, timestamp, {anomalies.masked_columns()}
+            FROM {self.table_name} d LEFT JOIN locations l ON l.id = d.location_id
+            WHERE d.rowid > ? AND d.rowid <= ? AND timestamp >= ?
+            ORDER BY d.rowid
+        ''', (self.last_rowid, last_rowid, timeseries.epoch_text(int(self.horizon))))
+        self._append_rows(row for row in cursor.fetchall() if row[0] is not None)
+        self.last_rowid = max(self.last_rowid, last_rowid)
+        for columns in self.locations.values():
+            columns.trim(self.horizon)
+        self._checked = time.monotonic()
+
+    def _append_rows(self, rows):
+        for location, timestamp_str, *values in rows:
+            columns = self.locations.get(location)
+            if columns is None:
+                columns = self.locations[location] = LocationColumns()
+            columns.append(parse_epoch(timestamp_str), values)
+
+    def covers(self, start_epoch):
+        return self.horizon is not None and start_epoch >= self.horizon
+
+    def slice(self, location, start_epoch, end_epoch):
+        """[start, end) の列。location が None なら全ての場所を時刻順にまとめる（NumPy の配列で返す）"""
+        with self._lock:
+            if location is not None:
+                columns = self.locations.get(location)
+                return columns.slice(start_epoch, end_epoch) if columns else (array("d"),) * 4
+            parts = [columns.slice(start_epoch, end_epoch) for columns in self.locations.values()]
+        if not parts:
+            return (array("d"),) * 4
+        if len(parts) == 1:
+            return parts[0]
+        # 場所ごとの列はそれぞれ時刻順なので、つなげて時刻の安定ソートの順に並べる（同じ時刻は場所の順）
+        merged = [np.concatenate([np.frombuffer(part[i]) for part in parts]) for i in range(len(METRICS) + 1)]
+        order = np.argsort(merged[0], kind="stable")
+        return tuple(column[order] for column in merged)
+
+    def size(self):
+        return sum(len(columns) for columns in self.locations.values())
+
+
+CACHE = HotCache()
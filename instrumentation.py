@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+Request timing instrumentation for the dashboard
+
+Bottleプラグインとして各ルートの処理時間を計測する。
+- DBクエリ / 後処理 / JSONシリアライズ / テンプレート描画 に分けて計測
+- 結果は Server-Timing レスポンスヘッダーと /api/metrics（ヒストグラム）で公開
+  （同じ値は metrics モジュール経由で Prometheus 形式の /metrics にも出る）
+- ?profile=1 を付けたリクエストは cProfile のサマリーを返す
+- 各リクエスト前後のRSS（常駐メモリ）を X-Memory-RSS ヘッダーとヒストグラムで公開
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from bottle import HTTPResponse, request, response
+
+import metrics
+
+# Server-Timing に出力するフェーズ（表示順）
+PHASES = ["db", "post", "json", "render"]
+PHASE_DESCRIPTIONS = {
+    "db": "DB query",
+    "post": "Row post-processing",
+    "json": "JSON serialization",
+    "render": "Template render",
+    "total": "Total",
+}
+
+PROFILE_LIMIT = 40
+
+_local = threading.local()
+
+
+class RequestTimer:
+    """1リクエスト内のフェーズ別処理時間（秒）"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases = dict.fromkeys(PHASES, 0.0)
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def finish(self):
+        """合計時間を確定し、計測外の時間を後処理(post)として割り当てる"""
+        total = time.perf_counter() - self.started
+        measured = sum(v for k, v in self.phases.items() if k != "post")
+        self.phases["post"] += max(total - measured, 0.0)
+        self.phases["total"] = total
+        return self.phases
+
+
+def current_timer():
+    return getattr(_local, "timer", None)
+
+
+@contextmanager
+def timed(phase):
+    """with timed("render"): ... の形で現在のリクエストにフェーズ時間を加算"""
+    timer = current_timer()
+    if timer is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(phase, time.perf_counter() - t0)
+
+
+# --- DB計測用のカーソル/接続 ---
+class TimedCursor(sqlite3.Cursor):
+    """execute/fetch系の所要時間を db フェーズとして加算するカーソル"""
+
+    def execute(self, *args, **kwargs):
+        with timed("db"):
+            return super().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        with timed("db"):
+            return super().executemany(*args, **kwargs)
+
+    def fetchone(self):
+        with timed("db"):
+            return super().fetchone()
+
+    def fetchmany(self, *args, **kwargs):
+        with timed("db"):
+            return super().fetchmany(*args, **kwargs)
+
+    def fetchall(self):
+        with timed("db"):
+            return super().fetchall()
+
+
+class TimedConnection(sqlite3.Connection):
+    """cursor() が TimedCursor を返す接続クラス（sqlite3.connect の factory に指定）"""
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+
+# --- メモリ計測 ---
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def rss_bytes():
+    """現在の常駐メモリ（バイト）。/proc が無い環境では最大RSSで代用"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class MemoryTracker:
+    """リクエスト中のRSSを記録する（ストリーミング応答ではチャンクごとに sample() する）"""
+
+    def __init__(self):
+        self.start = self.peak = self.end = rss_bytes()
+
+    def sample(self):
+        self.end = rss_bytes()
+        if self.end > self.peak:
+            self.peak = self.end
+        return self.end
+
+    def report(self):
+        return {
+            "rss_start": self.start,
+            "rss_peak": self.peak,
+            "rss_end": self.end,
+            "rss_growth": self.peak - self.start,
+        }
+
+    def header(self):
+        return f"start={self.start}; peak={self.peak}; growth={self.peak - self.start}"
+
+
+# --- メトリクス ---
+REQUESTS = metrics.counter(
+    "dashboard_requests_total", "Dashboard requests by route and status", ("route", "status"))
+REQUEST_PHASE_SECONDS = metrics.histogram(
+    "dashboard_request_phase_seconds", "Dashboard request time by route and phase", ("route", "phase"))
+REQUEST_RSS_GROWTH = metrics.histogram(
+    "dashboard_request_rss_growth_bytes", "Peak RSS growth during a request", ("route",),
+    buckets=(0, 256 * 1024, 1 << 20, 4 << 20, 16 << 20, 64 << 20, 256 << 20))
+
+
+def observe_memory(route_name, tracker):
+    REQUEST_RSS_GROWTH.labels(route_name).observe(tracker.peak - tracker.start)
+
+
+def _to_ms(value):
+    if value is None or value == float("inf"):
+        return None
+    return round(value * 1000, 3)
+
+
+def snapshot():
+    """/api/metrics 用にルート×フェーズのヒストグラムをミリ秒で返す"""
+    result = {}
+    for (route_name, phase), hist in REQUEST_PHASE_SECONDS.items():
+        cumulative = 0
+        buckets = {}
+        for bound, c in zip(REQUEST_PHASE_SECONDS.buckets + ("+Inf",), hist.counts):
+            cumulative += c
+            buckets[str(bound if bound == "+Inf" else bound * 1000)] = cumulative
+
+        result.setdefault(route_name, {})[phase] = {
+            "count": hist.count,
+            "sum_ms": _to_ms(hist.sum),
+            "avg_ms": _to_ms(hist.sum / hist.count) if hist.count else None,
+            "p50_ms": _to_ms(hist.quantile(0.5)),
+            "p95_ms": _to_ms(hist.quantile(0.95)),
+            "p99_ms": _to_ms(hist.quantile(0.99)),
+            "buckets": buckets,
+        }
+    return result
+
+
+def format_server_timing(phases):
+    """Server-Timing ヘッダー値を生成"""
+    parts = []
+    for phase in PHASES + ["total"]:
+        if phase in phases:
+            parts.append(f'{phase};desc="{PHASE_DESCRIPTIONS[phase]}";dur={phases[phase] * 1000:.2f}')
+    return ", ".join(parts)
+
+
+def _profile_summary(profiler):
+    out = io.StringIO()
+    stats = pstats.Stats(profiler, stream=out)
+    stats.sort_stats("cumulative").print_stats(PROFILE_LIMIT)
+    return out.getvalue()
+
+
+class TimingPlugin:
+    """ルートごとの処理時間を計測する Bottle プラグイン"""
+
+    name = "timing"
+    api = 2
+
+    def __init__(self, exclude=("/static/<filename:path>", "/api/metrics", "/metrics")):
+        self.exclude = set(exclude)
+
+    def apply(self, callback, route):
+        if route.rule in self.exclude:
+            return callback
+        route_name = route.name or route.rule
+
+        def wrapper(*args, **kwargs):
+            timer = _local.timer = RequestTimer()
+            memory = MemoryTracker()
+            profiler = None
+            if request.query.profile == "1":
+                profiler = cProfile.Profile()
+            status = "500"
+            try:
+                if profiler:
+                    body = profiler.runcall(callback, *args, **kwargs)
+                else:
+                    body = callback(*args, **kwargs)
+                status = str(response.status_code)
+            except HTTPResponse as e:
+                status = str(e.status_code)
+                raise
+            finally:
+                _local.timer = None
+                REQUESTS.labels(route_name, status).inc()
+            phases = timer.finish()
+            for phase, seconds in phases.items():
+                REQUEST_PHASE_SECONDS.labels(route_name, phase).observe(seconds)
+            response.set_header("Server-Timing", format_server_timing(phases))
+            # ジェネレーターを返すストリーミング応答は本文の生成中に自分で計測する
+            if isinstance(body, (str, bytes, dict, list)) or body is None:
+                memory.sample()
+                observe_memory(route_name, memory)
+                response.set_header("X-Memory-RSS", memory.header())
+            if profiler:
+                response.content_type = "text/plain; charset=utf-8"
+                return _profile_summary(profiler)
+            return body
+
+        return wrapper
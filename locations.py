@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+Location registry (locations table) and its in-process cache
+
+センサーの場所を locations テーブルに登録し、sensor_data からは整数の location_id で参照する。
+行ごとに場所名の文字列を持たないので、行と (location_id, timestamp) 索引が小さくなる。
+場所名（name、従来の sensor_location）は API・派生テーブル・アラートで使う識別子のまま残し、
+表示名・植物の種類・乾燥の閾値・土壌センサーの校正値・記録間隔を場所ごとの設定として持つ。
+
+場所の一覧は sensor_data の SELECT DISTINCT（全件走査）ではなく、この小さなテーブルから読む。
+CACHE はプロセス内のキャッシュで、locations の行数と revision（変更のたびに増える）が
+変わったときだけ読み直す。
+
+旧形式（sensor_data.sensor_location に場所名の文字列）のDBは、最初に索引を確認したとき
+（rollups.ensure_index）に ensure_schema() で変換する。手動での変換・設定:
+    python locations.py --migrate
+    python locations.py --set ohana_001 --display-name "ベランダのバジル" --plant-type basil --dry-threshold 35
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+import threading
+
+import rollups
+
+CREATE_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS locations (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE,
+        display_name TEXT,
+        plant_type TEXT,
+        dry_threshold REAL,
+        calibration TEXT,
+        sample_interval INTEGER,
+        revision INTEGER NOT NULL DEFAULT 0
+    )
+'''
+
+# 設定できる項目（calibration は土壌センサーの電圧 {"dry_value": 2.8, "wet_value": 1.5} のJSON）
+FIELDS = ("display_name", "plant_type", "dry_threshold", "calibration", "sample_interval")
+
+# sensor_data の列（models.SensorData と同じ）
+SENSOR_DATA_COLUMNS = '''
+    id INTEGER NOT NULL PRIMARY KEY,
+    timestamp DATETIME,
+    temperature FLOAT,
+    humidity FLOAT,
+    soil_moisture FLOAT,
+    location_id INTEGER REFERENCES locations (id),
+    quality INTEGER NOT NULL DEFAULT 0
+'''
+
+
+class Location:
+    """locations の1行"""
+
+    __slots__ = ("id", "name") + FIELDS
+
+    def __init__(self, id, name, display_name=None, plant_type=None, dry_threshold=None,
+                 calibration=None, sample_interval=None):
+        self.id = id
+        self.name = name
+        self.display_name = display_name
+        self.plant_type = plant_type
+        self.dry_threshold = dry_threshold
+        self.calibration = json.loads(calibration) if isinstance(calibration, str) else calibration
+        self.sample_interval = sample_interval
+
+    @property
+    def label(self):
+        return self.display_name or self.name
+
+    def to_dict(self):
+        return {"id": self.id, "name": self.name, **{field: getattr(self, field) for field in FIELDS}}
+
+
+class Registry:
+    """ある時点の locations の内容（読み取り専用）"""
+
+    def __init__(self, rows=()):
+        self.by_name = {}
+        self.by_id = {}
+        for row in rows:
+            location = Location(*row)
+            self.by_name[location.name] = location
+            self.by_id[location.id] = location
+
+    def names(self):
+        return sorted(self.by_name)
+
+    def get(self, name):
+        return self.by_name.get(name)
+
+    def id_of(self, name):
+        location = self.by_name.get(name)
+        return location.id if location else None
+
+    def name_of(self, location_id):
+        location = self.by_id.get(location_id)
+        return location.name if location else None
+
+
+class LocationCache:
+    """DBファイルごとの Registry。(DBファイル, 行数, 最大 revision) が変わったら読み直す"""
+
+    def __init__(self):
+        self._key = None
+        self._registry = Registry()
+        self._lock = threading.Lock()
+
+    def get(self, conn):
+        ensure_table(conn)
+        path = conn.execute("PRAGMA database_list").fetchone()[2]
+        key = (path, *conn.execute("SELECT COUNT(*), COALESCE(MAX(revision), 0) FROM locations").fetchone())
+        with self._lock:
+            if key != self._key:
+                rows = conn.execute(f"SELECT id, name, {', '.join(FIELDS)} FROM locations").fetchall()
+                self._registry = Registry(rows)
+                self._key = key
+            return self._registry
+
+    def clear(self):
+        with self._lock:
+            self._key = None
+            self._registry = Registry()
+
+
+CACHE = LocationCache()
+
+
+def ensure_table(conn):
+    conn.execute(CREATE_TABLE_SQL)
+
+
+def registry(conn):
+    return CACHE.get(conn)
+
+
+def names(conn):
+    """登録されている場所名（名前順）"""
+    return registry(conn).names()
+
+
+def location_id(conn, name):
+    """場所名の location_id（未登録なら None）"""
+    return registry(conn).id_of(name)
+
+
+def register(conn, name):
+    """場所を登録して location_id を返す（登録済みならその id。コミットは呼び出し側）"""
+    location = registry(conn).get(name)
+    if location is not None:
+        return location.id
+    conn.execute("INSERT OR IGNORE INTO locations (name) VALUES (?)", (name,))
+    return conn.execute("SELECT id FROM locations WHERE name = ?", (name,)).fetchone()[0]
+
+
+def _number(field, value):
+    """数値（または数値の文字列）を float にする。真偽値・NaN・無限大は受け付けない"""
+    if isinstance(value, bool):
+        raise ValueError(f"{field} must be a number")
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f"{field} must be a number") from None
+    if number != number or number in (float("inf"), float("-inf")):
+        raise ValueError(f"{field} must be a finite number")
+    return number
+
+
+def validate(field, value):
+    """設定項目の値を確認して保存する形に変換する（None は設定の解除）。不正なら ValueError"""
+    if value is None:
+        return None
+    if field in ("display_name", "plant_type"):
+        if not isinstance(value, str):
+            raise ValueError(f"{field} must be a string")
+        return value
+    if field == "dry_threshold":
+        return _number(field, value)
+    if field == "sample_interval":
+        interval = _number(field, value)
+        if interval <= 0 or interval != int(interval):
+            raise ValueError("sample_interval must be a positive integer (seconds)")
+        return int(interval)
+    if field == "calibration":
+        if isinstance(value, str):
+            try:
+                value = json.loads(value)
+            except ValueError:
+                raise ValueError("calibration must be a JSON object") from None
+        if not isinstance(value, dict):
+            raise ValueError("calibration must be an object with dry_value / wet_value")
+        unknown = set(value) - {"dry_value", "wet_value"}
+        if unknown:
+            raise ValueError(f"unknown calibration keys: {sorted(unknown)}")
+        return json.dumps({key: _number(f"calibration.{key}", number) for key, number in value.items()})
+    raise ValueError(f"unknown location field: {field}")
+
+
+def configure(conn, name, **fields):
+    """場所の設定を更新する（未登録なら登録する。コミットは呼び出し側）。更新後の Location を返す
+
+    値は validate() で確認し、不正な値があれば何も変えずに ValueError を送出する。
+    """
+    unknown = set(fields) - set(FIELDS)
+    if unknown:
+        raise ValueError(f"unknown location fields: {sorted(unknown)}")
+    fields = {field: validate(field, value) for field, value in fields.items()}
+    register(conn, name)
+    if fields:
+        assignments = ", ".join(f"{field} = ?" for field in fields)
+        conn.execute(f'''
+            UPDATE locations SET {assignments}, revision = (SELECT MAX(revision) FROM locations) + 1
+            WHERE name = ?
+        ''', (*fields.values(), name))
+    return registry(conn).get(name)
+
+
+# --- 旧形式からの変換 ---
+def ensure_schema(conn, table_name="sensor_data"):
+    """sensor_data が場所名の文字列を持つ旧形式なら location_id の形式に変換する。変換した場合 True"""
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table_name})")]
+    if "timestamp" not in columns:
+        return False
+    ensure_table(conn)
+    if "location_id" in columns:
+        return False
+    migrate(conn, table_name, columns)
+    return True
+
+
+def migrate(conn, table_name, columns):
+    """場所名を locations に登録し、sensor_data を location_id の列で作り直す（id は保持する）
+
+    SQLite は列の型を変えられないため、新しいテーブルにコピーして入れ替える。
+    全体を1つのトランザクションで行うので、途中で失敗しても元のテーブルが残る。
+    """
+    conn.commit()
+    conn.execute("BEGIN")
+    try:
+        if "sensor_location" in columns:
+            conn.execute(f'''
+                INSERT OR IGNORE INTO locations (name)
+                SELECT DISTINCT sensor_location FROM {table_name} WHERE sensor_location IS NOT NULL
+            ''')
+        # 索引は新しいテーブルに同じ名前で作り直すので先に削除する
+        for (index_name,) in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = ? AND sql IS NOT NULL",
+                (table_name,)).fetchall():
+            conn.execute(f"DROP INDEX {index_name}")
+        old_table = f"{table_name}_old"
+        conn.execute(f"ALTER TABLE {table_name} RENAME TO {old_table}")
+        conn.execute(f"CREATE TABLE {table_name} ({SENSOR_DATA_COLUMNS})")
+        id_column = "o.id" if "id" in columns else "o.rowid"
+        quality = "COALESCE(o.quality, 0)" if "quality" in columns else "0"
+        if "sensor_location" in columns:
+            location_column, join = "l.id", "LEFT JOIN locations l ON l.name = o.sensor_location"
+        else:
+            location_column, join = "NULL", ""
+        conn.execute(f'''
+            INSERT INTO {table_name} (id, timestamp, temperature, humidity, soil_moisture, location_id, quality)
+            SELECT {id_column}, o.timestamp, o.temperature, o.humidity, o.soil_moisture, {location_column}, {quality}
+            FROM {old_table} o {join}
+        ''')
+        conn.execute(f"DROP TABLE {old_table}")
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    CACHE.clear()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the sensor location registry")
+    parser.add_argument("--db", default=os.getenv("SENSOR_DB_PATH", "sensor_data.db"))
+    parser.add_argument("--migrate", action="store_true", help="旧形式の sensor_data を location_id の形式に変換")
+    parser.add_argument("--set", metavar="NAME", help="場所の設定を更新（未登録なら登録）")
+    parser.add_argument("--display-name")
+    parser.add_argument("--plant-type")
+    parser.add_argument("--dry-threshold", type=float)
+    parser.add_argument("--calibration", help='JSON（例: {"dry_value": 2.8, "wet_value": 1.5}）')
+    parser.add_argument("--sample-interval", type=int, help="想定の記録間隔（秒）")
+    args = parser.parse_args(argv)
+    conn = sqlite3.connect(args.db)
+    try:
+        if args.migrate:
+            size = os.path.getsize(args.db)
+            migrated = ensure_schema(conn)
+            rollups.ensure_index(conn)
+            if migrated:
+                conn.execute("VACUUM")
+                print(f"✅ sensor_data migrated: {size / 1e6:.1f} MB → {os.path.getsize(args.db) / 1e6:.1f} MB")
+            else:
+                print("✅ sensor_data already uses location_id")
+        if args.set:
+            fields = {field: getattr(args, field) for field in FIELDS if getattr(args, field) is not None}
+            if "calibration" in fields:
+                fields["calibration"] = json.loads(fields["calibration"])
+            configure(conn, args.set, **fields)
+            conn.commit()
+        for name in names(conn):
+            print(registry(conn).get(name).to_dict())
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,18 +8,34 @@ from datetime import datetime
 import logging
 import os
 import time
-import smtplib
-from email.mime.text import MIMEText
 from dotenv import load_dotenv
+import metrics
+from alerts import AlertDispatcher, SMTPTransport
+from alert_rules import RuleEngine
+import rollups
+import sketches
+import watering
+import forecasting
+import gaps
+import anomalies
+import locations
+import maintenance
 
 # --- .env読み込み ---
 load_dotenv()
 GMAIL_USER = os.getenv("GMAIL_USER")
 GMAIL_PASS = os.getenv("GMAIL_PASS")
 TO_EMAIL = os.getenv("TO_EMAIL")
+SMTP_HOST = os.getenv("SMTP_HOST", "smtp.gmail.com")
+SMTP_PORT = int(os.getenv("SMTP_PORT", "587"))
+ALERT_DIGEST_SECONDS = float(os.getenv("ALERT_DIGEST_SECONDS", "5"))
+ALERT_COOLDOWN_MINUTES = os.getenv("ALERT_COOLDOWN_MINUTES")  # 全種別共通の上書き（任意）
+# アラートルールの評価場所: "logger"（この処理内）または "sidecar"（alert_rules.py --follow）
+ALERT_ENGINE = os.getenv("ALERT_ENGINE", "logger")
+ALERT_RULES_PATH = os.getenv("ALERT_RULES_PATH", os.path.join(os.path.dirname(__file__), "alert_rules.json"))
 
 # --- センサーロケーション設定 ---
-SENSOR_LOCATION = "ohana_001"  # ← この行を追加
+SENSOR_LOCATION = os.getenv("SENSOR_LOCATION", "ohana_001")
 
 # --- ログ設定 ---
 log_dir = os.path.join(os.path.dirname(__file__), "logs")
@@ -36,38 +52,58 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# --- メトリクス設定 ---
+READ_RETRIES = metrics.counter("sensor_read_retries_total", "Sensor read retries", ("sensor",))
+ANOMALIES = metrics.counter("sensor_anomalies_total", "Readings flagged by the anomaly detector", ("metric", "flag"))
+READ_FAILURES = metrics.counter("sensor_read_failures_total", "Sensor reads that exhausted all retries", ("sensor",))
+DB_COMMIT_SECONDS = metrics.histogram("sensor_db_commit_seconds", "Time to commit a reading to SQLite")
+RUN_SECONDS = metrics.histogram("logger_run_seconds", "Total logger run time")
+LAST_SUCCESS = metrics.gauge("logger_last_success_timestamp_seconds", "Unix time of the last stored reading")
+LAST_VALUE = metrics.gauge("sensor_last_value", "Last stored sensor value", ("metric", "location"))
+# 前回実行までの累積値を引き継ぐ（cron実行のためプロセスは毎回終了する）
+metrics.REGISTRY.restore_textfile(metrics.LOGGER_TEXTFILE)
+run_started = time.perf_counter()
+
 # --- メール送信共通関数 ---
-def send_email(subject, body):
-    msg = MIMEText(body)
-    msg["Subject"] = subject
-    msg["From"] = GMAIL_USER
-    msg["To"] = TO_EMAIL
-    try:
-        with smtplib.SMTP("smtp.gmail.com", 587) as server:
-            server.starttls()
-            server.login(GMAIL_USER, GMAIL_PASS)
-            server.send_message(msg)
-            logger.info("📧 メール送信しました: " + subject)
-    except Exception as e:
-        logger.error(f"❌ メール送信に失敗しました: {e}")
+# 送信はバックグラウンドで行い、データ取得・保存を待たせない
+cooldowns = None
+if ALERT_COOLDOWN_MINUTES:
+    cooldowns = dict.fromkeys(["moisture", "sensor_error", "exception"], float(ALERT_COOLDOWN_MINUTES) * 60)
+dispatcher = AlertDispatcher(
+    SMTPTransport(SMTP_HOST, SMTP_PORT, GMAIL_USER, GMAIL_PASS),
+    sender=GMAIL_USER,
+    recipient=TO_EMAIL,
+    cooldowns=cooldowns,
+    digest_window=ALERT_DIGEST_SECONDS,
+    state_path=os.path.join(log_dir, "alert_state.json"),
+)
+
+def send_email(subject, body, kind, source=SENSOR_LOCATION):
+    dispatcher.submit(kind, subject, body, source)
 
-# --- 水やりアラート通知 ---
-def send_moisture_alert(soil_moisture, timestamp):
-    subject = "💧水やりアラート（土壌湿度低下）"
-    body = f"⚠️ 土壌湿度が {soil_moisture}% に低下しました。\n\n日時: {timestamp}\n\n水やりを検討してください。"
-    send_email(subject, body)
+# --- ルールによるアラート評価（水やりアラート等） ---
+rule_engine = RuleEngine.from_file(ALERT_RULES_PATH)
+rule_state_path = os.path.join(log_dir, "alert_rules_state.json")
+
+def evaluate_alert_rules(timestamp, values):
+    rule_engine.load_state(rule_state_path)
+    for event in rule_engine.process(SENSOR_LOCATION, timestamp, values):
+        logger.info(f"🔔 ルール {event.rule.name}: {event.state}（値: {event.value}）")
+        if event.state == "fired":
+            send_email(event.subject, event.body, event.rule.kind, event.location)
+    rule_engine.save_state(rule_state_path)
 
 # --- 異常通知（センサー失敗） ---
 def send_sensor_error(sensor_name):
     subject = f"❌センサー読み取り失敗: {sensor_name}"
     body = f"{sensor_name} が最大リトライ回数を超えても読み取れませんでした。\nご確認ください。"
-    send_email(subject, body)
+    send_email(subject, body, "sensor_error", f"{SENSOR_LOCATION}/{sensor_name}")
 
 # --- 異常通知（例外） ---
 def send_exception_alert(error_message):
     subject = "❗センサーシステムで例外が発生しました"
     body = f"次のエラーが発生しました：\n\n{error_message}"
-    send_email(subject, body)
+    send_email(subject, body, "exception")
 
 # --- GPIO初期化 ---
 GPIO.setwarnings(False)
@@ -85,6 +121,82 @@ Base.metadata.create_all(engine)
 Session = sessionmaker(bind=engine)
 session = Session()
 
+# --- センサー場所の登録（旧形式のDBは location_id の形式に変換）と土壌センサーの校正値 ---
+raw_conn = engine.raw_connection()
+try:
+    rollups.ensure_index(raw_conn)
+    LOCATION_ID = locations.register(raw_conn, SENSOR_LOCATION)
+    raw_conn.commit()
+    calibration = locations.registry(raw_conn).get(SENSOR_LOCATION).calibration or {}
+finally:
+    raw_conn.close()
+soil_sensor.dry_value = calibration.get("dry_value", soil_sensor.dry_value)
+soil_sensor.wet_value = calibration.get("wet_value", soil_sensor.wet_value)
+
+# --- 異常値の検査 ---
+# 品質フラグ（0 = 正常）を返す。ANOMALY_ACTION=quarantine でフラグが付いた場合は
+# sensor_quarantine に保存し、True を返して sensor_data への保存を止める
+def inspect_reading(timestamp, values):
+    raw_conn = engine.raw_connection()
+    try:
+        anomalies.ensure_column(raw_conn)
+        detector = anomalies.load_detector(raw_conn, SENSOR_LOCATION)
+        quality = detector.check(rollups.naive_epoch(timestamp), values)
+        anomalies.save_detector(raw_conn, SENSOR_LOCATION, detector)
+        quarantined = bool(quality) and anomalies.ANOMALY_ACTION == "quarantine"
+        if quarantined:
+            anomalies.quarantine(raw_conn, timestamp, values, SENSOR_LOCATION, quality)
+        raw_conn.commit()
+    except Exception as e:
+        logger.warning(f"⚠ 異常値の検査に失敗しました: {e}")
+        return 0, False
+    finally:
+        raw_conn.close()
+    for metric, flags in anomalies.describe(quality).items():
+        for flag in flags:
+            ANOMALIES.labels(metric, flag).inc()
+        logger.warning(f"⚠ {metric} の値に品質フラグが付きました: {', '.join(flags)}")
+    return quality, quarantined
+
+# --- 派生データの更新（分位点スケッチ・水やり検出・予測モデル・欠測区間等） ---
+# 水やり状態・予測から求めた値（days_since_watering / hours_until_dry / forecast_hours_until_dry）を返し、
+# アラートルールで参照できるようにする
+def update_derived_data(timestamp, values):
+    raw_conn = engine.raw_connection()
+    derived = {}
+    try:
+        sketches.record_reading(raw_conn, SENSOR_LOCATION, timestamp, values)
+        rollups.record_reading(raw_conn, SENSOR_LOCATION, timestamp, values)
+        detected = 0 if watering.ensure_built(raw_conn) else watering.update(raw_conn, location=SENSOR_LOCATION)
+        if not forecasting.ensure_built(raw_conn):
+            forecasting.update(raw_conn, location=SENSOR_LOCATION)
+        if not gaps.ensure_built(raw_conn):
+            found = gaps.update(raw_conn, location=SENSOR_LOCATION)
+            if found:
+                logger.info(f"📶 {found}件の欠測区間を検出しました")
+        raw_conn.commit()
+        state = watering.status(raw_conn, SENSOR_LOCATION)
+        derived = {**watering.alert_values(state),
+                   **forecasting.alert_values(forecasting.forecast(raw_conn, SENSOR_LOCATION))}
+        if detected:
+            logger.info(f"💧 水やりを検出しました（{state['last_watered']}）")
+    except Exception as e:
+        logger.warning(f"⚠ 派生データの更新に失敗しました: {e}")
+    finally:
+        raw_conn.close()
+    return derived
+
+# --- DBメンテナンス（期限の来た optimize / vacuum / ANALYZE / quick_check を時間予算内で） ---
+def run_maintenance():
+    # ロック待ちを短くするため、エンジンとは別の接続を使う
+    conn = maintenance.connect(db_path)
+    try:
+        maintenance.run_due(conn)
+    except Exception as e:
+        logger.warning(f"⚠ DBメンテナンスに失敗しました: {e}")
+    finally:
+        conn.close()
+
 # --- センサーデータ取得 ---
 try:
     MAX_RETRIES = 3
@@ -100,8 +212,10 @@ try:
             break
         else:
             logger.warning(f"⚠ DHT11 読み取り失敗（{attempt}回目）")
+            READ_RETRIES.labels("DHT11").inc()
             time.sleep(1)
     if not dht_valid:
+        READ_FAILURES.labels("DHT11").inc()
         send_sensor_error("DHT11")
 
     # --- SEN0193 読み取り ---
@@ -113,26 +227,48 @@ try:
             break
         else:
             logger.warning(f"⚠ 土壌湿度センサー 読み取り失敗（{attempt}回目）")
+            READ_RETRIES.labels("SEN0193").inc()
             time.sleep(1)
     if not soil_valid:
+        READ_FAILURES.labels("SEN0193").inc()
         send_sensor_error("SEN0193")
 
     # --- 保存と通知処理 ---
     if dht_valid and soil_valid:
         timestamp = datetime.now()
+        values = {
+            "temperature": temperature,
+            "humidity": humidity,
+            "soil_moisture": soil_moisture,
+        }
+        quality, quarantined = inspect_reading(timestamp, values)
+    if dht_valid and soil_valid and quarantined:
+        logger.info(f"[{timestamp}] Quarantined: Temp={temperature}C, Hum={humidity}%, Moisture={soil_moisture}%")
+    elif dht_valid and soil_valid:
         new_data = SensorData(
             timestamp=timestamp,
             temperature=temperature,
             humidity=humidity,
             soil_moisture=soil_moisture,
-            sensor_location=SENSOR_LOCATION
+            location_id=LOCATION_ID,
+            quality=quality
         )
         session.add(new_data)
-        session.commit()
+        with DB_COMMIT_SECONDS.time():
+            session.commit()
+        LAST_SUCCESS.set(time.time())
+        LAST_VALUE.labels("temperature", SENSOR_LOCATION).set(temperature)
+        LAST_VALUE.labels("humidity", SENSOR_LOCATION).set(humidity)
+        LAST_VALUE.labels("soil_moisture", SENSOR_LOCATION).set(soil_moisture)
         logger.info(f"[{timestamp}] Logged: Temp={temperature}C, Hum={humidity}%, Moisture={soil_moisture}%")
 
-        if soil_moisture < 30.0:
-            send_moisture_alert(soil_moisture, timestamp)
+        # フラグの付いた値は集計・アラートに使わない
+        values = anomalies.masked_values(values, quality)
+        derived = update_derived_data(timestamp, values)
+
+        if ALERT_ENGINE == "logger":
+            evaluate_alert_rules(timestamp, {**values, **derived})
+        run_maintenance()
     else:
         logger.info("⚠ 有効なセンサーが揃っていないため、データは保存されませんでした")
 
@@ -143,3 +279,10 @@ except Exception as e:
 finally:
     session.close()
     GPIO.cleanup()
+    # 未送信のアラートを送り切ってから終了
+    dispatcher.close(timeout=60)
+    RUN_SECONDS.observe(time.perf_counter() - run_started)
+    try:
+        metrics.REGISTRY.write_textfile(metrics.LOGGER_TEXTFILE)
+    except OSError as e:
+        logger.warning(f"⚠ メトリクスの書き出しに失敗しました: {e}")
@@ -0,0 +1,472 @@
+# -*- coding: utf-8 -*-
+"""
+Online database maintenance (PRAGMA optimize / incremental vacuum / ANALYZE / quick_check)
+
+ダッシュボードとロガーの空き時間に、期限の来た作業だけを時間予算（MAINTENANCE_BUDGET_SECONDS）の
+範囲で実行する:
+
+    optimize            PRAGMA optimize（1時間ごと）
+    incremental_vacuum  空きページを VACUUM_PAGES ずつファイルから切り詰める
+                        （auto_vacuum = INCREMENTAL のDBで、空きが VACUUM_MIN_BYTES 以上のとき）
+    analyze             テーブルごとの ANALYZE（1日ごと。analysis_limit で標本だけを読む）
+    quick_check         テーブルごとの PRAGMA quick_check（1日ごと）
+
+予算はプログレスハンドラーで守る。期限を過ぎるか should_stop() が真になると実行中の文を中断し、
+残りの作業は次の機会に回す。書き込みロックを取る作業（vacuum / analyze）は小さく区切って
+その都度コミットするので、30秒ごとの更新リクエストや cron のロガーを長く待たせない。
+ダッシュボードではリクエストが IDLE_SECONDS 来ていない間だけ動き、リクエストが届いたら中断する。
+
+各作業の前後のDBサイズ（空きページを含む）を maintenance_runs テーブルに残し、ログとメトリクスにも出す。
+ダッシュボードと同じ形の問い合わせ（直近24時間の場所別集計）の所要時間は、1回の実行の前後に
+予算の外で1度ずつ測り、その実行の行に記録する。
+
+既存のDBで incremental vacuum を使うには一度だけ（ダッシュボードとロガーを止めて）変換する:
+    python maintenance.py --enable-incremental
+"""
+
+import argparse
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+import metrics
+import rollups
+
+logger = logging.getLogger(__name__)
+
+# 1回の実行に使う時間（秒）。0 で無効
+BUDGET_SECONDS = float(os.getenv("MAINTENANCE_BUDGET_SECONDS", "2"))
+# 最後のリクエストからこの秒数が経つまでは始めない（ダッシュボード）
+IDLE_SECONDS = float(os.getenv("MAINTENANCE_IDLE_SECONDS", "5"))
+# ダッシュボードで期限を確認する間隔（秒）
+CHECK_INTERVAL_SECONDS = 60
+OPTIMIZE_SECONDS = 3600
+ANALYZE_SECONDS = 24 * 3600
+QUICK_CHECK_SECONDS = 24 * 3600
+# 1回のコミットで切り詰めるページ数と、その後に他の接続へ譲る時間（秒）
+VACUUM_PAGES = 256
+VACUUM_PAUSE = 0.02
+VACUUM_MIN_BYTES = 1 << 20
+# ANALYZE で1索引あたりに読む行数の上限（PRAGMA analysis_limit）
+ANALYSIS_LIMIT = 1000
+# プログレスハンドラーを呼ぶ間隔（VM命令数）
+PROGRESS_STEPS = 1000
+# 他の接続のロックを待つ時間（秒）。待たずに次の機会に回す
+BUSY_TIMEOUT = 0.2
+# 残す実行記録の日数
+KEEP_DAYS = 90
+
+AUTO_VACUUM_MODES = {0: "none", 1: "full", 2: "incremental"}
+
+CREATE_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS maintenance_runs (
+        id INTEGER PRIMARY KEY,
+        task TEXT NOT NULL,
+        target TEXT NOT NULL DEFAULT '',
+        started INTEGER NOT NULL,
+        seconds REAL NOT NULL,
+        result TEXT NOT NULL,
+        bytes_before INTEGER,
+        bytes_after INTEGER,
+        free_bytes_before INTEGER,
+        free_bytes_after INTEGER,
+        probe_ms_before REAL,
+        probe_ms_after REAL,
+        detail TEXT
+    )
+'''
+
+RUNS = metrics.counter("db_maintenance_runs_total", "Database maintenance tasks run", ("task", "result"))
+TASK_SECONDS = metrics.histogram("db_maintenance_seconds", "Time spent in a database maintenance task", ("task",))
+RECLAIMED_BYTES = metrics.counter("db_maintenance_reclaimed_bytes_total", "Bytes returned to the filesystem by incremental vacuum")
+DB_BYTES = metrics.gauge("db_file_bytes", "Size of the database file")
+FREE_BYTES = metrics.gauge("db_free_bytes", "Bytes in free pages of the database file")
+PROBE_SECONDS = metrics.gauge("db_probe_query_seconds", "Time of the dashboard-shaped probe query after the last maintenance run")
+
+
+def ensure_table(conn):
+    conn.execute(CREATE_TABLE_SQL)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_maintenance_task ON maintenance_runs(task, target, started)")
+
+
+def connect(db_path):
+    return sqlite3.connect(db_path, timeout=BUSY_TIMEOUT)
+
+
+# --- 時間予算 ---
+class Budget:
+    """期限と中断条件。exhausted() が真になったら作業を止める"""
+
+    def __init__(self, seconds, should_stop=None):
+        self.deadline = time.monotonic() + seconds
+        self.should_stop = should_stop
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def exhausted(self):
+        return self.remaining() <= 0 or (self.should_stop is not None and bool(self.should_stop()))
+
+
+def _interrupted(error):
+    return "interrupted" in str(error)
+
+
+# --- 計測 ---
+def space(conn):
+    """(DBのバイト数, 空きページのバイト数)"""
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    freelist = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return page_count * page_size, freelist * page_size
+
+
+def auto_vacuum_mode(conn):
+    return AUTO_VACUUM_MODES.get(conn.execute("PRAGMA auto_vacuum").fetchone()[0], "none")
+
+
+def probe(conn, table_name="sensor_data", repeat=3):
+    """ダッシュボードと同じ形の問い合わせ（最新の場所の直近24時間の件数・平均）の最短時間（ミリ秒）"""
+    if not rollups.table_exists(conn, table_name) or not rollups.table_exists(conn, "locations"):
+        return None
+    # 最新の行は場所ごとの MAX(timestamp) で探す（(location_id, timestamp) の索引の端を読むだけ。
+    # id の順は取り込みで過去の行を足すと時刻の順と一致しない）
+    latest_rows = [(conn.execute(f"SELECT MAX(timestamp) FROM {table_name} WHERE location_id = ?",
+                                 (location_id,)).fetchone()[0], location_id)
+                   for (location_id,) in conn.execute("SELECT id FROM locations").fetchall()]
+    latest_rows = [row for row in latest_rows if row[0] is not None]
+    if not latest_rows:
+        return None
+    latest, location_id = max(latest_rows)
+    since = (datetime.fromisoformat(latest) - timedelta(days=1)).strftime("%Y-%m-%d %H:%M:%S")
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        conn.execute(f'''
+            SELECT COUNT(*), AVG(temperature), AVG(humidity), AVG(soil_moisture) FROM {table_name}
+            WHERE location_id = ? AND timestamp >= ?
+        ''', (location_id, since)).fetchone()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(best * 1000, 3)
+
+
+# --- 作業 ---
+class IntegrityError(Exception):
+    """quick_check が問題を報告した"""
+
+
+def user_tables(conn):
+    return [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name")]
+
+
+def last_success(conn, task, target=""):
+    row = conn.execute('''
+        SELECT MAX(started) FROM maintenance_runs WHERE task = ? AND target = ? AND result = 'ok'
+    ''', (task, target)).fetchone()
+    return row[0] or 0
+
+
+def due_tasks(conn, now=None, force=False):
+    """期限の来た (作業, 対象) のリスト。最後に成功した時刻が古い順"""
+    ensure_table(conn)
+    now = time.time() if now is None else now
+    tasks = []
+    if auto_vacuum_mode(conn) == "incremental" and space(conn)[1] >= VACUUM_MIN_BYTES:
+        tasks.append((0, "incremental_vacuum", ""))
+    for task, target, interval in [("optimize", "", OPTIMIZE_SECONDS),
+                                   *(("analyze", t, ANALYZE_SECONDS) for t in user_tables(conn)),
+                                   *(("quick_check", t, QUICK_CHECK_SECONDS) for t in user_tables(conn))]:
+        last = last_success(conn, task, target)
+        if force or now - last >= interval:
+            tasks.append((last, task, target))
+    # 空き領域の回収と optimize を先に、残りは古いものから
+    order = {"incremental_vacuum": 0, "optimize": 1}
+    tasks.sort(key=lambda t: (order.get(t[1], 2), t[0]))
+    return [(task, target) for _, task, target in tasks]
+
+
+def _optimize(conn, target, budget):
+    conn.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+    conn.execute("PRAGMA optimize").fetchall()
+    return None
+
+
+def _incremental_vacuum(conn, target, budget):
+    reclaimed_pages = 0
+    while not budget.exhausted():
+        free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if not free:
+            break
+        # 1ページごとに結果の無い行が返るので、execute() では1ページしか進まない。
+        # executescript() は最後まで実行してコミットする
+        conn.executescript(f"PRAGMA incremental_vacuum({min(free, VACUUM_PAGES)});")
+        reclaimed_pages += min(free, VACUUM_PAGES)
+        # 待っている読み手・書き手にロックを譲る
+        time.sleep(VACUUM_PAUSE)
+    return f"{reclaimed_pages} pages"
+
+
+def _analyze(conn, target, budget):
+    conn.execute(f"PRAGMA analysis_limit = {ANALYSIS_LIMIT}")
+    conn.execute(f'ANALYZE "{target}"')
+    conn.commit()
+    return None
+
+
+def _quick_check(conn, target, budget):
+    rows = [row[0] for row in conn.execute(f'PRAGMA quick_check("{target}")')]
+    if rows != ["ok"]:
+        raise IntegrityError("; ".join(rows[:5]))
+    return None
+
+
+TASKS = {
+    "optimize": _optimize,
+    "incremental_vacuum": _incremental_vacuum,
+    "analyze": _analyze,
+    "quick_check": _quick_check,
+}
+# 実行の前後に問い合わせ時間を測る作業（quick_check は読むだけなので、これだけなら測らない）
+PROBED = {"optimize", "incremental_vacuum", "analyze"}
+
+
+def run_task(conn, task, target, budget):
+    """1つの作業を実行して maintenance_runs に記録し、記録した値の dict を返す
+
+    問い合わせ時間（probe_ms_before / probe_ms_after）は run_due が実行の前後に測って書き込む。
+    """
+    bytes_before, free_before = space(conn)
+    started = time.time()
+    timer = time.perf_counter()
+    conn.set_progress_handler(lambda: int(budget.exhausted()), PROGRESS_STEPS)
+    detail = None
+    try:
+        detail = TASKS[task](conn, target, budget)
+        result = "ok"
+    except IntegrityError as e:
+        result, detail = "corrupt", str(e)
+    except sqlite3.DatabaseError as e:
+        conn.rollback()
+        if _interrupted(e):
+            result = "interrupted"
+        elif "locked" in str(e) or "busy" in str(e):
+            result = "busy"
+        else:
+            result, detail = "error", str(e)
+    finally:
+        conn.set_progress_handler(None, 0)
+    seconds = time.perf_counter() - timer
+    bytes_after, free_after = space(conn)
+    record = {
+        "task": task,
+        "target": target,
+        "started": int(started),
+        "seconds": round(seconds, 4),
+        "result": result,
+        "bytes_before": bytes_before,
+        "bytes_after": bytes_after,
+        "free_bytes_before": free_before,
+        "free_bytes_after": free_after,
+        "probe_ms_before": None,
+        "probe_ms_after": None,
+        "detail": detail,
+    }
+    record["id"] = conn.execute(f'''
+        INSERT INTO maintenance_runs ({", ".join(record)}) VALUES ({", ".join("?" for _ in record)})
+    ''', tuple(record.values())).lastrowid
+    conn.commit()
+    RUNS.labels(task, result).inc()
+    TASK_SECONDS.labels(task).observe(seconds)
+    if bytes_before > bytes_after:
+        RECLAIMED_BYTES.inc(bytes_before - bytes_after)
+    DB_BYTES.set(bytes_after)
+    FREE_BYTES.set(free_after)
+    return record
+
+
+def describe(record):
+    """ログ用の1行"""
+    name = record["task"] + (f"({record['target']})" if record["target"] else "")
+    text = f"{name}: {record['result']} in {record['seconds'] * 1000:.0f} ms"
+    reclaimed = record["bytes_before"] - record["bytes_after"]
+    if reclaimed:
+        text += f", reclaimed {reclaimed / 1024:,.0f} KiB"
+    if record["detail"]:
+        text += f" ({record['detail']})"
+    return text
+
+
+def summarize(records):
+    """1回の実行をまとめたログ用の1行（回収した領域と、実行の前後の問い合わせ時間）"""
+    results = {}
+    for record in records:
+        results[record["result"]] = results.get(record["result"], 0) + 1
+    text = (f"{len(records)} maintenance tasks in {sum(r['seconds'] for r in records) * 1000:.0f} ms ("
+            + ", ".join(f"{result}={count}" for result, count in results.items()) + ")")
+    reclaimed = records[0]["bytes_before"] - records[-1]["bytes_after"]
+    text += f", reclaimed {reclaimed / 1024:,.0f} KiB, {records[-1]['free_bytes_after'] / 1024:,.0f} KiB still free"
+    if records[0]["probe_ms_before"] is not None and records[0]["probe_ms_after"] is not None:
+        text += f", probe {records[0]['probe_ms_before']:.2f} → {records[0]['probe_ms_after']:.2f} ms"
+    return text
+
+
+def run_due(conn, budget_seconds=BUDGET_SECONDS, should_stop=None, force=False, table_name="sensor_data"):
+    """期限の来た作業を予算の範囲で順に実行し、記録のリストを返す
+
+    問い合わせ時間は作業の前後ではなく実行全体の前後に1度ずつ、予算の外で測る。
+    """
+    if budget_seconds <= 0:
+        return []
+    records = []
+    try:
+        tasks = due_tasks(conn, force=force)
+        conn.commit()
+    except sqlite3.OperationalError as e:
+        logger.info(f"🧹 DBメンテナンスを見送りました: {e}")
+        return records
+    probed = any(task in PROBED for task, _ in tasks)
+    probe_before = probe(conn, table_name) if probed else None
+    budget = Budget(budget_seconds, should_stop)
+    for task, target in tasks:
+        if budget.exhausted():
+            break
+        try:
+            record = run_task(conn, task, target, budget)
+        except sqlite3.OperationalError as e:
+            # 記録の書き込みがロック待ちで失敗した場合など。次の機会に回す
+            conn.rollback()
+            logger.info(f"🧹 DBメンテナンスを中断しました: {e}")
+            break
+        records.append(record)
+        if record["result"] == "corrupt":
+            logger.error(f"🧹 {describe(record)}")
+        elif record["result"] == "error":
+            logger.warning(f"🧹 {describe(record)}")
+        else:
+            logger.debug(f"🧹 {describe(record)}")
+        if record["result"] in ("interrupted", "busy"):
+            break
+    if records:
+        changed = any(r["task"] in PROBED and r["result"] == "ok" for r in records)
+        probe_after = probe(conn, table_name) if changed else None
+        if probe_before is not None or probe_after is not None:
+            for record in records:
+                record["probe_ms_before"], record["probe_ms_after"] = probe_before, probe_after
+            conn.executemany("UPDATE maintenance_runs SET probe_ms_before = ?, probe_ms_after = ? WHERE id = ?",
+                             [(probe_before, probe_after, r["id"]) for r in records])
+        if probe_after is not None:
+            PROBE_SECONDS.set(probe_after / 1000)
+        logger.info(f"🧹 {summarize(records)}")
+        conn.execute("DELETE FROM maintenance_runs WHERE started < ?", (int(time.time()) - KEEP_DAYS * 86400,))
+        conn.commit()
+    return records
+
+
+# --- ダッシュボード用のスケジューラー ---
+class Scheduler:
+    """リクエストが IDLE_SECONDS 来ていない間に run_due() を呼ぶバックグラウンドスレッド"""
+
+    def __init__(self, db_path, budget_seconds=BUDGET_SECONDS, idle_seconds=IDLE_SECONDS,
+                 interval=CHECK_INTERVAL_SECONDS):
+        self.db_path = db_path
+        self.budget_seconds = budget_seconds
+        self.idle_seconds = idle_seconds
+        self.interval = interval
+        self.last_request = time.monotonic()
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self.budget_seconds > 0
+
+    def touch(self):
+        """リクエストの到着を記録する（実行中の作業はこれで中断される）"""
+        self.last_request = time.monotonic()
+
+    def idle(self):
+        return time.monotonic() - self.last_request >= self.idle_seconds
+
+    def start(self):
+        if not self.enabled or self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="db-maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            # 更新リクエストの合間を待つ
+            while not self.idle() and not self._stop.wait(min(1.0, self.idle_seconds)):
+                pass
+            if self._stop.is_set() or not os.path.exists(self.db_path):
+                continue
+            conn = connect(self.db_path)
+            try:
+                run_due(conn, self.budget_seconds, should_stop=lambda: not self.idle())
+            except Exception as e:
+                logger.warning(f"⚠ DBメンテナンスに失敗しました: {e}")
+            finally:
+                conn.close()
+
+
+# --- 状態表示・変換 ---
+def status(conn):
+    ensure_table(conn)
+    size, free = space(conn)
+    last = {}
+    for task, result, started in conn.execute('''
+        SELECT task, result, MAX(started) FROM maintenance_runs GROUP BY task, result
+    '''):
+        last.setdefault(task, {})[result] = datetime.fromtimestamp(started).strftime("%Y-%m-%d %H:%M:%S")
+    return {
+        "file_bytes": size,
+        "free_bytes": free,
+        "auto_vacuum": auto_vacuum_mode(conn),
+        "probe_ms": probe(conn),
+        "last_runs": last,
+    }
+
+
+def enable_incremental(conn):
+    """auto_vacuum を INCREMENTAL にして VACUUM する（DB全体を書き直すので一度だけ、他の接続を止めて実行）"""
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+    return auto_vacuum_mode(conn)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run online database maintenance within a time budget")
+    parser.add_argument("--db", default=os.getenv("SENSOR_DB_PATH", "sensor_data.db"))
+    parser.add_argument("--budget", type=float, default=BUDGET_SECONDS or 2.0, help="使う時間（秒）")
+    parser.add_argument("--force", action="store_true", help="期限に関係なく全ての作業を実行する")
+    parser.add_argument("--status", action="store_true", help="DBのサイズ・空き領域と最後の実行を表示")
+    parser.add_argument("--enable-incremental", action="store_true",
+                        help="auto_vacuum を INCREMENTAL に変換する（VACUUM でDB全体を書き直す）")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    conn = sqlite3.connect(args.db)
+    try:
+        if args.enable_incremental:
+            before = space(conn)[0]
+            print(f"✅ auto_vacuum={enable_incremental(conn)} ({before:,} → {space(conn)[0]:,} bytes)")
+        elif args.status:
+            for key, value in status(conn).items():
+                print(f"{key}: {value}")
+        else:
+            conn.execute(f"PRAGMA busy_timeout = {int(BUSY_TIMEOUT * 1000)}")
+            records = run_due(conn, args.budget, force=args.force)
+            print(f"✅ {len(records)} maintenance tasks run")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
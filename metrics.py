@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+"""
+Lightweight metrics registry (Prometheus text format)
+
+log_sensor_data.py / dht11.py / sen0193.py / dashboard.py で共有する
+カウンター・ゲージ・ヒストグラム。記録処理は属性の加算とbisect程度に抑えており、
+DHT11の読み取りパスに置いたままでも影響しない。
+
+ロガーはcronで毎回終了するプロセスのため、終了時に write_textfile() で
+logs/logger.prom に書き出し、次回起動時に restore_textfile() で値を引き継ぐ。
+ダッシュボードの /metrics は自身のメトリクスとこのファイルをまとめて返す。
+"""
+
+import os
+import re
+import tempfile
+import threading
+from bisect import bisect_left
+from time import perf_counter as _perf_counter
+
+# 秒単位のデフォルトバケット
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_SAMPLE_RE = re.compile(r'^([a-zA-Z_:][a-zA-Z0-9_:]*)(?:\{(.*)\})?\s+(\S+)$')
+_LABEL_RE = re.compile(r'(\w+)="((?:[^"\\]|\\.)*)"')
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class _HistogramChild:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最後は +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        return _Timer(self)
+
+    def quantile(self, q):
+        """バケット上限による分位点の近似値（データがなければNone）"""
+        if self.count == 0:
+            return None
+        target = q * self.count
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= target:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+class _Timer:
+    """with HISTOGRAM.time(): ... で経過秒数を記録"""
+
+    __slots__ = ("child", "start")
+
+    def __init__(self, child):
+        self.child = child
+
+    def __enter__(self):
+        self.start = _perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.child.observe(_perf_counter() - self.start)
+        return False
+
+
+class _Metric:
+    """ラベル付きメトリクスの共通部分。ラベルなしの場合は自身が値を持つ"""
+
+    type_name = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._default = self._children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values, **kwargs):
+        """ラベル値に対応する子メトリクスを返す（ホットパスでは事前に取得しておく）"""
+        if kwargs:
+            values = tuple(kwargs[n] for n in self.labelnames)
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def items(self):
+        return sorted(self._children.items())
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type_name}"]
+        for key, child in self.items():
+            lines.extend(self._expose_child(key, child))
+        return lines
+
+    def _expose_child(self, key, child):
+        return [f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(child.value)}"]
+
+
+class Counter(_Metric):
+    type_name = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def set(self, value):
+        self._default.value = value
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+    def dec(self, amount=1):
+        self._default.value -= amount
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def time(self):
+        return _Timer(self._default)
+
+    def _expose_child(self, key, child):
+        lines = []
+        cumulative = 0
+        for bound, c in zip(self.buckets + (float("inf"),), child.counts):
+            cumulative += c
+            le = f'le="{_format_value(float(bound))}"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}")
+        labels = _format_labels(self.labelnames, key)
+        lines.append(f"{self.name}_sum{labels} {_format_value(child.sum)}")
+        lines.append(f"{self.name}_count{labels} {child.count}")
+        return lines
+
+
+class Registry:
+    """メトリクスの登録と Prometheus テキスト形式での出力"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, documentation, labelnames=(), **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, documentation, labelnames, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"metric {name} already registered as {metric.type_name}")
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter, name, documentation, labelnames)
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge, name, documentation, labelnames)
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def expose(self):
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].expose())
+        return "\n".join(lines) + "\n"
+
+    # --- テキストファイル経由の受け渡し（cronで動くロガー用） ---
+    def write_textfile(self, path):
+        """一時ファイル経由でアトミックに書き出す"""
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".metrics-")
+        with os.fdopen(fd, "w") as f:
+            f.write(self.expose())
+        os.replace(tmp_path, path)
+
+    def restore_textfile(self, path):
+        """前回書き出した値を読み込み、カウンターとヒストグラムを累積させる"""
+        if not os.path.exists(path):
+            return
+        with open(path) as f:
+            for line in f:
+                if not line.strip() or line.startswith("#"):
+                    continue
+                match = _SAMPLE_RE.match(line.strip())
+                if match:
+                    self._restore_sample(*match.groups())
+
+    def _restore_sample(self, sample_name, label_text, value_text):
+        labels = dict(_LABEL_RE.findall(label_text or ""))
+        value = float(value_text)
+        metric = self._metrics.get(sample_name)
+        if isinstance(metric, Counter):
+            metric.labels(*(labels.get(n, "") for n in metric.labelnames)).value = value
+            return
+        for suffix in ("_bucket", "_sum", "_count"):
+            if not sample_name.endswith(suffix):
+                continue
+            metric = self._metrics.get(sample_name[:-len(suffix)])
+            if not isinstance(metric, Histogram):
+                return
+            child = metric.labels(*(labels.get(n, "") for n in metric.labelnames))
+            if suffix == "_sum":
+                child.sum = value
+            elif suffix == "_count":
+                child.count = int(value)
+            else:
+                # 累積値から各バケットの個数に戻す
+                le = labels.get("le")
+                index = len(metric.buckets) if le == "+Inf" else metric.buckets.index(float(le)) if float(le) in metric.buckets else None
+                if index is not None:
+                    child.counts[index] = int(value) - sum(child.counts[:index])
+            return
+
+
+def merge_expositions(sources):
+    """(プロセス名, テキスト形式) の並びを1つのテキストにまとめる
+
+    複数のプロセスが同じ名前のメトリクスを持つと HELP / TYPE が重複して不正な出力になるため、
+    同じ名前のメトリクスは1つにまとめ、各サンプルに process ラベルを付けて区別する。
+    """
+    families = {}
+    for process, text in sources:
+        family = None
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith("#"):
+                parts = line.split(None, 3)
+                if len(parts) >= 3 and parts[1] in ("HELP", "TYPE"):
+                    family = families.setdefault(parts[2], {"HELP": None, "TYPE": None, "samples": []})
+                    if family[parts[1]] is None:
+                        family[parts[1]] = line
+                continue
+            match = _SAMPLE_RE.match(line)
+            if not match or family is None:
+                continue
+            name, label_text, value = match.groups()
+            label = f'process="{_escape(process)}"'
+            family["samples"].append(f"{name}{{{label}{',' + label_text if label_text else ''}}} {value}")
+    lines = []
+    for family in families.values():
+        lines.extend(line for line in (family["HELP"], family["TYPE"]) if line)
+        lines.extend(family["samples"])
+    return "\n".join(lines) + "\n"
+
+
+# プロセス共通のデフォルトレジストリ
+REGISTRY = Registry()
+
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+# ロガーのメトリクスファイル（ダッシュボードの /metrics からも読む）
+LOGGER_TEXTFILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "logs", "logger.prom")
@@ -1,9 +1,22 @@
-from sqlalchemy import Column, Integer, Float, String, DateTime
+from sqlalchemy import Column, Integer, Float, String, DateTime, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime
 
 Base = declarative_base()
 
+class Location(Base):
+    # 場所ごとの設定（locations.py。sensor_data からは id で参照する）
+    __tablename__ = 'locations'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False, unique=True)
+    display_name = Column(String)
+    plant_type = Column(String)
+    dry_threshold = Column(Float)
+    calibration = Column(String)  # JSON（例: {"dry_value": 2.8, "wet_value": 1.5}）
+    sample_interval = Column(Integer)
+    revision = Column(Integer, nullable=False, default=0, server_default='0')
+
 class SensorData(Base):
     __tablename__ = 'sensor_data'
 
@@ -12,3 +25,11 @@ class SensorData(Base):
     temperature = Column(Float)
     humidity = Column(Float)
     soil_moisture = Column(Float)
+    location_id = Column(Integer, ForeignKey('locations.id'))
+    # 品質フラグ（anomalies.py。0 = 正常）
+    quality = Column(Integer, nullable=False, default=0)
+
+    # 場所ごとの期間指定の読み出しを範囲走査にする（rollups.LOCATION_TIME_INDEX と同名）
+    __table_args__ = (
+        Index('idx_sensor_data_location_timestamp', 'location_id', 'timestamp'),
+    )
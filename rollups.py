@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""
+Pre-aggregated rollups of sensor_data
+
+場所ごとに1時間・1日単位の部分集計（件数・合計・二乗和・最小・最大）を
+sensor_rollups テーブルに保持する。部分集計はマージ可能なので、
+1時間の倍数のバケット（6時間・1週間など）は時間単位ロールアップから、
+1日の倍数は日単位ロールアップから作れる。生データを走査するのは
+1時間未満のバケットか生データ表示のときだけになる。
+
+時刻はタイムゾーンなしの日時をUTCとみなしたUNIX秒（SQLiteの strftime('%s') と同じ）。
+
+ロガーは読み取りごとに record_reading() で更新する。テーブルが無い場合は
+初回に sensor_data から作成する。手動での作り直し:
+    python rollups.py --rebuild
+"""
+
+import argparse
+import calendar
+import os
+import sqlite3
+import time
+from datetime import datetime
+
+import anomalies
+import locations
+
+METRICS = ("temperature", "humidity", "soil_moisture")
+
+# ロールアップの粒度（秒）。粗い順
+TIERS = (86400, 3600)
+
+LOCATION_TIME_INDEX = "idx_sensor_data_location_timestamp"
+
+_METRIC_COLUMNS = ",\n        ".join(
+    f"{m}_count INTEGER NOT NULL DEFAULT 0, {m}_sum REAL NOT NULL DEFAULT 0, "
+    f"{m}_sumsq REAL NOT NULL DEFAULT 0, {m}_min REAL, {m}_max REAL"
+    for m in METRICS)
+
+CREATE_TABLE_SQL = f'''
+    CREATE TABLE IF NOT EXISTS sensor_rollups (
+        sensor_location TEXT NOT NULL,
+        width INTEGER NOT NULL,
+        bucket_start INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        {_METRIC_COLUMNS},
+        PRIMARY KEY (sensor_location, width, bucket_start)
+    ) WITHOUT ROWID
+'''
+
+PARTIAL_COLUMNS = [f"{m}_{part}" for m in METRICS for part in ("count", "sum", "sumsq", "min", "max")]
+
+
+def naive_epoch(dt):
+    """タイムゾーンなしの日時をUTCとみなしてUNIX秒に変換"""
+    return calendar.timegm(dt.timetuple())
+
+
+def table_exists(conn, name):
+    row = conn.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name=?", (name,)).fetchone()
+    return row is not None
+
+
+def ensure_index(conn, table_name="sensor_data"):
+    """(location_id, timestamp) の索引を作成（期間指定の読み出しを範囲走査にする）
+
+    旧形式（場所名の文字列の列）のテーブルは先に location_id の形式に変換する。
+    """
+    locations.ensure_schema(conn, table_name)
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {LOCATION_TIME_INDEX} ON {table_name} (location_id, timestamp)")
+
+
+def ensure_built(conn, table_name="sensor_data"):
+    """ロールアップテーブルが無ければ作成して既存データから構築する。構築した場合 True"""
+    if not table_exists(conn, table_name):
+        return False
+    ensure_index(conn, table_name)
+    anomalies.ensure_column(conn, table_name)
+    if table_exists(conn, "sensor_rollups"):
+        return False
+    rebuild(conn, table_name)
+    return True
+
+
+def rebuild(conn, table_name="sensor_data", location=None, start_epoch=None, end_epoch=None):
+    """sensor_data からロールアップを作り直す（集計はSQLite内で行う。品質フラグの付いた値は除外）
+
+    location を指定した場合はその場所だけ、start_epoch / end_epoch を指定した場合は
+    その期間を含む日の分だけを作り直す。
+    """
+    ensure_index(conn, table_name)
+    anomalies.ensure_column(conn, table_name)
+    conn.execute(CREATE_TABLE_SQL)
+    data_conditions, data_params, rollup_conditions, rollup_params = [], [], [], []
+    if location is not None:
+        data_conditions.append("location_id = ?")
+        data_params.append(locations.location_id(conn, location))
+        rollup_conditions.append("sensor_location = ?")
+        rollup_params.append(location)
+    if start_epoch is not None:
+        first_day, end_day = start_epoch // 86400 * 86400, -(-end_epoch // 86400) * 86400
+        data_conditions.append("timestamp >= ? AND timestamp < ?")
+        data_params += [time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(t)) for t in (first_day, end_day)]
+        rollup_conditions.append("bucket_start >= ? AND bucket_start < ?")
+        rollup_params += [first_day, end_day]
+    data_where = " WHERE " + " AND ".join(data_conditions) if data_conditions else ""
+    rollup_where = " WHERE " + " AND ".join(rollup_conditions) if rollup_conditions else ""
+    conn.execute(f"DELETE FROM sensor_rollups{rollup_where}", rollup_params)
+    conn.execute(f'''
+        INSERT INTO sensor_rollups (sensor_location, width, bucket_start, count, {", ".join(PARTIAL_COLUMNS)})
+        SELECT l.name, 3600, (CAST(strftime('%s', timestamp) AS INTEGER) / 3600) * 3600,
+               COUNT(*), {_partial_select()}
+        FROM (SELECT location_id, timestamp, {anomalies.masked_columns()} FROM {table_name}{data_where}) d
+        JOIN locations l ON l.id = d.location_id
+        GROUP BY d.location_id, CAST(strftime('%s', timestamp) AS INTEGER) / 3600
+    ''', data_params)
+    # 日単位は時間単位ロールアップをさらにまとめる
+    conn.execute(f'''
+        INSERT INTO sensor_rollups (sensor_location, width, bucket_start, count, {", ".join(PARTIAL_COLUMNS)})
+        SELECT sensor_location, 86400, (bucket_start / 86400) * 86400, SUM(count), {_merged_select()}
+        FROM sensor_rollups
+        WHERE {" AND ".join(["width = 3600", *rollup_conditions])}
+        GROUP BY sensor_location, bucket_start / 86400
+    ''', rollup_params)
+    conn.commit()
+
+
+def _upsert_sql():
+    updates = ["count = count + 1"]
+    for m in METRICS:
+        updates.append(f"{m}_count = {m}_count + excluded.{m}_count")
+        updates.append(f"{m}_sum = {m}_sum + excluded.{m}_sum")
+        updates.append(f"{m}_sumsq = {m}_sumsq + excluded.{m}_sumsq")
+        updates.append(f"{m}_min = CASE WHEN {m}_min IS NULL OR excluded.{m}_min < {m}_min THEN excluded.{m}_min ELSE {m}_min END")
+        updates.append(f"{m}_max = CASE WHEN {m}_max IS NULL OR excluded.{m}_max > {m}_max THEN excluded.{m}_max ELSE {m}_max END")
+    placeholders = ", ".join("?" for _ in range(4 + len(PARTIAL_COLUMNS)))
+    return f'''
+        INSERT INTO sensor_rollups (sensor_location, width, bucket_start, count, {", ".join(PARTIAL_COLUMNS)})
+        VALUES ({placeholders})
+        ON CONFLICT (sensor_location, width, bucket_start) DO UPDATE SET {", ".join(updates)}
+    '''
+
+
+UPSERT_SQL = _upsert_sql()
+
+
+def record_reading(conn, location, timestamp, values, table_name="sensor_data"):
+    """1件の読み取り値を各粒度のロールアップに加算する（コミットは呼び出し側）
+
+    テーブルが無かった場合は sensor_data から構築する（この読み取りも含まれる）。
+    """
+    if ensure_built(conn, table_name):
+        return
+    if isinstance(timestamp, str):
+        timestamp = datetime.fromisoformat(timestamp)
+    epoch = naive_epoch(timestamp)
+    partials = []
+    for m in METRICS:
+        value = values.get(m)
+        if value is None:
+            partials.extend((0, 0.0, 0.0, None, None))
+        else:
+            partials.extend((1, value, value * value, value, value))
+    for width in TIERS:
+        conn.execute(UPSERT_SQL, (location, width, (epoch // width) * width, 1, *partials))
+
+
+def choose_tier(bucket_seconds, origin=0):
+    """要求バケットを満たす最も粗いロールアップ粒度（無ければ None = 生データ）"""
+    if not bucket_seconds:
+        return None
+    for width in TIERS:
+        if bucket_seconds >= width and bucket_seconds % width == 0 and origin % width == 0:
+            return width
+    return None
+
+
+def fetch_partials(cursor, width, location, start_epoch, end_epoch, table_name="sensor_data"):
+    """ロールアップ行を時刻順に返す: (bucket_start, count, *PARTIAL_COLUMNS)
+
+    location が None の場合は全ての場所を合算する。期間に収まるバケットはロールアップから読み、
+    期間の端で一部しか含まれないバケットは期間内の sensor_data の行だけから同じ形で集計する
+    （期間の前後の行を数えない）。アーカイブで sensor_data から削除した月に掛かる端は数えない。
+    """
+    first = -(-start_epoch // width) * width
+    last = end_epoch // width * width
+    if first >= last:
+        return _raw_partials(cursor, table_name, width, location, start_epoch, end_epoch)
+    rows = _raw_partials(cursor, table_name, width, location, start_epoch, first) if start_epoch < first else []
+    if location is not None:
+        rows += cursor.execute(f'''
+            SELECT bucket_start, count, {", ".join(PARTIAL_COLUMNS)}
+            FROM sensor_rollups
+            WHERE sensor_location = ? AND width = ? AND bucket_start >= ? AND bucket_start < ?
+            ORDER BY bucket_start
+        ''', (location, width, first, last)).fetchall()
+    else:
+        rows += cursor.execute(f'''
+            SELECT bucket_start, SUM(count), {_merged_select()}
+            FROM sensor_rollups
+            WHERE width = ? AND bucket_start >= ? AND bucket_start < ?
+            GROUP BY bucket_start
+            ORDER BY bucket_start
+        ''', (width, first, last)).fetchall()
+    if last < end_epoch:
+        rows += _raw_partials(cursor, table_name, width, location, last, end_epoch)
+    return rows
+
+
+def _partial_select():
+    """行から (件数, 合計, 二乗和, 最小, 最大) を集計する列"""
+    return ", ".join(
+        f"COUNT({m}), COALESCE(SUM({m}), 0), COALESCE(SUM({m} * {m}), 0), MIN({m}), MAX({m})" for m in METRICS)
+
+
+def _merged_select():
+    """部分集計行をさらにまとめる列"""
+    return ", ".join(f"SUM({m}_count), SUM({m}_sum), SUM({m}_sumsq), MIN({m}_min), MAX({m}_max)" for m in METRICS)
+
+
+def _raw_partials(cursor, table_name, width, location, start_epoch, end_epoch):
+    """[start_epoch, end_epoch) の sensor_data の行をロールアップ行と同じ形に集計する"""
+    location_condition = " AND location_id = ?" if location is not None else ""
+    location_params = (locations.location_id(cursor.connection, location),) if location is not None else ()
+    return cursor.execute(f'''
+        SELECT (CAST(strftime('%s', timestamp) AS INTEGER) / {width}) * {width} AS bucket, COUNT(*), {_partial_select()}
+        FROM (SELECT timestamp, {anomalies.masked_columns()} FROM {table_name}
+              WHERE timestamp >= ? AND timestamp < ?{location_condition})
+        GROUP BY bucket
+        ORDER BY bucket
+    ''', (*(time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(t)) for t in (start_epoch, end_epoch)),
+          *location_params)).fetchall()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain pre-aggregated sensor_data rollups")
+    parser.add_argument("--db", default=os.getenv("SENSOR_DB_PATH", "sensor_data.db"))
+    parser.add_argument("--rebuild", action="store_true", help="sensor_data から全ロールアップを作り直す")
+    args = parser.parse_args(argv)
+    if args.rebuild:
+        conn = sqlite3.connect(args.db)
+        ensure_index(conn)
+        rebuild(conn)
+        count = conn.execute("SELECT COUNT(*) FROM sensor_rollups").fetchone()[0]
+        conn.close()
+        print(f"✅ {count} rollup rows rebuilt")
+
+
+if __name__ == "__main__":
+    main()
@@ -5,8 +5,17 @@ SEN0193 Capacitive Soil Moisture Sensor Class
 Raspberry Pi + MCP3002 A/D Converter
 """
 
+import time
+
 from gpiozero import MCP3002
 
+import metrics
+
+READ_SECONDS = metrics.histogram("sen0193_read_seconds", "SEN0193 ADC read latency in seconds")
+OUT_OF_RANGE = metrics.counter("sen0193_out_of_range_total", "SEN0193 readings outside the valid voltage window")
+READ_ERRORS = metrics.counter("sen0193_read_errors_total", "SEN0193 readings that raised an exception")
+LAST_VOLTAGE = metrics.gauge("sen0193_voltage_volts", "Last SEN0193 raw voltage")
+
 class SEN0193:
     """SEN0193 Capacitive Soil Moisture Sensor Reader Class"""
     
@@ -27,7 +36,11 @@ class SEN0193:
     
     def read_raw_voltage(self):
         """Read raw voltage from sensor"""
-        return self.adc.value * self.vref
+        start = time.perf_counter()
+        voltage = self.adc.value * self.vref
+        READ_SECONDS.observe(time.perf_counter() - start)
+        LAST_VOLTAGE.set(voltage)
+        return voltage
     
     def read_moisture_percentage(self):
         """
@@ -64,6 +77,10 @@ class SEN0193:
         try:
             voltage = self.read_raw_voltage()
             # Check if voltage is within expected range for SEN0193
-            return 0.5 <= voltage <= 3.5
+            if 0.5 <= voltage <= 3.5:
+                return True
+            OUT_OF_RANGE.inc()
+            return False
         except:
+            READ_ERRORS.inc()
             return False
\ No newline at end of file
@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+Mergeable quantile sketches (t-digest)
+
+場所×メトリクスごとに1時間・1日単位の t-digest をデータ取り込み時に更新し、
+sensor_sketches テーブルに保存する。問い合わせ時は期間内のスケッチを
+マージするだけで分位点（p5/p50/p95 など）が求まるため、sensor_data を
+ORDER BY で並べ替える必要がない。30日・1年の期間でも、日単位のスケッチ
+数百個と端の時間単位スケッチのマージで済む。
+
+既存データからの作成:
+    python sketches.py --rebuild
+"""
+
+import argparse
+import math
+import os
+import sqlite3
+from array import array
+from datetime import datetime, timedelta
+
+import anomalies
+import locations
+import rollups
+import timeseries
+
+METRICS = ("temperature", "humidity", "soil_moisture")
+DEFAULT_COMPRESSION = 100
+
+CREATE_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS sensor_sketches (
+        sensor_location TEXT NOT NULL,
+        period TEXT NOT NULL,
+        bucket_start TEXT NOT NULL,
+        metric TEXT NOT NULL,
+        digest BLOB NOT NULL,
+        PRIMARY KEY (sensor_location, period, bucket_start, metric)
+    ) WITHOUT ROWID
+'''
+
+PERIOD_FORMATS = {
+    "hour": "%Y-%m-%d %H:00:00",
+    "day": "%Y-%m-%d 00:00:00",
+}
+
+
+class TDigest:
+    """Merging t-digest（スケール関数 k1）"""
+
+    def __init__(self, compression=DEFAULT_COMPRESSION):
+        self.compression = compression
+        self.means = []
+        self.weights = []
+        self.total = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+        self._buffer = []
+
+    # --- 追加・マージ ---
+    def add(self, x, weight=1.0):
+        if x is None:
+            return
+        self._buffer.append((x, weight))
+        self.total += weight
+        if x < self.min:
+            self.min = x
+        if x > self.max:
+            self.max = x
+        if len(self._buffer) >= self.compression * 5:
+            self.compress()
+
+    def merge(self, other):
+        other.compress()
+        self._buffer.extend(zip(other.means, other.weights))
+        self.total += other.total
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        if len(self._buffer) >= self.compression * 5:
+            self.compress()
+        return self
+
+    def _k_to_q(self, k):
+        return (math.sin(k * 2 * math.pi / self.compression) + 1) / 2
+
+    def _q_to_k(self, q):
+        return self.compression / (2 * math.pi) * math.asin(2 * q - 1)
+
+    def compress(self):
+        if not self._buffer:
+            return
+        items = sorted(list(zip(self.means, self.weights)) + self._buffer)
+        self._buffer = []
+        total = self.total
+        means, weights = [], []
+        cur_mean, cur_weight = items[0]
+        q0 = 0.0
+        q_limit = self._k_to_q(self._q_to_k(q0) + 1)
+        for mean, weight in items[1:]:
+            if q0 + (cur_weight + weight) / total <= q_limit:
+                cur_weight += weight
+                cur_mean += (mean - cur_mean) * weight / cur_weight
+            else:
+                means.append(cur_mean)
+                weights.append(cur_weight)
+                q0 += cur_weight / total
+                q_limit = self._k_to_q(min(self._q_to_k(min(q0, 1.0)) + 1, self.compression / 4))
+                cur_mean, cur_weight = mean, weight
+        means.append(cur_mean)
+        weights.append(cur_weight)
+        self.means, self.weights = means, weights
+
+    # --- 分位点 ---
+    def quantile(self, q):
+        self.compress()
+        if not self.means:
+            return None
+        if len(self.means) == 1 or q <= 0:
+            return self.min if q <= 0 else self.means[0]
+        if q >= 1:
+            return self.max
+        target = q * self.total
+        cumulative = 0.0
+        for i, (mean, weight) in enumerate(zip(self.means, self.weights)):
+            # 各セントロイドの中心位置（累積重みの中央）を基準に線形補間
+            center = cumulative + weight / 2
+            if target < center:
+                if i == 0:
+                    left_mean, left_center = self.min, 0.0
+                else:
+                    left_mean = self.means[i - 1]
+                    left_center = cumulative - self.weights[i - 1] / 2
+                span = center - left_center
+                return left_mean + (mean - left_mean) * (target - left_center) / span if span > 0 else mean
+            cumulative += weight
+        last_center = self.total - self.weights[-1] / 2
+        span = self.total - last_center
+        return self.means[-1] + (self.max - self.means[-1]) * (target - last_center) / span if span > 0 else self.max
+
+    # --- シリアライズ ---
+    def to_bytes(self):
+        self.compress()
+        values = array("d", [self.compression, self.min, self.max])
+        for mean, weight in zip(self.means, self.weights):
+            values.append(mean)
+            values.append(weight)
+        return values.tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        values = array("d")
+        values.frombytes(data)
+        digest = cls(int(values[0]))
+        digest.min, digest.max = values[1], values[2]
+        digest.means = list(values[3::2])
+        digest.weights = list(values[4::2])
+        digest.total = sum(digest.weights)
+        return digest
+
+
+# --- DB操作 ---
+def ensure_table(conn):
+    conn.execute(CREATE_TABLE_SQL)
+
+
+def to_datetime(timestamp):
+    if isinstance(timestamp, str):
+        return datetime.fromisoformat(timestamp.split(".")[0])
+    return timestamp
+
+
+def record_reading(conn, location, timestamp, values, table_name="sensor_data"):
+    """1件の読み取り値を時間・日単位のスケッチに反映する（コミットは呼び出し側）
+
+    テーブルが無かった場合は sensor_data から構築する（この読み取りも含まれる）。
+    """
+    if ensure_built(conn, table_name):
+        return
+    ensure_table(conn)
+    dt = to_datetime(timestamp)
+    for period, fmt in PERIOD_FORMATS.items():
+        bucket_start = dt.strftime(fmt)
+        for metric in METRICS:
+            value = values.get(metric)
+            if value is None:
+                continue
+            row = conn.execute(
+                "SELECT digest FROM sensor_sketches WHERE sensor_location = ? AND period = ? AND bucket_start = ? AND metric = ?",
+                (location, period, bucket_start, metric)).fetchone()
+            digest = TDigest.from_bytes(row[0]) if row else TDigest()
+            digest.add(float(value))
+            conn.execute(
+                "INSERT OR REPLACE INTO sensor_sketches (sensor_location, period, bucket_start, metric, digest) VALUES (?, ?, ?, ?, ?)",
+                (location, period, bucket_start, metric, digest.to_bytes()))
+
+
+def rebuild(conn, table_name="sensor_data", batch_size=10000, location=None, start_epoch=None, end_epoch=None):
+    """sensor_data からスケッチを作り直す（品質フラグの付いた値は除外）
+
+    location を指定した場合はその場所だけ、start_epoch / end_epoch を指定した場合は
+    その期間を含む日の分だけを作り直す。
+    """
+    ensure_table(conn)
+    rollups.ensure_index(conn, table_name)
+    anomalies.ensure_column(conn, table_name)
+    data_conditions, data_params, sketch_conditions, sketch_params = [], [], [], []
+    if location is not None:
+        data_conditions.append("d.location_id = ?")
+        data_params.append(locations.location_id(conn, location))
+        sketch_conditions.append("sensor_location = ?")
+        sketch_params.append(location)
+    if start_epoch is not None:
+        first_day, end_day = (timeseries.epoch_text(start_epoch // 86400 * 86400),
+                              timeseries.epoch_text(-(-end_epoch // 86400) * 86400))
+        data_conditions.append("d.timestamp >= ? AND d.timestamp < ?")
+        sketch_conditions.append("bucket_start >= ? AND bucket_start < ?")
+        data_params += [first_day, end_day]
+        sketch_params += [first_day, end_day]
+    data_where = " WHERE " + " AND ".join(data_conditions) if data_conditions else ""
+    sketch_where = " WHERE " + " AND ".join(sketch_conditions) if sketch_conditions else ""
+    conn.execute(f"DELETE FROM sensor_sketches{sketch_where}", sketch_params)
+    digests = {}
+    cursor = conn.execute(f'''
+        SELECT l.name, timestamp, {anomalies.masked_columns()}
+        FROM {table_name} d JOIN locations l ON l.id = d.location_id{data_where}
+    ''', data_params)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for location, timestamp, *values in rows:
+            # 先頭13文字/10文字で時間・日のバケットを決める（datetimeへの変換を避ける）
+            keys = (("hour", timestamp[:13] + ":00:00"), ("day", timestamp[:10] + " 00:00:00"))
+            for period, bucket_start in keys:
+                for metric, value in zip(METRICS, values):
+                    if value is None:
+                        continue
+                    key = (location, period, bucket_start, metric)
+                    digest = digests.get(key)
+                    if digest is None:
+                        digest = digests[key] = TDigest()
+                    digest.add(float(value))
+    conn.executemany(
+        "INSERT INTO sensor_sketches (sensor_location, period, bucket_start, metric, digest) VALUES (?, ?, ?, ?, ?)",
+        ((*key, digest.to_bytes()) for key, digest in digests.items()))
+    conn.commit()
+    return len(digests)
+
+
+def ensure_built(conn, table_name="sensor_data"):
+    """テーブルが無い（または空で sensor_data に行がある）場合に既存データから構築する。構築した場合 True"""
+    if not rollups.table_exists(conn, table_name):
+        return False
+    if rollups.table_exists(conn, "sensor_sketches") and (
+            conn.execute("SELECT 1 FROM sensor_sketches LIMIT 1").fetchone()
+            or not conn.execute(f"SELECT 1 FROM {table_name} LIMIT 1").fetchone()):
+        return False
+    rebuild(conn, table_name)
+    return True
+
+
+def _period_ranges(start, end):
+    """[start, end) を日単位スケッチと端の時間単位スケッチの範囲に分割する"""
+    hour_start = start.replace(minute=0, second=0, microsecond=0)
+    first_day = start.replace(hour=0, minute=0, second=0, microsecond=0)
+    if first_day < start:
+        first_day += timedelta(days=1)
+    last_day = end.replace(hour=0, minute=0, second=0, microsecond=0)
+    if first_day >= last_day:
+        return [("hour", hour_start, end)]
+    ranges = [("day", first_day, last_day)]
+    if hour_start < first_day:
+        ranges.append(("hour", hour_start, first_day))
+    if last_day < end:
+        ranges.append(("hour", last_day, end))
+    return ranges
+
+
+def load_merged(conn, start, end, location=None, metrics=METRICS):
+    """期間内のスケッチを場所×メトリクスごとにマージして返す"""
+    merged = {}
+    cursor = conn.cursor()
+    placeholders = ",".join("?" for _ in metrics)
+    for period, range_start, range_end in _period_ranges(start, end):
+        sql = f'''
+            SELECT sensor_location, metric, digest FROM sensor_sketches
+            WHERE period = ? AND bucket_start >= ? AND bucket_start < ? AND metric IN ({placeholders})
+        '''
+        params = [period, range_start.strftime("%Y-%m-%d %H:%M:%S"), range_end.strftime("%Y-%m-%d %H:%M:%S"), *metrics]
+        if location is not None:
+            sql += " AND sensor_location = ?"
+            params.append(location)
+        for loc, metric, blob in cursor.execute(sql, params):
+            target = merged.setdefault(loc, {}).get(metric)
+            digest = TDigest.from_bytes(blob)
+            if target is None:
+                merged[loc][metric] = digest
+            else:
+                target.merge(digest)
+    return merged
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain per-location quantile sketches")
+    parser.add_argument("--db", default=os.getenv("SENSOR_DB_PATH", "sensor_data.db"))
+    parser.add_argument("--rebuild", action="store_true", help="sensor_data から全スケッチを作り直す")
+    args = parser.parse_args(argv)
+    if args.rebuild:
+        conn = sqlite3.connect(args.db)
+        count = rebuild(conn)
+        conn.close()
+        print(f"✅ {count} sketches rebuilt")
+
+
+if __name__ == "__main__":
+    main()
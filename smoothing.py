@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Smoothing overlays for chart series (moving average / EWMA / Savitzky–Golay)
+
+SEN0193 のような静電容量式土壌センサーはノイズが大きいため、グラフ系列に
+平滑化した線を重ねて傾向を見やすくする。どの方式も系列を1回走査するだけ（O(n)）で、
+窓幅（点数）は MAX_POINTS までに制限するので、表示期間が長くなっても
+1点あたりのコストは変わらない。
+
+欠損（NaN）は平滑化の計算から除外し、出力でも欠損のまま残す。
+"""
+
+import numpy as np
+
+import aggregation
+
+METHODS = {
+    "ma": "移動平均",
+    "ewma": "指数移動平均",
+    "savgol": "Savitzky–Golay",
+}
+DEFAULT_POINTS = 6
+MAX_POINTS = 101
+SAVGOL_ORDER = 2
+
+
+def parse_smoothing(method, points=None):
+    """クエリの smooth / smooth_points を検証して (方式, 点数) を返す。平滑化なしは None"""
+    if not method or method == "none":
+        return None
+    if method not in METHODS:
+        raise ValueError(f"smooth must be one of {['none'] + sorted(METHODS)}")
+    try:
+        points = int(points) if points else DEFAULT_POINTS
+    except ValueError:
+        raise ValueError("smooth_points must be an integer")
+    if not 2 <= points <= MAX_POINTS:
+        raise ValueError(f"smooth_points must be between 2 and {MAX_POINTS}")
+    if method == "savgol" and points % 2 == 0:
+        points += 1  # Savitzky–Golay は中心対称の窓なので奇数にする
+    return method, points
+
+
+def moving_average(values, points):
+    """直近 points 点の単純移動平均（累積和で O(n)）"""
+    return aggregation.rolling_mean(values, points)
+
+
+def ewma(values, points):
+    """指数移動平均。平滑化係数は points 点のEMAと同じ 2 / (points + 1)"""
+    values = np.atleast_2d(values)
+    alpha = 2.0 / (points + 1)
+    rows = []
+    for column in values.tolist():
+        state = None
+        out = []
+        for value in column:
+            if value == value:  # NaN は状態を更新しない
+                state = value if state is None else state + alpha * (value - state)
+            out.append(state)
+        rows.append(out)
+    return np.array(rows, dtype=float)
+
+
+def savgol_coefficients(points, order=SAVGOL_ORDER):
+    """窓幅 points（奇数）・order 次多項式の平滑化係数"""
+    half = points // 2
+    order = min(order, points - 1)
+    offsets = np.arange(-half, half + 1, dtype=float)
+    vandermonde = offsets[:, None] ** np.arange(order + 1)
+    return np.linalg.pinv(vandermonde)[0]
+
+
+def savitzky_golay(values, points, order=SAVGOL_ORDER):
+    """Savitzky–Golay 平滑化（固定長の畳み込みなので O(n)）
+
+    欠損は前後の値で線形補間してから畳み込み、両端は端点で点対称に折り返して延長する。
+    """
+    values = np.atleast_2d(values)
+    coefficients = savgol_coefficients(points, order)
+    half = points // 2
+    result = np.full(values.shape, np.nan)
+    for row, column in enumerate(values):
+        present = ~np.isnan(column)
+        if not present.any():
+            continue
+        positions = np.arange(column.size)
+        filled = np.interp(positions, positions[present], column[present])
+        padded = np.pad(filled, half, mode="reflect", reflect_type="odd")
+        result[row] = np.convolve(padded, coefficients[::-1], mode="valid")
+    return result
+
+
+FUNCTIONS = {
+    "ma": moving_average,
+    "ewma": ewma,
+    "savgol": savitzky_golay,
+}
+
+
+def smooth(values, method, points):
+    """(メトリクス, 点) の配列を平滑化する。元が欠損の点は欠損のまま"""
+    values = np.atleast_2d(values)
+    if values.shape[1] == 0:
+        return values.copy()
+    result = FUNCTIONS[method](values, points)
+    result[np.isnan(values)] = np.nan
+    return result
+
+
+def label(method, points):
+    return f"{METHODS[method]}（{points}点）"
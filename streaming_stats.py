@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+Mergeable statistics accumulators
+
+ロールアップの部分集計（件数・合計・二乗和・最小・最大）をまとめて 件数・平均・最小・最大・
+標準偏差・最終値 を求めるアキュムレーター。平均と分散は Chan の方法でマージし、値は保持しない。
+分位点は部分集計からは求まらないので、スケッチ（sketches）か生データから求めた値を
+set_quantile() で与える（生データの統計は aggregation.summarize で NumPy から直接求める）。
+"""
+
+import math
+
+DEFAULT_QUANTILES = (0.05, 0.5, 0.95)
+
+
+class RunningStats:
+    """1系列分の統計（部分集計のマージ）"""
+
+    __slots__ = ("count", "mean", "m2", "min", "max", "last", "quantiles")
+
+    def __init__(self, quantiles=DEFAULT_QUANTILES):
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+        # 分位点 → 値（set_quantile() で与えるまでは None）
+        self.quantiles = dict.fromkeys(quantiles)
+
+    def add_partial(self, count, total, sumsq, minimum, maximum):
+        """事前集計済みの (件数, 合計, 二乗和, 最小, 最大) をマージする（Chanの方法）
+
+        分位点には反映されないため、set_quantile() で外部の値を与える。
+        """
+        if not count:
+            return
+        mean_b = total / count
+        m2_b = max(sumsq - total * mean_b, 0.0)
+        n = self.count + count
+        delta = mean_b - self.mean
+        self.mean += delta * count / n
+        self.m2 += m2_b + delta * delta * self.count * count / n
+        self.count = n
+        if self.min is None or minimum < self.min:
+            self.min = minimum
+        if self.max is None or maximum > self.max:
+            self.max = maximum
+
+    def set_last(self, value):
+        if value is not None:
+            self.last = value
+
+    def set_quantile(self, q, value):
+        """分位点の値（スケッチ・生データから求めたもの）を設定する"""
+        if q in self.quantiles:
+            self.quantiles[q] = value
+
+    @property
+    def std(self):
+        if self.count < 2:
+            return 0.0 if self.count else None
+        return math.sqrt(self.m2 / (self.count - 1))
+
+    def summary(self, digits=1, empty=0):
+        """テンプレート表示用の丸め済み辞書（データなしは empty）"""
+        def r(value):
+            return round(value, digits) if value is not None else empty
+
+        result = {
+            "count": self.count,
+            "avg": r(self.mean if self.count else None),
+            "min": r(self.min),
+            "max": r(self.max),
+            "std": r(self.std),
+            "last": r(self.last),
+        }
+        for q, value in self.quantiles.items():
+            result[f"p{int(round(q * 100))}"] = r(value)
+        return result
+
+
+class WindowStats:
+    """複数メトリクス分の RunningStats をまとめたもの"""
+
+    def __init__(self, metrics, quantiles=DEFAULT_QUANTILES):
+        self.metrics = tuple(metrics)
+        self.rows = 0
+        self.series = {m: RunningStats(quantiles) for m in self.metrics}
+
+    def add_partials(self, rows, partials):
+        """partials はメトリクス順の (件数, 合計, 二乗和, 最小, 最大)"""
+        self.rows += rows
+        for metric, partial in zip(self.metrics, partials):
+            self.series[metric].add_partial(*partial)
+
+    def merge(self, other):
+        """別の WindowStats の件数・平均・分散・最小・最大を取り込む"""
+        self.rows += other.rows
+        for metric in self.metrics:
+            mine, theirs = self.series[metric], other.series[metric]
+            if theirs.count:
+                total = theirs.mean * theirs.count
+                sumsq = theirs.m2 + total * theirs.mean
+                mine.add_partial(theirs.count, total, sumsq, theirs.min, theirs.max)
+
+    def summary(self, digits=1):
+        result = {"count": self.rows}
+        for metric in self.metrics:
+            result[metric] = self.series[metric].summary(digits)
+        return result
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+"""alerts.AlertDispatcher / SMTPTransport を FakeSMTPServer に対して送信して確認する"""
+
+import email
+import json
+from email.header import decode_header, make_header
+from email.mime.text import MIMEText
+
+import pytest
+
+from alerts import AlertDispatcher, FakeSMTPServer, SMTPTransport
+
+
+def message(subject):
+    msg = MIMEText("body")
+    msg["Subject"] = subject
+    msg["From"] = "logger@example.com"
+    msg["To"] = "owner@example.com"
+    return msg
+
+
+def subjects(server):
+    return [str(make_header(decode_header(email.message_from_string(m["data"])["Subject"])))
+            for m in server.messages]
+
+
+@pytest.fixture
+def server():
+    with FakeSMTPServer() as server:
+        yield server
+
+
+def dispatcher_for(server, state_path=None, digest_window=0.0):
+    transport = SMTPTransport("127.0.0.1", server.port, starttls=False)
+    return AlertDispatcher(transport, "logger@example.com", "owner@example.com",
+                           digest_window=digest_window, state_path=state_path)
+
+
+def test_alerts_within_digest_window_are_sent_as_one_email(server):
+    dispatcher = dispatcher_for(server, digest_window=0.5)
+    assert dispatcher.submit("moisture", "乾燥 A", "body", source="a")
+    assert dispatcher.submit("moisture", "乾燥 B", "body", source="b")
+    assert dispatcher.submit("sensor_error", "読み取り失敗", "body", source="a/DHT11")
+    dispatcher.close(timeout=10)
+    assert len(server.messages) == 1
+    assert "3件" in subjects(server)[0]
+    assert server.messages[0]["to"] == ["<owner@example.com>"]
+
+
+def test_cooldown_is_per_kind_and_source(server, tmp_path):
+    state_path = str(tmp_path / "alert_state.json")
+    dispatcher = dispatcher_for(server, state_path)
+    assert dispatcher.submit("moisture", "乾燥 A", "body", source="a")
+    # 送信待ちの間も同じ種別・発生元は重複させない
+    assert not dispatcher.submit("moisture", "乾燥 A", "body", source="a")
+    assert dispatcher.submit("moisture", "乾燥 B", "body", source="b")
+    dispatcher.close(timeout=10)
+    assert sorted(subjects(server)) == ["乾燥 A", "乾燥 B"]
+
+    # 次の cron 実行（状態ファイルを引き継ぐ）
+    dispatcher = dispatcher_for(server, state_path)
+    assert not dispatcher.submit("moisture", "乾燥 A", "body", source="a")
+    assert dispatcher.submit("moisture", "乾燥 C", "body", source="c")
+    assert dispatcher.submit("sensor_error", "読み取り失敗", "body", source="a")
+    dispatcher.close(timeout=10)
+    with open(state_path) as f:
+        assert set(json.load(f)["last_sent"]) == {"moisture:a", "moisture:b", "moisture:c", "sensor_error:a"}
+
+
+def test_failed_send_does_not_start_cooldown(tmp_path):
+    state_path = str(tmp_path / "alert_state.json")
+    with FakeSMTPServer() as stopped:
+        port = stopped.port
+    # 止まったサーバーへの送信は接続できずに失敗する
+    transport = SMTPTransport("127.0.0.1", port, starttls=False, timeout=2)
+    dispatcher = AlertDispatcher(transport, "logger@example.com", "owner@example.com",
+                                 digest_window=0.0, state_path=state_path)
+    assert dispatcher.submit("moisture", "乾燥 A", "body", source="a")
+    dispatcher.close(timeout=10)
+    with open(state_path) as f:
+        assert json.load(f)["last_sent"] == {}
+
+    with FakeSMTPServer() as server:
+        dispatcher = dispatcher_for(server, state_path)
+        assert dispatcher.submit("moisture", "乾燥 A", "body", source="a")
+        dispatcher.close(timeout=10)
+        assert subjects(server) == ["乾燥 A"]
+
+
+def test_transport_reconnects_after_server_disconnected(server):
+    transport = SMTPTransport("127.0.0.1", server.port, starttls=False)
+    transport.send(message("1通目"))
+    # サーバーに切断された後の状態（smtplib はソケットを閉じ、次の送信で SMTPServerDisconnected）
+    transport._server.close()
+    transport.send(message("2通目"))
+    transport.close()
+    assert server.connections == 2
+    assert subjects(server) == ["1通目", "2通目"]
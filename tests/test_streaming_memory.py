@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+"""/api/data?stream=1（stream_api_data）のRSSの増加量が期間の行数によらず一定の範囲に収まることの確認"""
+
+import sqlite3
+
+import pytest
+
+import benchmark_dashboard
+import dashboard
+import timeseries
+from instrumentation import MemoryTracker, TimedConnection
+
+ROWS = 2_000_000
+LOCATIONS = 2
+# ストリーミングで許すRSSの増加量（全件をリストにすると数百MBになる）
+RSS_BUDGET = 64 * 2**20
+
+
+@pytest.fixture(scope="module")
+def large_db(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp("stream") / "large.db")
+    benchmark_dashboard.seed_database(path, ROWS, LOCATIONS)
+    return path
+
+
+@pytest.mark.parametrize("location, expected", [(None, ROWS), ("bench_001", ROWS // LOCATIONS)])
+def test_stream_rss_stays_bounded(large_db, location, expected):
+    conn = sqlite3.connect(large_db, factory=TimedConnection)
+    cursor = conn.cursor()
+    table_name = dashboard.resolve_table_name(cursor)
+    window = timeseries.resolve_window("1y", "raw", None, None)
+    memory = MemoryTracker()
+    newlines = 0
+    # 本文は溜めずに読み捨てる（接続はジェネレーターが閉じる）
+    for chunk in dashboard.stream_api_data(conn, cursor, table_name, window, location, {}, 1200, memory,
+                                           "/api/data"):
+        newlines += chunk.count(b"\n")
+    # 先頭の "rows": [ の行と末尾の ] / "memory" の行を除くと1行1件
+    assert newlines - 2 == expected
+    assert memory.peak - memory.start < RSS_BUDGET, memory.report()
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+"""
+Tiled time-series access for zoom / pan
+
+時間軸を (バケット幅, タイル番号) の固定グリッドに区切り、1タイル = TILE_SIZE バケット分の
+平均値系列として返す。グラフをズーム・パンしたときは、表示範囲と画面幅から
+バケット幅を選び、表示範囲にかかるタイルだけを取得すればよい。
+
+タイルの範囲は絶対時刻で決まるため、同じ (場所, バケット幅, タイル番号) は何度でも
+再利用できる。終了済みのタイル（終端が現在時刻より前）は内容が変わらないので
+サーバー側のLRUキャッシュとブラウザのHTTPキャッシュに長期間置き、
+現在時刻を含むタイルだけ短い有効期限にする。
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+import timeseries
+
+# ズームレベルとして使うバケット幅（秒）。ロガーは10分間隔なので1分幅がほぼ生データ
+TILE_BUCKETS = (60, 15 * 60, 3600, 6 * 3600, 86400, timeseries.WEEK)
+# 1タイルあたりのバケット数
+TILE_SIZE = 240
+# 現在時刻を含むタイルの有効期限（秒）
+OPEN_TILE_TTL = 60
+CACHE_ENTRIES = 1024
+
+TILE_CACHE = metrics.counter(
+    "dashboard_tile_cache_total", "Tile cache lookups by result", ("result",))
+
+
+def tile_origin(bucket):
+    """週単位のタイルは月曜始まりに揃える"""
+    return timeseries.WEEK_ORIGIN if bucket % timeseries.WEEK == 0 else 0
+
+
+def tile_range(bucket, index):
+    """タイルの [開始, 終了) をUNIX秒で返す"""
+    span = bucket * TILE_SIZE
+    start = tile_origin(bucket) + index * span
+    return start, start + span
+
+
+def tile_index(bucket, epoch):
+    return (epoch - tile_origin(bucket)) // (bucket * TILE_SIZE)
+
+
+class TileCache:
+    """(場所, バケット幅, タイル番号) をキーにしたスレッドセーフなLRUキャッシュ"""
+
+    def __init__(self, max_entries=CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires is not None and expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, ttl=None):
+        expires = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_load(self, key, loader, ttl=None):
+        """キャッシュにあれば返し、無ければ loader() の結果を保存して返す。(値, ヒットしたか)"""
+        value = self.get(key)
+        if value is not None:
+            TILE_CACHE.labels("hit").inc()
+            return value, True
+        TILE_CACHE.labels("miss").inc()
+        value = loader()
+        self.put(key, value, ttl)
+        return value, False
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+CACHE = TileCache()
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Time window and bucket resolution for dashboard queries
+
+クエリパラメータ（range / from / to / aggregate）から表示期間とバケット幅を決め、
+読み出し元（生データ or ロールアップ）を選ぶ。
+
+- range:     1h〜30d の既定キーに加え 90d / 1y
+- from / to: ISO 8601 形式の日時 または UNIX秒
+- aggregate: raw / hourly / daily / weekly、または 5m・15m・6h・1w のような任意の幅
+"""
+
+import re
+from datetime import datetime, timedelta
+
+import rollups
+
+RANGE_DELTAS = {
+    "1h": timedelta(hours=1),
+    "6h": timedelta(hours=6),
+    "12h": timedelta(hours=12),
+    "24h": timedelta(days=1),
+    "3d": timedelta(days=3),
+    "7d": timedelta(days=7),
+    "30d": timedelta(days=30),
+    "90d": timedelta(days=90),
+    "1y": timedelta(days=365),
+}
+
+AGGREGATE_ALIASES = {
+    "raw": None,
+    "hourly": 3600,
+    "daily": 86400,
+    "weekly": 7 * 86400,
+}
+
+AGGREGATE_LABELS = {
+    "raw": "生データ",
+    "hourly": "1時間平均",
+    "daily": "1日平均",
+    "weekly": "1週間平均",
+}
+
+_UNIT_SECONDS = {"s": 1, "m": 60, "min": 60, "h": 3600, "d": 86400, "w": 7 * 86400}
+_BUCKET_RE = re.compile(r"^(\d+)\s*(s|min|m|h|d|w)$")
+
+WEEK = 7 * 86400
+# 1970-01-05 は月曜日。週単位のバケットは月曜始まりに揃える
+WEEK_ORIGIN = 4 * 86400
+
+
+def parse_bucket(text):
+    """'raw' / 'hourly' / '15m' / '6h' / '1w' などを秒数に変換（生データは None）"""
+    text = (text or "raw").strip().lower()
+    if text in AGGREGATE_ALIASES:
+        return AGGREGATE_ALIASES[text]
+    match = _BUCKET_RE.match(text)
+    if not match or int(match.group(1)) == 0:
+        raise ValueError(f"invalid bucket width: {text}")
+    return int(match.group(1)) * _UNIT_SECONDS[match.group(2)]
+
+
+def parse_time(text):
+    """ISO 8601 または UNIX秒（ローカル時刻として解釈）を datetime に変換"""
+    text = text.strip()
+    if re.fullmatch(r"\d+(\.\d+)?", text):
+        return datetime.fromtimestamp(float(text))
+    dt = datetime.fromisoformat(text.replace("Z", "+00:00"))
+    if dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+    return dt
+
+
+def bucket_label(seconds):
+    if seconds is None:
+        return "raw"
+    for unit, size in (("w", WEEK), ("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds % size == 0:
+            return f"{seconds // size}{unit}"
+    return f"{seconds}s"
+
+
+def aggregate_label(aggregate_param, bucket_seconds):
+    """画面表示用の集計方法名"""
+    if aggregate_param in AGGREGATE_LABELS:
+        return AGGREGATE_LABELS[aggregate_param]
+    return f"{bucket_label(bucket_seconds)}平均"
+
+
+class Window:
+    """表示期間 [start, end) とバケット幅"""
+
+    def __init__(self, start, end, bucket, range_key):
+        self.start = start
+        self.end = end
+        self.bucket = bucket
+        self.range_key = range_key
+        self.origin = WEEK_ORIGIN if bucket and bucket % WEEK == 0 else 0
+        self.tier = rollups.choose_tier(bucket, self.origin)
+
+    @property
+    def start_epoch(self):
+        return rollups.naive_epoch(self.start)
+
+    @property
+    def end_epoch(self):
+        return rollups.naive_epoch(self.end)
+
+    @property
+    def source(self):
+        return "raw" if self.tier is None else f"rollup_{bucket_label(self.tier)}"
+
+    def start_text(self):
+        return self.start.strftime("%Y-%m-%d %H:%M:%S")
+
+    def end_text(self):
+        return self.end.strftime("%Y-%m-%d %H:%M:%S")
+
+    def bucket_start(self, epoch):
+        return ((epoch - self.origin) // self.bucket) * self.bucket + self.origin
+
+    def format_type(self):
+        """format_timestamp 用の表示形式"""
+        if self.bucket is None or self.bucket < 3600:
+            return "raw"
+        if self.bucket < 86400:
+            return "hourly"
+        return "daily"
+
+    def metadata(self):
+        return {
+            "from": self.start.isoformat(timespec="seconds"),
+            "to": self.end.isoformat(timespec="seconds"),
+            "bucket": bucket_label(self.bucket),
+            "bucket_seconds": self.bucket,
+            "source": self.source,
+        }
+
+
+def nearest_range_key(duration):
+    """任意期間に対して、表示形式の決定に使う既定キーを選ぶ"""
+    for key in ("1h", "6h", "12h", "24h", "3d", "7d", "30d"):
+        if duration <= RANGE_DELTAS[key] * 1.01:
+            return key
+    return "30d"
+
+
+def resolve_window(range_param="24h", aggregate_param="raw", from_param=None, to_param=None, now=None):
+    """クエリパラメータから Window を作る。不正な値は ValueError"""
+    now = now or datetime.now()
+    bucket = parse_bucket(aggregate_param)
+    if from_param or to_param:
+        end = parse_time(to_param) if to_param else now
+        start = parse_time(from_param) if from_param else end - RANGE_DELTAS["24h"]
+        if start >= end:
+            raise ValueError("from must be earlier than to")
+        range_key = nearest_range_key(end - start)
+    else:
+        range_param = range_param or "24h"
+        if range_param not in RANGE_DELTAS:
+            raise ValueError(f"unknown range: {range_param}")
+        end = now
+        start = now - RANGE_DELTAS[range_param]
+        range_key = range_param if range_param in ("1h", "6h", "12h", "24h", "3d", "7d", "30d") else "30d"
+    return Window(start, end, bucket, range_key)
+
+
+# --- 時刻文字列 ⇔ UNIX秒 ---
+_EPOCH_BASE = datetime(1970, 1, 1)
+_day_epochs = {}
+
+
+def timestamp_epoch(timestamp_str):
+    """'YYYY-MM-DD HH:MM:SS[.ffffff]' をUNIX秒に変換（日付部分はキャッシュ）"""
+    day = timestamp_str[:10]
+    base = _day_epochs.get(day)
+    if base is None:
+        if len(_day_epochs) > 4096:
+            _day_epochs.clear()
+        base = _day_epochs[day] = rollups.naive_epoch(datetime.strptime(day, "%Y-%m-%d"))
+    return base + int(timestamp_str[11:13]) * 3600 + int(timestamp_str[14:16]) * 60 + int(timestamp_str[17:19])
+
+
+def epoch_datetime(epoch):
+    """UNIX秒をタイムゾーンなしの datetime に変換（naive_epoch の逆）"""
+    return _EPOCH_BASE + timedelta(seconds=epoch)
+
+
+def epoch_text(epoch):
+    """UNIX秒を 'YYYY-MM-DD HH:MM:SS' に変換"""
+    return epoch_datetime(epoch).strftime("%Y-%m-%d %H:%M:%S")
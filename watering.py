@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""
+Watering-event detection and drying rate
+
+場所ごとに soil_moisture の新しい読み取り値だけを走査し、直前の値からの
+急な上昇（RISE_THRESHOLD 以上）を水やりとして watering_events テーブルに記録する。
+水やり後の読み取り値には直線を当てはめ（最小二乗の累積値を行に保持するので O(1) で更新）、
+乾燥速度（%/時）として保存する。
+
+ダッシュボードとアラートは status() で「最後の水やりからの日数」と
+「乾燥の閾値（場所ごとの設定、既定は DRY_THRESHOLD = 30%）を下回るまでの予測時間」を索引の1行参照で得られ、
+生データを遡って走査する必要がない。
+
+ロガーは読み取りごとに update() で追記する。既存データからの作成:
+    python watering.py --rebuild
+"""
+
+import argparse
+import os
+import sqlite3
+from datetime import datetime
+
+import anomalies
+import locations
+import rollups
+import timeseries
+
+# 直前の読み取り値からこれ以上上がったら水やりとみなす（%ポイント）
+RISE_THRESHOLD = float(os.getenv("WATERING_RISE", "8"))
+# この時間内の続けての上昇は同じ水やり（染み込み中）として扱う
+MERGE_SECONDS = 3600
+# 乾燥速度を出すのに必要な読み取り数と期間（短すぎるとセンサーのノイズで傾きが暴れる）
+MIN_FIT_POINTS = 6
+MIN_FIT_HOURS = 3.0
+DRY_THRESHOLD = 30.0
+
+CREATE_TABLES_SQL = ('''
+    CREATE TABLE IF NOT EXISTS watering_events (
+        sensor_location TEXT NOT NULL,
+        watered_at INTEGER NOT NULL,
+        moisture_before REAL NOT NULL,
+        moisture_after REAL NOT NULL,
+        fit_count INTEGER NOT NULL DEFAULT 0,
+        fit_t REAL NOT NULL DEFAULT 0,
+        fit_v REAL NOT NULL DEFAULT 0,
+        fit_tt REAL NOT NULL DEFAULT 0,
+        fit_tv REAL NOT NULL DEFAULT 0,
+        drying_rate REAL,
+        last_reading_at INTEGER,
+        PRIMARY KEY (sensor_location, watered_at)
+    ) WITHOUT ROWID
+''', '''
+    CREATE TABLE IF NOT EXISTS watering_scan (
+        sensor_location TEXT PRIMARY KEY,
+        last_timestamp TEXT NOT NULL,
+        last_value REAL
+    ) WITHOUT ROWID
+''')
+
+EVENT_COLUMNS = ("watered_at", "moisture_before", "moisture_after", "fit_count",
+                 "fit_t", "fit_v", "fit_tt", "fit_tv", "drying_rate", "last_reading_at")
+
+
+class WateringEvent:
+    """1回の水やりと、その後の乾燥の直線当てはめ（時刻は水やりからの経過時間）"""
+
+    __slots__ = EVENT_COLUMNS
+
+    def __init__(self, watered_at, moisture_before, moisture_after, fit_count=0,
+                 fit_t=0.0, fit_v=0.0, fit_tt=0.0, fit_tv=0.0, drying_rate=None, last_reading_at=None):
+        self.watered_at = watered_at
+        self.moisture_before = moisture_before
+        self.moisture_after = moisture_after
+        self.fit_count = fit_count
+        self.fit_t = fit_t
+        self.fit_v = fit_v
+        self.fit_tt = fit_tt
+        self.fit_tv = fit_tv
+        self.drying_rate = drying_rate
+        self.last_reading_at = last_reading_at
+
+    def reset_fit(self):
+        self.fit_count = 0
+        self.fit_t = self.fit_v = self.fit_tt = self.fit_tv = 0.0
+        self.drying_rate = None
+
+    def add_point(self, epoch, value):
+        hours = (epoch - self.watered_at) / 3600.0
+        self.fit_count += 1
+        self.fit_t += hours
+        self.fit_v += value
+        self.fit_tt += hours * hours
+        self.fit_tv += hours * value
+        self.last_reading_at = epoch
+        denominator = self.fit_count * self.fit_tt - self.fit_t * self.fit_t
+        # denominator / n² は時刻の分散。期間 H に均等に並んでいれば H² / 12
+        spread = self.fit_count * self.fit_count * MIN_FIT_HOURS * MIN_FIT_HOURS / 12
+        if self.fit_count >= MIN_FIT_POINTS and denominator >= spread and denominator > 1e-12:
+            self.drying_rate = (self.fit_count * self.fit_tv - self.fit_t * self.fit_v) / denominator
+
+    def fitted(self, epoch):
+        """当てはめた直線の epoch 時点の値（傾きが無ければ None）"""
+        if self.drying_rate is None:
+            return None
+        hours = (epoch - self.watered_at) / 3600.0
+        mean_t = self.fit_t / self.fit_count
+        mean_v = self.fit_v / self.fit_count
+        return mean_v + self.drying_rate * (hours - mean_t)
+
+    def row(self):
+        return tuple(getattr(self, column) for column in EVENT_COLUMNS)
+
+
+class WateringDetector:
+    """1場所分の逐次検出器。add() で新しく検出した水やりがあれば返す"""
+
+    def __init__(self, last_value=None, event=None):
+        self.last_value = last_value
+        self.event = event
+
+    def add(self, epoch, value):
+        if value is None:
+            return None
+        detected = None
+        event = self.event
+        if self.last_value is not None and value - self.last_value >= RISE_THRESHOLD:
+            if event is not None and epoch - event.watered_at <= MERGE_SECONDS:
+                # 染み込み中の続けての上昇: 同じ水やりのピークを更新し、乾燥の当てはめはやり直す
+                event.moisture_after = value
+                event.reset_fit()
+            else:
+                event = self.event = detected = WateringEvent(epoch, self.last_value, value)
+        if event is not None:
+            event.add_point(epoch, value)
+        self.last_value = value
+        return detected
+
+
+def ensure_tables(conn):
+    for sql in CREATE_TABLES_SQL:
+        conn.execute(sql)
+
+
+def latest_event(conn, location):
+    row = conn.execute(f'''
+        SELECT {", ".join(EVENT_COLUMNS)} FROM watering_events
+        WHERE sensor_location = ? ORDER BY watered_at DESC LIMIT 1
+    ''', (location,)).fetchone()
+    return WateringEvent(*row) if row else None
+
+
+def _save(conn, location, detector, events, last_timestamp):
+    placeholders = ", ".join("?" for _ in range(len(EVENT_COLUMNS) + 1))
+    conn.executemany(
+        f"INSERT OR REPLACE INTO watering_events (sensor_location, {', '.join(EVENT_COLUMNS)}) VALUES ({placeholders})",
+        [(location, *event.row()) for event in events])
+    conn.execute(
+        "INSERT OR REPLACE INTO watering_scan (sensor_location, last_timestamp, last_value) VALUES (?, ?, ?)",
+        (location, last_timestamp, detector.last_value))
+
+
+def update(conn, table_name="sensor_data", location=None, batch_size=10000):
+    """前回の走査位置より新しい読み取り値を場所ごとに処理する（コミットは呼び出し側）。検出数を返す"""
+    ensure_tables(conn)
+    registry = locations.registry(conn)
+    names = registry.names() if location is None else [location]
+    detected = 0
+    for loc in names:
+        scan = conn.execute(
+            "SELECT last_timestamp, last_value FROM watering_scan WHERE sensor_location = ?", (loc,)).fetchone()
+        last_timestamp, last_value = scan if scan else ("", None)
+        detector = WateringDetector(last_value, latest_event(conn, loc))
+        events = {}
+        cursor = conn.execute(f'''
+            SELECT timestamp, CASE WHEN quality & {anomalies.metric_mask("soil_moisture")} THEN NULL ELSE soil_moisture END
+            FROM {table_name}
+            WHERE location_id = ? AND timestamp > ?
+            ORDER BY timestamp
+        ''', (registry.id_of(loc), last_timestamp))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for timestamp_str, value in rows:
+                if detector.add(timeseries.timestamp_epoch(timestamp_str), value):
+                    detected += 1
+                if detector.event is not None:
+                    events[detector.event.watered_at] = detector.event
+            last_timestamp = rows[-1][0]
+        if events or scan is None or last_timestamp != scan[0]:
+            _save(conn, loc, detector, [events[key] for key in sorted(events)], last_timestamp)
+    return detected
+
+
+def ensure_built(conn, table_name="sensor_data"):
+    """テーブルが無ければ作成して既存データから検出する。構築した場合 True"""
+    if not rollups.table_exists(conn, table_name) or rollups.table_exists(conn, "watering_scan"):
+        return False
+    rollups.ensure_index(conn, table_name)
+    anomalies.ensure_column(conn, table_name)
+    update(conn, table_name)
+    conn.commit()
+    return True
+
+
+def rebuild(conn, table_name="sensor_data", location=None):
+    rollups.ensure_index(conn, table_name)
+    anomalies.ensure_column(conn, table_name)
+    ensure_tables(conn)
+    for table in ("watering_events", "watering_scan"):
+        if location is None:
+            conn.execute(f"DELETE FROM {table}")
+        else:
+            conn.execute(f"DELETE FROM {table} WHERE sensor_location = ?", (location,))
+    detected = update(conn, table_name, location)
+    conn.commit()
+    return detected
+
+
+# --- 問い合わせ ---
+def threshold_for(conn, location):
+    """場所の乾燥の閾値（locations.dry_threshold。未設定なら DRY_THRESHOLD）"""
+    entry = locations.registry(conn).get(location)
+    return entry.dry_threshold if entry and entry.dry_threshold is not None else DRY_THRESHOLD
+
+
+def status(conn, location, now_epoch=None, threshold=None):
+    """最後の水やりからの日数・乾燥速度・threshold（省略時は場所の閾値）を下回るまでの予測時間"""
+    if now_epoch is None:
+        now_epoch = rollups.naive_epoch(datetime.now())
+    if threshold is None:
+        threshold = threshold_for(conn, location)
+    result = {
+        "location": location,
+        "last_watered": None,
+        "days_since_watering": None,
+        "drying_rate_per_day": None,
+        "rate_source": None,
+        "current": None,
+        "threshold": threshold,
+        "hours_until_threshold": None,
+        "predicted_at": None,
+    }
+    scan = conn.execute(
+        "SELECT last_value FROM watering_scan WHERE sensor_location = ?", (location,)).fetchone()
+    if scan:
+        result["current"] = scan[0]
+    event = latest_event(conn, location)
+    if event is None:
+        return result
+    result["last_watered"] = timeseries.epoch_text(event.watered_at)
+    result["days_since_watering"] = round((now_epoch - event.watered_at) / 86400, 2)
+    rate, current = event.drying_rate, event.fitted(event.last_reading_at)
+    if rate is None:
+        # 水やり直後で読み取りが少ないときは、前回の乾燥速度と最新の値で予測する
+        row = conn.execute('''
+            SELECT drying_rate FROM watering_events
+            WHERE sensor_location = ? AND watered_at < ? AND drying_rate IS NOT NULL
+            ORDER BY watered_at DESC LIMIT 1
+        ''', (location, event.watered_at)).fetchone()
+        if row is None or result["current"] is None:
+            return result
+        rate, current = row[0], result["current"]
+        result["rate_source"] = "previous"
+    else:
+        result["rate_source"] = "current"
+    result["drying_rate_per_day"] = round(rate * 24, 2)
+    if current <= threshold:
+        hours = 0.0
+    elif rate < 0:
+        hours = (current - threshold) / -rate
+    else:
+        return result  # 乾いていない（上昇中・横ばい）
+    predicted = event.last_reading_at + hours * 3600
+    result["hours_until_threshold"] = round(max(0.0, (predicted - now_epoch) / 3600), 1)
+    result["predicted_at"] = timeseries.epoch_text(int(predicted))
+    return result
+
+
+def events(conn, location, start_epoch, end_epoch):
+    """期間内の水やりと乾燥速度（%/日）"""
+    sql = '''
+        SELECT sensor_location, watered_at, moisture_before, moisture_after, drying_rate, fit_count
+        FROM watering_events
+        WHERE watered_at >= ? AND watered_at < ?
+    '''
+    params = [start_epoch, end_epoch]
+    if location is not None:
+        sql += " AND sensor_location = ?"
+        params.append(location)
+    return [
+        {
+            "location": loc,
+            "watered_at": timeseries.epoch_text(watered_at),
+            "before": before,
+            "after": after,
+            "drying_rate_per_day": round(rate * 24, 2) if rate is not None else None,
+            "readings": count,
+        }
+        for loc, watered_at, before, after, rate, count in conn.execute(sql + " ORDER BY watered_at", params)
+    ]
+
+
+def alert_values(state):
+    """アラートルールで参照できる派生メトリクス（値の無いものは含めない）"""
+    values = {}
+    if state["days_since_watering"] is not None:
+        values["days_since_watering"] = state["days_since_watering"]
+    if state["hours_until_threshold"] is not None:
+        values["hours_until_dry"] = state["hours_until_threshold"]
+    return values
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Detect watering events and drying rates")
+    parser.add_argument("--db", default=os.getenv("SENSOR_DB_PATH", "sensor_data.db"))
+    parser.add_argument("--rebuild", action="store_true", help="sensor_data から検出し直す")
+    parser.add_argument("--status", action="store_true", help="場所ごとの現在の状態を表示")
+    args = parser.parse_args(argv)
+    conn = sqlite3.connect(args.db)
+    try:
+        if args.rebuild:
+            print(f"✅ {rebuild(conn)} watering events detected")
+        if args.status:
+            ensure_built(conn)
+            for (location,) in conn.execute("SELECT sensor_location FROM watering_scan ORDER BY sensor_location").fetchall():
+                print(status(conn, location))
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()